@@ -0,0 +1,153 @@
+'''
+async worker runtime, started with `python worker.py --async` (or WORKER_MODE=async).
+one event loop and three keep-alive aiohttp sessions (letterboxd, tmdb api, tmdb images) live as long as the process
+so connections and tls sessions are reused from task to task. up to MAX_CONCURRENT_TASKS tasks run at once, their
+network phases interleave on the loop while compositing and encoding run on a render thread with its own sqlite
+connection. sqlite calls left on the loop are short local queries.
+tasks aren't profiled here (see profiling.py), cProfile can't tell interleaved tasks apart.
+'''
+
+import asyncio
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from databases import connect, get_schemas
+from db_cache import dbCache, DEFAULT_MAX_SIZE
+from tmdb_cache import tmdbCache
+from watch_history import watchHistory
+from negative_cache import negativeCache
+from fetch_data import MovieCellBuilder, get_poster_timeout
+from metrics import TaskMetrics
+from scheduler import TaskScheduler, CostEstimate
+from deadline import TaskDeadline, load_deadlines
+from worker import get_new_tasks, update_task_status, push_result, get_date_range, get_members, render, store_results
+
+MAX_CONCURRENT_TASKS = int(os.environ.get('MAX_CONCURRENT_TASKS', 4))
+MAX_FILMS_PER_MOSAIC = 30
+RENDER_THREADS = 1 # TILE_CACHE isn't locked, keep rendering on one thread
+POLL_INTERVAL = 1 # seconds between checks for new tasks
+CONNECTIONS_PER_HOST = 8
+KEEPALIVE_TIMEOUT = 60 # seconds an idle connection is kept open for the next task
+API_TIMEOUT = aiohttp.ClientTimeout(total=20, connect=5)
+
+_render_local = threading.local()
+
+def get_render_db() -> sqlite3.Connection:
+    # sqlite connections can't be shared across threads so the render thread opens its own
+    if not hasattr(_render_local, 'db'):
+        _render_local.db = connect(timeout=30)
+    return _render_local.db
+
+def render_in_thread(task: tuple, movie_cells: list, movie_cell_builder: MovieCellBuilder, metrics: TaskMetrics,
+                     deadline: TaskDeadline) -> tuple[dict, dict]:
+    return render(get_render_db(), task, movie_cells, movie_cell_builder, metrics, deadline=deadline)
+
+def make_session(timeout: aiohttp.ClientTimeout) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(limit_per_host=CONNECTIONS_PER_HOST, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+class WorkerSessions:
+    '''
+    keep-alive sessions shared by every task the process runs
+    '''
+    letterboxd: aiohttp.ClientSession
+    tmdb_api: aiohttp.ClientSession
+    tmdb_images: aiohttp.ClientSession
+
+    def __init__(self) -> None:
+        self.letterboxd = make_session(API_TIMEOUT)
+        self.tmdb_api = make_session(API_TIMEOUT)
+        self.tmdb_images = make_session(get_poster_timeout())
+
+    async def close(self) -> None:
+        await asyncio.gather(self.letterboxd.close(), self.tmdb_api.close(), self.tmdb_images.close())
+
+async def run_task(db: sqlite3.Connection, db_cache: dbCache, tmdb_cache: tmdbCache, sessions: WorkerSessions,
+                   executor: ThreadPoolExecutor, task: tuple, metrics: TaskMetrics) -> str:
+    '''
+    async worker.run_task(), returns the final status of the task
+    '''
+    update_task_status(db, task[0], 'COLLECTING DATA', "I'M COLLECTING DATA")
+    deadline = TaskDeadline(load_deadlines('config.json'), metrics)
+
+    movie_cell_builder = await MovieCellBuilder.load_async(
+        username=task[1],
+        mode=int(task[2]),
+        db_cache=db_cache,
+        letterboxd_session=sessions.letterboxd,
+        tmdb_session=sessions.tmdb_api,
+        metrics=metrics,
+        tmdb_cache=tmdb_cache,
+        date_range=get_date_range(task),
+        deadline=deadline,
+        watch_history=watchHistory(db),
+        negative_cache=negativeCache(db),
+        members=get_members(task)
+    )
+
+    status, err = movie_cell_builder.get_status()
+
+    # username is no good
+    if not status:
+        update_task_status(db, task[0], 'ERROR', "I BROKE IT :(", err)
+        push_result(db, task[0], None)
+        return 'ERROR'
+
+    # other tasks' downloads can't evict this one's posters before the render thread reads them
+    with db_cache.pinned(movie_cell_builder.get_movie_poster_paths()):
+        movie_cells = await movie_cell_builder.build_cells_async(sessions.tmdb_images)
+
+        # the loop keeps serving other tasks' downloads while this one renders
+        update_task_status(db, task[0], 'BUILDING MOSAIC', "I'M BUILDING UR MOSAIC")
+        encoded, preview = await asyncio.get_running_loop().run_in_executor(
+            executor, render_in_thread, task, movie_cells, movie_cell_builder, metrics, deadline)
+    store_results(db, task[0], encoded, preview, metrics)
+
+    update_task_status(db, task[0], 'COMPLETE', 'ALL DONE!')
+    return 'COMPLETE'
+
+async def run_task_safely(db: sqlite3.Connection, db_cache: dbCache, tmdb_cache: tmdbCache, sessions: WorkerSessions,
+                          executor: ThreadPoolExecutor, task: tuple, estimate: CostEstimate) -> None:
+    # one task failing mustn't take the other running tasks down with it
+    metrics = TaskMetrics(task[0])
+    estimate.count(metrics)
+    status = 'ERROR'
+    try:
+        status = await run_task(db, db_cache, tmdb_cache, sessions, executor, task, metrics)
+    except Exception as e:
+        print(f'TASK {task[0]} FAILED: {type(e).__name__}: {e}')
+        update_task_status(db, task[0], 'ERROR', "I BROKE IT :(", 'something went wrong building your mosaic, try again soon')
+        push_result(db, task[0], None)
+    metrics.push(db, status)
+
+async def main(db: sqlite3.Connection) -> None:
+    # the render thread reads posters while the loop writes, WAL lets them overlap
+    for schema in get_schemas(db):
+        db.execute(f'PRAGMA {schema}.journal_mode=WAL').fetchall()
+    # room for every running task's posters so they don't evict each other's before rendering
+    db_cache = dbCache(max(DEFAULT_MAX_SIZE, MAX_CONCURRENT_TASKS * MAX_FILMS_PER_MOSAIC * 2), db)
+    tmdb_cache = tmdbCache(db)
+    sessions = WorkerSessions()
+    executor = ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix='render')
+    waiting = TaskScheduler(db)
+    running = set()
+
+    try:
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+
+            # set status of all new tasks to queued
+            for task in get_new_tasks(db):
+                waiting.push(task, get_members(task) or [task[1]], get_date_range(task))
+                update_task_status(db, task[0], 'QUEUED', "I'M WAITING :/")
+
+            # start the cheapest expected tasks while there are free slots, see scheduler.py
+            while waiting and len(running) < MAX_CONCURRENT_TASKS:
+                job = asyncio.create_task(run_task_safely(db, db_cache, tmdb_cache, sessions, executor, *waiting.pop()))
+                running.add(job)
+                job.add_done_callback(running.discard)
+    finally:
+        await sessions.close()
+        executor.shutdown()
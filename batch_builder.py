@@ -0,0 +1,175 @@
+'''
+offline mosaic generation for a roster of usernames (e.g. a community's month-end mosaics).
+runs MovieCellBuilder + image_builder.build across a process pool without going through TASKS.
+every process opens its own connection to the shared DATABASE so posters (DB_CACHE) and
+tmdb metadata (TMDB_CACHE) downloaded for one user are reused by all the others.
+
+roster file: one `username [mode]` per line, mode 0 (this month, default), 1 (last 30) or 2 (this year), # for comments
+big mosaics (see large_mosaic.py) are rendered in stripes straight into the output file
+outputs are written as {output_dir}/{username}_{mode}_{YYYY-MM}.png, anything already written is skipped
+so an interrupted batch picks up where it left off when run again.
+
+USAGE: python server_utils.py batch [roster_file] [output_dir] [processes]
+'''
+
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from time import monotonic
+from db_cache import dbCache, DEFAULT_MAX_SIZE
+from tmdb_cache import tmdbCache
+from watch_history import watchHistory
+from negative_cache import negativeCache
+from metrics import TaskMetrics
+from schema import create_tables
+from databases import connect, get_schemas
+
+MODE_NAMES = {0: 'month', 1: 'last30', 2: 'year'}
+MAX_FILMS_PER_MOSAIC = 30
+
+# set per pool process by init_process()
+_db: sqlite3.Connection = None
+_db_cache: dbCache = None
+_tmdb_cache: tmdbCache = None
+_watch_history: watchHistory = None
+_negative_cache: negativeCache = None
+
+def read_roster(roster_path: str) -> list[tuple[str, int]]:
+    jobs = []
+    with open(roster_path, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            parts = line.replace(',', ' ').split()
+            mode = int(parts[1]) if len(parts) > 1 else 0
+            if mode not in MODE_NAMES:
+                raise ValueError(f'invalid mode `{parts[1]}` for {parts[0]} in {roster_path}')
+            jobs.append((parts[0], mode))
+    # keep roster order but drop repeated entries
+    return list(dict.fromkeys(jobs))
+
+def get_output_path(output_dir: str, username: str, mode: int) -> str:
+    return os.path.join(output_dir, f'{username}_{MODE_NAMES[mode]}_{datetime.now().strftime("%Y-%m")}.png')
+
+def init_process(cache_size: int) -> None:
+    global _db, _db_cache, _tmdb_cache, _watch_history, _negative_cache
+    # long timeout since every process writes posters into the same file
+    _db = connect(timeout=60)
+    _db_cache = dbCache(cache_size, _db)
+    _tmdb_cache = tmdbCache(_db)
+    _watch_history = watchHistory(_db)
+    _negative_cache = negativeCache(_db)
+
+def build_one(username: str, mode: int, output_path: str) -> tuple[str, int, str, float, dict]:
+    '''
+    builds and saves a single mosaic inside a pool process
+    returns (username, mode, error message or None, seconds, counts)
+    '''
+    # imported here so importing this module (e.g. from server_utils.py) doesn't load PIL/bs4/aiohttp
+    from fetch_data import MovieCellBuilder
+    from image_builder import build
+    from encoder import encode, drop_unused_alpha, load_output_formats
+    from large_mosaic import build_striped, load_large_mosaic_config, use_striped
+
+    metrics = TaskMetrics(f'batch:{username}:{mode}')
+    movie_cell_builder = MovieCellBuilder(username=username, mode=mode, db_cache=_db_cache, metrics=metrics, tmdb_cache=_tmdb_cache, watch_history=_watch_history, negative_cache=_negative_cache)
+    status, err = movie_cell_builder.get_status()
+    if not status:
+        return (username, mode, err, metrics.total_seconds(), metrics.counts)
+
+    # a year in review can need more posters than the cache holds, none are evicted until the mosaic is rendered
+    with _db_cache.pinned(movie_cell_builder.get_movie_poster_paths()):
+        movie_cells = movie_cell_builder.build_cells()
+        # dbCache.push doesn't commit, release the write lock before the slow part
+        _db.commit()
+
+        # write to a temporary file first so a killed batch never leaves a half written png behind
+        tmp_path = f'{output_path}.tmp'
+        if use_striped(len(movie_cells), load_large_mosaic_config('config.json')):
+            with metrics.stage('striped_render'), open(tmp_path, 'wb') as f:
+                build_striped(
+                    movie_cells=movie_cells,
+                    username=username,
+                    config_path='config.json',
+                    last_watch_date=movie_cell_builder.get_last_movie_date(),
+                    db=_db,
+                    out=f,
+                    metrics=metrics,
+                    in_memory=False
+                    )
+            os.replace(tmp_path, output_path)
+            metrics.count('result_bytes', os.path.getsize(output_path))
+            return (username, mode, None, metrics.total_seconds(), metrics.counts)
+
+        with metrics.stage('compositing'):
+            image = build(
+                movie_cells=movie_cells,
+                username=username,
+                config_path='config.json',
+                last_watch_date=movie_cell_builder.get_last_movie_date(),
+                db=_db,
+                metrics=metrics
+                )
+
+        with metrics.stage('encode'):
+            image_data = encode(drop_unused_alpha(image), 'png', load_output_formats('config.json')['png'])
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
+            os.replace(tmp_path, output_path)
+        metrics.count('result_bytes', os.path.getsize(output_path))
+
+        return (username, mode, None, metrics.total_seconds(), metrics.counts)
+
+def run_batch(roster_path: str, output_dir: str, processes: int = None) -> None:
+    processes = processes or os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+
+    # make sure the shared tables exist and let readers and the writer overlap across processes
+    db = connect()
+    create_tables(db, ['DB_CACHE', 'CACHE_STATS', 'TMDB_CACHE', 'WATCH_HISTORY', 'NEGATIVE_CACHE'])
+    for schema in get_schemas(db):
+        db.execute(f'PRAGMA {schema}.journal_mode=WAL').fetchall()
+    db.close()
+
+    jobs = read_roster(roster_path)
+    pending = [(username, mode, get_output_path(output_dir, username, mode)) for username, mode in jobs]
+    pending = [job for job in pending if not os.path.isfile(job[2])]
+    skipped = len(jobs) - len(pending)
+    print(f'{len(jobs)} mosaics in roster, {skipped} already built, building {len(pending)} with {processes} processes')
+
+    # concurrent builders need room in the cache so they don't evict each other's posters mid-build
+    cache_size = max(DEFAULT_MAX_SIZE, processes * MAX_FILMS_PER_MOSAIC * 2)
+
+    start = monotonic()
+    built, failed = 0, []
+    totals = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_process, initargs=(cache_size,)) as pool:
+        futures = {pool.submit(build_one, *job): job for job in pending}
+        for future in as_completed(futures):
+            username, mode, _ = futures[future]
+            try:
+                username, mode, err, seconds, counts = future.result()
+            except Exception as e:
+                err, seconds, counts = f'{type(e).__name__}: {e}', 0.0, {}
+
+            for name, n in counts.items():
+                totals[name] = totals.get(name, 0) + n
+
+            if err:
+                failed.append((username, mode, err))
+                print(f'FAILED {username} ({MODE_NAMES[mode]}): {err}')
+            else:
+                built += 1
+                print(f'BUILT  {username} ({MODE_NAMES[mode]}) in {seconds:.1f}s [{built + len(failed)}/{len(pending)}]')
+
+    elapsed = monotonic() - start
+    print('==== BATCH SUMMARY ====')
+    print(f'built: {built}  failed: {len(failed)}  skipped (already built): {skipped}')
+    print(f'elapsed: {elapsed:.1f}s  throughput: {built / elapsed * 60 if elapsed else 0:.1f} mosaics/min')
+    print(f'films: {totals.get("films", 0)}  posters downloaded: {totals.get("posters_downloaded", 0)}  '
+          f'posters cached: {totals.get("posters_cached", 0)}  poster MB: {totals.get("poster_bytes", 0) / 1e6:.1f}  '
+          f'output MB: {totals.get("result_bytes", 0) / 1e6:.1f}')
+    if failed:
+        print('re-run the same command to retry failed users')
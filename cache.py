@@ -1,5 +1,5 @@
 import unittest
-from collections import deque
+from collections import deque, OrderedDict
 
 '''
 cache implementation
@@ -63,6 +63,105 @@ class LRUImageCache:
         return str(list(self.fp_deque))
 
 
+class TileCache:
+    '''
+    LRU cache of rendered tiles bounded by memory instead of entry count.
+    values are (image, extra) pairs, the memory charged for an entry is width * height * bands of its image
+    '''
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        #                   == OrderedDict ==
+        # least recently used < --- > most recently used
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def tile_bytes(value: tuple) -> int:
+        image = value[0]
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+    def get(self, key: tuple) -> tuple:
+        value = self.tiles.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tiles.move_to_end(key)
+        return value
+
+    def put(self, key: tuple, value: tuple) -> None:
+        size = self.tile_bytes(value)
+        if size > self.max_bytes:
+            # would evict everything else and still not fit
+            return
+        if key in self.tiles:
+            self.used_bytes -= self.tile_bytes(self.tiles.pop(key))
+        while self.tiles and self.used_bytes + size > self.max_bytes:
+            _, evicted = self.tiles.popitem(last=False)
+            self.used_bytes -= self.tile_bytes(evicted)
+            self.evictions += 1
+        self.tiles[key] = value
+        self.used_bytes += size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.tiles),
+            'bytes': self.used_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class FakeTile:
+    # stands in for a PIL image so these tests don't need PIL
+    def __init__(self, width: int, height: int) -> None:
+        self.size = (width, height)
+
+    def getbands(self) -> tuple:
+        return ('R', 'G', 'B', 'A')
+
+
+class TestTileCache(unittest.TestCase):
+    def test_miss_then_hit(self):
+        cache = TileCache(1000)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', (FakeTile(5, 5), 1))
+        self.assertEqual(cache.get('a')[1], 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = TileCache(300)
+        cache.put('a', (FakeTile(5, 5), 0)) # 100 bytes
+        cache.put('b', (FakeTile(5, 5), 0))
+        cache.put('c', (FakeTile(5, 5), 0))
+        cache.get('a')
+        cache.put('d', (FakeTile(5, 5), 0))
+        self.assertNotIn('b', cache.tiles)
+        self.assertEqual(list(cache.tiles), ['c', 'a', 'd'])
+        self.assertEqual(cache.used_bytes, 300)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_replacing_key_keeps_byte_count(self):
+        cache = TileCache(1000)
+        cache.put('a', (FakeTile(5, 5), 0))
+        cache.put('a', (FakeTile(10, 5), 0))
+        self.assertEqual(cache.used_bytes, 200)
+        self.assertEqual(len(cache.tiles), 1)
+
+    def test_oversized_tile_not_cached(self):
+        cache = TileCache(50)
+        cache.put('a', (FakeTile(5, 5), 0))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
 class TestLRUImageCache(unittest.TestCase):
     def test_init(self):
         cache = LRUImageCache(5)
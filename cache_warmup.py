@@ -0,0 +1,204 @@
+'''
+fills DB_CACHE ahead of time so the first users after a deploy or cache wipe don't pay for cold poster downloads.
+posters go through the same fetch_data.resize_poster pipeline as the worker and are inserted with
+dbCache.push_many in large transactions. nothing beyond the cache's max_size is fetched.
+
+sources (USAGE: python server_utils.py cache [warmup/import] ...)
+warmup ids [file] - one `tmdb_id [mv|tv]` per line. titles are looked up on tmdb to build the cache key,
+                    a few films are titled differently on letterboxd and will still miss
+warmup rss [feed files...] - saved letterboxd rss feeds, every diary entry in them
+warmup db [database file] - most recently used posters from another database's DB_CACHE (no downloads needed)
+import [directory] - local poster images named after the film title (e.g. `The Fifth Element.jpg`)
+'''
+
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from time import monotonic
+import aiohttp
+from db_cache import dbCache
+from tmdb_cache import tmdbCache
+from schema import get_columns
+from rate_limiter import get_limiter
+from fetch_data import Transformer, resize_poster, title_to_image_path, load_thumbnail_size
+from tmdb_fetch import get_director, get_tmdb_poster_url, get_title, get_poster_size, set_poster_size
+
+RESOLVE_THREADS = 8
+FETCH_CONCURRENCY = 16
+FETCH_TIMEOUT = 30
+INSERT_BATCH_SIZE = 200
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def read_ids(path: str) -> list[tuple[int, str]]:
+    ids = []
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split('#')[0].replace(',', ' ').split()
+            if parts:
+                ids.append((int(parts[0]), parts[1] if len(parts) > 1 else 'mv'))
+    return list(dict.fromkeys(ids))
+
+def read_rss_files(paths: list) -> list[tuple[str, int, str]]:
+    '''
+    returns (title, tmdb_id, tmdb_type) for every diary entry in the feeds
+    '''
+    entries = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            # mode -1 keeps every dated entry instead of filtering to this month / last 30
+            transformer = Transformer(username='', mode=-1, date=datetime.now(), feed_content=f.read())
+        transformer.load_movies()
+        entries.extend(
+            (title, tmdb_id, tmdb_type)
+            for title, (tmdb_id, tmdb_type) in zip(transformer.get_movie_titles(), transformer.get_tmdb_ids())
+        )
+    return list(dict.fromkeys(entries))
+
+def get_uncached(db: sqlite3.Connection, filenames: list) -> set:
+    cur = db.execute('SELECT FILENAME FROM DB_CACHE')
+    cached = {row[0] for row in cur.fetchall()}
+    cur.close()
+    return {filename for filename in filenames if filename not in cached}
+
+def resolve_posters(db: sqlite3.Connection, entries: list[tuple[str, int, str]], budget: int) -> list[tuple[str, str]]:
+    '''
+    turns (title or None, tmdb_id, tmdb_type) entries into (filename, poster_url) for posters that aren't cached yet.
+    tmdb calls run in a thread pool, TMDB_CACHE is checked and filled from this thread only
+    '''
+    tmdb_cache = tmdbCache(db)
+
+    def resolve(entry: tuple) -> tuple[str, int, str, str, str]:
+        title, tmdb_id, tmdb_type = entry
+        try:
+            if title is None:
+                title = get_title(tmdb_id, tmdb_type)
+            cached = tmdb_cache_hits.get((tmdb_id, tmdb_type))
+            if cached:
+                return (title, tmdb_id, tmdb_type, cached[0], cached[1])
+            return (title, tmdb_id, tmdb_type, get_director(tmdb_id, tmdb_type), get_tmdb_poster_url(tmdb_id, tmdb_type))
+        except Exception as e:
+            print(f'could not resolve {tmdb_type} {tmdb_id}: {e}')
+            return None
+
+    # titles known up front can be checked against DB_CACHE before any api call
+    uncached = get_uncached(db, [title_to_image_path(title) for title, _, _ in entries if title])
+    entries = [entry for entry in entries if entry[0] is None or title_to_image_path(entry[0]) in uncached][:budget]
+    tmdb_cache_hits = {(tmdb_id, tmdb_type): tmdb_cache.lookup(tmdb_id, tmdb_type) for _, tmdb_id, tmdb_type in entries}
+
+    with ThreadPoolExecutor(max_workers=RESOLVE_THREADS) as pool:
+        resolved = [row for row in pool.map(resolve, entries) if row]
+
+    name_urls = []
+    poster_size = get_poster_size(load_thumbnail_size())
+    for title, tmdb_id, tmdb_type, director, poster_url in resolved:
+        if not tmdb_cache_hits.get((tmdb_id, tmdb_type)):
+            tmdb_cache.push(tmdb_id, tmdb_type, director, poster_url)
+        if title and poster_url:
+            name_urls.append((title_to_image_path(title), set_poster_size(poster_url, poster_size)))
+
+    uncached = get_uncached(db, [filename for filename, _ in name_urls])
+    return list(dict((filename, url) for filename, url in name_urls if filename in uncached).items())
+
+async def fetch_posters(name_urls: list[tuple[str, str]]) -> list[tuple[str, bytes]]:
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    async def fetch(session: aiohttp.ClientSession, filename: str, url: str) -> tuple[str, bytes]:
+        async with semaphore:
+            # shares the workers' tmdb_images budget so a warmup doesn't get live tasks throttled
+            await get_limiter('tmdb_images').acquire_async()
+            try:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    return (filename, await response.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f'could not download {url}: {e}')
+                return None
+
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        rows = await asyncio.gather(*[fetch(session, filename, url) for filename, url in name_urls])
+    return [row for row in rows if row]
+
+def resize_row(row: tuple[str, bytes]) -> tuple[str, bytes, str]:
+    filename, image_data = row
+    try:
+        return (filename, *resize_poster(image_data))
+    except Exception as e:
+        print(f'could not resize {filename}: {e}')
+        return None
+
+def resize_file(path: str) -> tuple[str, bytes, str]:
+    title = os.path.splitext(os.path.basename(path))[0]
+    with open(path, 'rb') as f:
+        return resize_row((title_to_image_path(title), f.read()))
+
+def resize_all(function, items: list) -> list[tuple[str, bytes, str]]:
+    if not items:
+        return []
+    with ProcessPoolExecutor() as pool:
+        return [row for row in pool.map(function, items, chunksize=16) if row]
+
+def store(db_cache: dbCache, rows: list[tuple[str, bytes, str]]) -> int:
+    inserted = 0
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        inserted += db_cache.push_many(rows[i:i + INSERT_BATCH_SIZE])
+    return inserted
+
+def print_summary(source: str, considered: int, inserted: int, start: float, db_cache: dbCache) -> None:
+    print(f'{source}: {considered} posters considered, {inserted} inserted in {monotonic() - start:.1f}s. '
+          f'DB_CACHE now holds {db_cache.get_count()} rows')
+
+def warm_from_entries(db: sqlite3.Connection, db_cache: dbCache, entries: list, source: str) -> int:
+    start = monotonic()
+    budget = db_cache.get_max_size()
+    name_urls = resolve_posters(db, entries, budget)
+    print(f'{source}: resolved {len(name_urls)} uncached posters in {monotonic() - start:.1f}s, downloading')
+    rows = asyncio.run(fetch_posters(name_urls))
+    inserted = store(db_cache, resize_all(resize_row, rows))
+    print_summary(source, len(entries), inserted, start, db_cache)
+    return inserted
+
+def warm_from_ids(db: sqlite3.Connection, db_cache: dbCache, path: str) -> int:
+    entries = [(None, tmdb_id, tmdb_type) for tmdb_id, tmdb_type in read_ids(path)]
+    return warm_from_entries(db, db_cache, entries, 'ids')
+
+def warm_from_rss(db: sqlite3.Connection, db_cache: dbCache, paths: list) -> int:
+    return warm_from_entries(db, db_cache, read_rss_files(paths), 'rss')
+
+def warm_from_db(db: sqlite3.Connection, db_cache: dbCache, path: str) -> int:
+    '''
+    copies the most recently used posters from another database file.
+    keys are rebuilt with this deployment's IMAGES_DIR in case it changed, blobs keep the codec they were stored with
+    '''
+    start = monotonic()
+    source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    # older database files don't have CODEC yet
+    codec = 'CODEC' if 'CODEC' in [column.upper() for column in get_columns(source, 'DB_CACHE')] else 'NULL'
+    cur = source.execute(
+        f"""
+        SELECT FILENAME, IMAGEBLOB, {codec} FROM DB_CACHE
+        ORDER BY LAST_USED_DATE DESC
+        LIMIT ?
+        """, (db_cache.get_max_size(),))
+    images_dir = os.environ['IMAGES_DIR']
+    rows = [(images_dir + '/' + os.path.basename(filename), blob, codec) for filename, blob, codec in cur.fetchall()]
+    cur.close()
+    source.close()
+    inserted = store(db_cache, rows)
+    print_summary('db', len(rows), inserted, start, db_cache)
+    return inserted
+
+def import_directory(db: sqlite3.Connection, db_cache: dbCache, directory: str) -> int:
+    start = monotonic()
+    paths = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    titles = {title_to_image_path(os.path.splitext(os.path.basename(path))[0]): path for path in paths}
+    uncached = get_uncached(db, list(titles))
+    paths = [path for filename, path in titles.items() if filename in uncached][:db_cache.get_max_size()]
+    inserted = store(db_cache, resize_all(resize_file, paths))
+    print_summary('import', len(titles), inserted, start, db_cache)
+    return inserted
@@ -10,87 +10,213 @@ from time import sleep
 from dotenv import load_dotenv
 if os.path.isfile('.env'):
     load_dotenv('.env')
+from schema import create_tables
+from databases import connect, get_schemas
+from negative_cache import negativeCache
+from result_store import get_result_store
 
 EXPIRY_TIME = 3600
+METRICS_RETENTION = 7 * 24 * 3600 # TASK_METRICS rows feed /metrics so they outlive their task
+RESULTS_MAX_BYTES = int(os.environ.get('RESULTS_MAX_BYTES', 512 * 1024 * 1024)) # oldest results go first past this
+DELETE_BATCH_SIZE = 200 # tasks removed per transaction so the worker and server are never locked out for long
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+UNFINISHED_STATUSES = ('READY', 'QUEUED', 'COLLECTING DATA', 'BUILDING MOSAIC')
 
-def get_results(db: sqlite3.Connection):
+# bytes a RESULTS row holds, rows written before SIZE existed hold a base64 string
+# (length() of a blob is read from the record header, the blob itself isn't loaded)
+RESULT_BYTES = 'COALESCE(SIZE, LENGTH(RESULT), 0)'
+
+def get_expired_tasks(db: sqlite3.Connection, limit: int = DELETE_BATCH_SIZE) -> list:
     '''
-    Fetches all rows from RESULTS table.
-    (TASK_ID, RESULT(IMAGE_STRING), CREATED_ON)
+    Returns up to `limit` task_id's that are expired, compared in sql on the indexed CREATED_ON column.
+    a task has one row per output format, any of its rows being past expiry expires the task
     '''
+    cutoff = (datetime.now() - timedelta(seconds=EXPIRY_TIME)).strftime(DATE_FORMAT)
     cur = db.execute(
         """
-        SELECT * FROM RESULTS
-        """
-        )
-    rows = cur.fetchall()
+        SELECT DISTINCT ID FROM RESULTS
+        WHERE CREATED_ON < ?
+        LIMIT ?
+        """, (cutoff, limit))
+    expired_task_ids = [row[0] for row in cur.fetchall()]
     cur.close()
-    return rows
+    return expired_task_ids
 
-def get_expired_tasks(db: sqlite3.Connection) -> list:
+def fail_stale_tasks(db: sqlite3.Connection) -> int:
     '''
-    Returns list of all task_id's that are expired
+    Sets tasks that haven't finished EXPIRY_TIME after being created to ERROR, the worker that had them died.
+    each gets an empty result so it expires like any other task
+    returns how many tasks were failed
     '''
-    results = get_results(db)
-    expired_task_ids = []
-    if not results:
-        return []
-    now = datetime.now()
-    for row in results:
-        try:
-            task_id, _, created_on = row
-            created_date = datetime.strptime(created_on, '%Y-%m-%d %H:%M:%S')
-            if now - created_date > timedelta(seconds=EXPIRY_TIME):
-            # if True:
-                expired_task_ids.append(task_id)
-        except:
-            continue
-    return expired_task_ids
+    cutoff = (datetime.now() - timedelta(seconds=EXPIRY_TIME)).strftime(DATE_FORMAT)
+    cur = db.execute(
+        f"""
+        SELECT ID FROM TASKS
+        WHERE STATUS IN ({','.join('?' for _ in UNFINISHED_STATUSES)}) AND CREATED_ON < ?
+        """, (*UNFINISHED_STATUSES, cutoff))
+    task_ids = [row[0] for row in cur.fetchall()]
+    cur.close()
+
+    store = get_result_store(db)
+    for task_id in task_ids:
+        db.execute(
+            "UPDATE TASKS SET STATUS = 'ERROR', PROGRESS_MSG = ?, ERROR_MSG = ? WHERE ID = ?",
+            ("I BROKE IT :(", 'something went wrong building your mosaic, try again soon', task_id))
+        # commits the update too
+        store.put(task_id, None)
+    return len(task_ids)
+
+def get_results_bytes(db: sqlite3.Connection) -> int:
+    cur = db.execute(f'SELECT COALESCE(SUM({RESULT_BYTES}), 0) FROM RESULTS')
+    total = cur.fetchone()[0]
+    cur.close()
+    return total
 
-def remove_expired_tasks(db: sqlite3.Connection) -> int:
+def get_over_budget_tasks(db: sqlite3.Connection, max_bytes: int) -> list:
     '''
-    Removes all expired tasks from RESULTS and TASKS table
-    returns how many expired id's were found (and hopefully removed)
+    Returns the oldest task_id's that have to go for RESULTS to fit in max_bytes
     '''
+    total = get_results_bytes(db)
+    if total <= max_bytes:
+        return []
 
-    expired_ids = get_expired_tasks(db)
-    if not expired_ids:
-        return 0
+    cur = db.execute(
+        f"""
+        SELECT ID, SUM({RESULT_BYTES}) FROM RESULTS
+        GROUP BY ID
+        ORDER BY MIN(CREATED_ON)
+        """)
+    task_ids = []
+    for task_id, size in cur:
+        if total <= max_bytes:
+            break
+        task_ids.append(task_id)
+        total -= size
+    cur.close()
+    return task_ids
+
+def remove_tasks(db: sqlite3.Connection, task_ids: list) -> tuple[int, int]:
+    '''
+    Removes tasks from TASKS and their results, returns (RESULTS rows removed, result bytes removed)
+    '''
+    placeholders = ','.join('?' for _ in task_ids)
+    cur = db.execute(f'SELECT COUNT(*), COALESCE(SUM({RESULT_BYTES}), 0) FROM RESULTS WHERE ID IN ({placeholders})', task_ids)
+    rows, size = cur.fetchone()
+    cur.close()
 
-    placeholders = ','.join('?' for _ in expired_ids)
     db.execute(f"""
         DELETE FROM TASKS
         WHERE ID IN ({placeholders})
-    """, expired_ids)
+    """, task_ids)
 
-    db.execute(f"""
-        DELETE FROM RESULTS
-        WHERE ID IN ({placeholders})
-    """, expired_ids)
+    # removes files too when results are kept on disk, commits both deletes
+    get_result_store(db).delete(task_ids)
+
+    return (rows, size)
 
+def remove_expired_tasks(db: sqlite3.Connection) -> tuple[int, int, int]:
+    '''
+    Removes all expired tasks from RESULTS and TASKS table in batches of DELETE_BATCH_SIZE
+    returns (tasks removed, RESULTS rows removed, result bytes removed)
+    '''
+    tasks, rows, size = 0, 0, 0
+    while expired_ids := get_expired_tasks(db):
+        batch_rows, batch_size = remove_tasks(db, expired_ids)
+        tasks, rows, size = tasks + len(expired_ids), rows + batch_rows, size + batch_size
+    return (tasks, rows, size)
+
+def remove_over_budget_tasks(db: sqlite3.Connection, max_bytes: int = RESULTS_MAX_BYTES) -> tuple[int, int, int]:
+    '''
+    Removes the oldest results until RESULTS fits in max_bytes
+    returns (tasks removed, RESULTS rows removed, result bytes removed)
+    '''
+    task_ids = get_over_budget_tasks(db, max_bytes)
+    tasks, rows, size = 0, 0, 0
+    for i in range(0, len(task_ids), DELETE_BATCH_SIZE):
+        batch = task_ids[i:i + DELETE_BATCH_SIZE]
+        batch_rows, batch_size = remove_tasks(db, batch)
+        tasks, rows, size = tasks + len(batch), rows + batch_rows, size + batch_size
+    return (tasks, rows, size)
+
+def get_free_bytes(db: sqlite3.Connection, schema: str = 'main') -> int:
+    freelist_count = db.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]
+    page_size = db.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+    return freelist_count * page_size
+
+def enable_incremental_vacuum(db: sqlite3.Connection) -> None:
+    '''
+    auto_vacuum can only be switched on an existing file by a full VACUUM, which happens once per database file
+    '''
+    for schema in get_schemas(db):
+        if db.execute(f'PRAGMA {schema}.auto_vacuum').fetchone()[0] == 2:
+            continue
+        print(f'SWITCHING {schema.upper()} DATABASE TO INCREMENTAL AUTO_VACUUM (one time full VACUUM)')
+        db.execute(f'PRAGMA {schema}.auto_vacuum = INCREMENTAL')
+        db.execute(f'VACUUM {schema}')
+
+def reclaim_space(db: sqlite3.Connection) -> int:
+    '''
+    Gives pages freed by deletes back to the filesystem and truncates the WAL of every database file on db
+    returns how many bytes the database files shrank by
+    '''
+    reclaimed = 0
+    for schema in get_schemas(db):
+        free_bytes = get_free_bytes(db, schema)
+        if free_bytes:
+            # execute() only steps the pragma once (one page), executescript runs it to completion
+            db.executescript(f'PRAGMA {schema}.incremental_vacuum;')
+        if db.execute(f'PRAGMA {schema}.journal_mode').fetchone()[0] == 'wal':
+            db.execute(f'PRAGMA {schema}.wal_checkpoint(TRUNCATE)').fetchall()
+        reclaimed += free_bytes - get_free_bytes(db, schema)
+    return reclaimed
+
+def sweep(db: sqlite3.Connection) -> dict:
+    '''
+    one janitor pass: tasks a dead worker left unfinished, expired results, results over the byte budget, old metrics, then file space
+    '''
+    report = {}
+    report['stale_tasks'] = fail_stale_tasks(db)
+    report['expired_tasks'], report['expired_rows'], report['expired_bytes'] = remove_expired_tasks(db)
+    report['budget_tasks'], report['budget_rows'], report['budget_bytes'] = remove_over_budget_tasks(db)
+    report['metrics_rows'] = remove_old_metrics(db)
+    report['negative_rows'] = negativeCache(db).remove_expired()
+    report['results_bytes'] = get_results_bytes(db)
+    report['file_bytes_reclaimed'] = reclaim_space(db)
+    return report
+
+def remove_old_metrics(db: sqlite3.Connection) -> int:
+    '''
+    Removes TASK_METRICS rows older than METRICS_RETENTION
+    returns how many rows were removed
+    '''
+    cutoff = (datetime.now() - timedelta(seconds=METRICS_RETENTION)).strftime('%Y-%m-%d %H:%M:%S')
+    cur = db.execute("DELETE FROM TASK_METRICS WHERE FINISHED_ON < ?", (cutoff,))
+    removed = cur.rowcount
+    cur.close()
     db.commit()
+    return removed
 
-    return len(expired_ids)
+def print_report(report: dict) -> None:
+    print(f"FAILED {report['stale_tasks']} UNFINISHED TASKS OLDER THAN {EXPIRY_TIME} SECONDS")
+    print(f"EXPIRED: {report['expired_tasks']} TASKS, {report['expired_rows']} RESULT ROWS, {report['expired_bytes']} BYTES")
+    print(f"OVER BUDGET: {report['budget_tasks']} TASKS, {report['budget_rows']} RESULT ROWS, {report['budget_bytes']} BYTES")
+    print(f"RESULTS NOW {report['results_bytes']} OF {RESULTS_MAX_BYTES} BYTES")
+    print(f"REMOVED {report['metrics_rows']} TASK_METRICS ROWS")
+    print(f"REMOVED {report['negative_rows']} EXPIRED NEGATIVE_CACHE ROWS")
+    print(f"DATABASE FILES SHRANK BY {report['file_bytes_reclaimed']} BYTES")
 
 def main(db: sqlite3.Connection):
 
     while True:
-        sleep(1)
-        remove_expired_tasks(db)
+        sleep(60)
+        print_report(sweep(db))
 
 if __name__ == '__main__':
 
-    db = sqlite3.connect(os.environ['DATABASE'])
-    cur = db.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS TASKS(id, user, mode, progress_msg, status, error_msg)")
-    cur.execute("CREATE TABLE IF NOT EXISTS RESULTS(id, result, created_on)")
-    cur.close()
-    db.commit()
-    removed_entries = remove_expired_tasks(db)
-    db.commit()
-
-    if removed_entries:
-        print(f'REMOVED {removed_entries} ROWS')
+    db = connect()
+    create_tables(db, ['TASKS', 'RESULTS', 'TASK_METRICS', 'NEGATIVE_CACHE'])
+    enable_incremental_vacuum(db)
+    print_report(sweep(db))
     # main(db)
 
 # }, "minutecron": {
@@ -0,0 +1,103 @@
+'''
+which sqlite file each table lives in. there are three stores:
+queue - DATABASE: TASKS and the small tables read and written on every task
+results - RESULTS_DATABASE: finished mosaics (RESULTS)
+posters - POSTERS_DATABASE: the poster cache (DB_CACHE, CACHE_STATS)
+a store whose variable isn't set keeps its tables in DATABASE. every file has its own writer lock, so multi-MB
+result inserts, poster churn and janitor deletes don't hold up task updates, and each file can be vacuumed on its own.
+
+connect() opens DATABASE and ATTACHes the other stores' files under the store's name. sqlite looks unqualified
+table names up in every attached file, so queries (and joins across stores) work the same on one connection.
+"databases" in config.json sets pragmas per store. page_size and auto_vacuum only take effect while a file is empty.
+
+tables created in DATABASE before their store got its own file would shadow the ones in the new file (main is
+searched first), connect() refuses to open until they are moved with `python server_utils.py databases split`
+'''
+
+import json
+import os
+import sqlite3
+from functools import lru_cache
+
+STORES = {
+    'queue': ['TASKS', 'TASK_METRICS', 'METRIC_TOTALS', 'NEGATIVE_CACHE', 'RATE_LIMITS', 'TMDB_CACHE', 'WATCH_HISTORY'],
+    'results': ['RESULTS'],
+    'posters': ['DB_CACHE', 'CACHE_STATS'],
+}
+STORE_VARIABLES = {'queue': 'DATABASE', 'results': 'RESULTS_DATABASE', 'posters': 'POSTERS_DATABASE'}
+DEFAULT_DATABASES = {
+    # small rows rewritten constantly, small pages keep each status update to a page or two
+    'queue': {'page_size': 4096, 'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -4000},
+    # multi-MB blobs written once and streamed out, big pages mean short overflow chains, little worth caching
+    'results': {'page_size': 65536, 'auto_vacuum': 'incremental', 'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -2000},
+    # a webp poster fits in one page, posters are read over and over while rendering
+    'posters': {'page_size': 16384, 'auto_vacuum': 'incremental', 'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -16000},
+}
+# these only apply to an empty file and have to be set before anything else touches it
+FILE_PRAGMAS = ['page_size', 'auto_vacuum']
+
+@lru_cache(maxsize=None)
+def load_databases(path: str = 'config.json') -> dict:
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return {store: {**DEFAULT_DATABASES[store], **config.get('databases', {}).get(store, {})} for store in STORES}
+
+def get_store(table: str) -> str:
+    for store, tables in STORES.items():
+        if table.upper() in tables:
+            return store
+    raise ValueError(f'table `{table}` is not in any store')
+
+def get_path(store: str) -> str:
+    return os.environ.get(STORE_VARIABLES[store]) or os.environ['DATABASE']
+
+def is_separate(store: str) -> bool:
+    # true if the store has a file of its own rather than sharing DATABASE
+    return store != 'queue' and os.path.realpath(get_path(store)) != os.path.realpath(get_path('queue'))
+
+def get_schemas(db: sqlite3.Connection) -> dict:
+    '''
+    {schema name: store} for every store file open on db, 'main' is DATABASE
+    '''
+    cur = db.execute('PRAGMA database_list')
+    names = [row[1] for row in cur.fetchall()]
+    cur.close()
+    return {name: 'queue' if name == 'main' else name for name in names if name == 'main' or name in STORES}
+
+def get_schema(db: sqlite3.Connection, table: str) -> str:
+    '''
+    schema name to qualify table with on db, 'main' for a connection that doesn't have its store attached
+    '''
+    store = get_store(table)
+    return store if store in get_schemas(db) else 'main'
+
+def apply_pragmas(db: sqlite3.Connection, schema: str, pragmas: dict) -> None:
+    for name in sorted(pragmas, key=lambda name: name not in FILE_PRAGMAS):
+        db.execute(f'PRAGMA {schema}.{name} = {pragmas[name]}').fetchall()
+
+def get_shadowed_tables(db: sqlite3.Connection) -> list:
+    '''
+    tables still in DATABASE that belong to a store attached from another file
+    '''
+    cur = db.execute("SELECT NAME FROM main.sqlite_master WHERE TYPE = 'table'")
+    existing = {row[0].upper() for row in cur.fetchall()}
+    cur.close()
+    return [table for schema, store in get_schemas(db).items() if schema != 'main' for table in STORES[store] if table in existing]
+
+def connect(timeout: float = 5.0, check_shadowed: bool = True, **kwargs) -> sqlite3.Connection:
+    '''
+    sqlite3.connect() to DATABASE with every separate store attached and each file's pragmas applied
+    '''
+    config = load_databases()
+    db = sqlite3.connect(get_path('queue'), timeout, **kwargs)
+    apply_pragmas(db, 'main', config['queue'])
+    for store in STORES:
+        if is_separate(store):
+            db.execute(f'ATTACH DATABASE ? AS {store}', (get_path(store),))
+            apply_pragmas(db, store, config[store])
+
+    shadowed = get_shadowed_tables(db) if check_shadowed else []
+    if shadowed:
+        db.close()
+        raise RuntimeError(f'{", ".join(shadowed)} still in DATABASE, run `python server_utils.py databases split` to move them')
+    return db
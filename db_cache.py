@@ -3,15 +3,97 @@ dcCache class:
 stores (_max_size) images as binary blobs in a lookup table.
 can be used to cache images
 main purpose is for movie posters that need downloading constantly
-called by worker.py->fetch_data.py. worker only has one 'thread' running at a time so there shouldn't be any threat of
-deleted data as it is needed in image_builder.py which is also handled by worker.py
+called by worker.py->fetch_data.py. a running task pins its posters (see dbCache.pinned) so they aren't evicted
+before image_builder.py / large_mosaic.py read them back, a year or custom range can need more posters than max_size.
+pins only hold against evictions made through the same dbCache
 
-rows in 'DB_CACHE' table are structured like this | FILENAME: str | IMAGEBLOB: BLOB| LAST_USED_DATE: str(datetime) |
+rows in 'DB_CACHE' table are structured like this
+| FILENAME: str | IMAGEBLOB: BLOB| LAST_USED_DATE: str(datetime) | CODEC: str | CREATED_ON: str(datetime) | HITS: int |
+CODEC says how IMAGEBLOB is encoded, see poster_codec.py. HITS is how many lookups found the row since it was inserted
+
+telemetry: lookups, hits, misses, inserts, evictions and bytes written are kept as running totals in 'CACHE_STATS'
+| NAME: str | VALUE: int |
+they are written in the same transaction as the cache operation they count. get_cache_report() adds entry ages,
+the most reused posters and how many distinct posters were used recently (the working set max_size has to hold),
+see `python server_utils.py cache stats` and /metrics
 '''
 
+import os
 import sqlite3
-from datetime import datetime
+import unittest
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from schema import create_tables
+
+DEFAULT_MAX_SIZE = int(os.environ.get('DB_CACHE_SIZE', 100))
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+STAT_NAMES = ['lookups', 'hits', 'misses', 'inserts', 'evictions', 'bytes_written']
+# (label, upper bound), anything older falls into 'older'
+AGE_BUCKETS = [('1h', timedelta(hours=1)), ('1d', timedelta(days=1)), ('7d', timedelta(days=7)), ('30d', timedelta(days=30))]
+
+def count_stats(db: sqlite3.Connection, **counts: int) -> None:
+    '''
+    adds to the CACHE_STATS totals, the caller commits
+    '''
+    db.executemany(
+        """
+        INSERT INTO CACHE_STATS(NAME, VALUE) VALUES (?, ?)
+        ON CONFLICT(NAME) DO UPDATE SET VALUE = VALUE + excluded.VALUE
+        """,
+        [(name, n) for name, n in counts.items() if n])
+
+def get_stats(db: sqlite3.Connection) -> dict:
+    cur = db.execute('SELECT NAME, VALUE FROM CACHE_STATS')
+    stats = {name: 0 for name in STAT_NAMES}
+    stats.update(dict(cur.fetchall()))
+    cur.close()
+    return stats
+
+def get_age_distribution(db: sqlite3.Connection, column: str) -> dict:
+    '''
+    {bucket: rows} of how long ago `column` (CREATED_ON or LAST_USED_DATE) was, rows without a date count as 'unknown'
+    '''
+    now = datetime.now()
+    cases = ' '.join(
+        f"WHEN {column} >= '{(now - age).strftime(DATE_FORMAT)}' THEN '{label}'" for label, age in AGE_BUCKETS)
+    cur = db.execute(f"""
+        SELECT CASE WHEN {column} IS NULL THEN 'unknown' {cases} ELSE 'older' END AS BUCKET, COUNT(*)
+        FROM DB_CACHE GROUP BY BUCKET
+        """)
+    counts = dict(cur.fetchall())
+    cur.close()
+    return {label: counts.get(label, 0) for label in [*[label for label, _ in AGE_BUCKETS], 'older', 'unknown']}
+
+def get_top_reused(db: sqlite3.Connection, n: int = 10) -> list[tuple[str, int, str]]:
+    '''
+    [(filename, hits, created_on)] for the n most reused posters
+    '''
+    cur = db.execute(
+        """
+        SELECT FILENAME, COALESCE(HITS, 0), CREATED_ON FROM DB_CACHE
+        ORDER BY COALESCE(HITS, 0) DESC
+        LIMIT ?
+        """, (n,))
+    rows = cur.fetchall()
+    cur.close()
+    return rows
 
+def get_cache_report(db: sqlite3.Connection, top_n: int = 10) -> dict:
+    cur = db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(IMAGEBLOB)), 0) FROM DB_CACHE')
+    entries, size = cur.fetchone()
+    cur.close()
+    stats = get_stats(db)
+    looked_up = stats['hits'] + stats['misses']
+    return {
+        'entries': entries,
+        'bytes': size,
+        'stats': stats,
+        'hit_ratio': stats['hits'] / looked_up if looked_up else None,
+        'age': get_age_distribution(db, 'CREATED_ON'),
+        'last_used': get_age_distribution(db, 'LAST_USED_DATE'),
+        'top_reused': get_top_reused(db, top_n),
+    }
 
 class dbCache:
     _max_size: int
@@ -19,62 +101,153 @@ class dbCache:
     def __init__(self, max_size, db:sqlite3.Connection) -> None:
         self._max_size = max_size
         self._db = db
+        # filename -> how many running tasks still need it
+        self._pinned = Counter()
 
     def lookup(self, filename: str) -> bool:
         '''
         looks up filename and returns true or false.
         if the filename is true then the driving code needs to call dbCache.push()
         '''
-        cur = self._db.execute('SELECT * FROM DB_CACHE where FILENAME = ?', (filename,))
+        cur = self._db.execute('SELECT 1 FROM DB_CACHE where FILENAME = ?', (filename,))
         data = cur.fetchone()
         cur.close()
 
         if not data:
+            count_stats(self._db, lookups=1, misses=1)
+            self._db.commit()
             return False
         
 
         self._db.execute(
         """UPDATE DB_CACHE
-        SET LAST_USED_DATE = ?
+        SET LAST_USED_DATE = ?, HITS = COALESCE(HITS, 0) + 1
         WHERE FILENAME = ?
         """,
         (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), filename)
         )
+        count_stats(self._db, lookups=1, hits=1)
 
         self._db.commit()
 
         return True
     
-    def push(self, filename: str, image_data: bytes) -> int:
+    def lookup_many(self, filenames: list[str]) -> set:
+        '''
+        batched lookup(), returns the set of filenames that are cached and marks them used in one transaction
+        '''
+        filenames = list(dict.fromkeys(filenames))
+        if not filenames:
+            return set()
 
-        table_count = self.get_count()
+        placeholders = ','.join('?' for _ in filenames)
+        cur = self._db.execute(f'SELECT FILENAME FROM DB_CACHE WHERE FILENAME IN ({placeholders})', filenames)
+        cached = {row[0] for row in cur.fetchall()}
+        cur.close()
 
-        # see if we need to remove any data to keep table in max_size
-        if table_count >= self._max_size:
-            cur = self._db.execute("""
-            SELECT FILENAME
-            FROM DB_CACHE
-            ORDER BY LAST_USED_DATE ASC
-            LIMIT 1
-            """)
+        if cached:
+            self._db.execute(
+            f"""UPDATE DB_CACHE
+            SET LAST_USED_DATE = ?, HITS = COALESCE(HITS, 0) + 1
+            WHERE FILENAME IN ({','.join('?' for _ in cached)})
+            """,
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), *cached)
+            )
+        count_stats(self._db, lookups=len(filenames), hits=len(cached), misses=len(filenames) - len(cached))
+        self._db.commit()
 
-            old_filename = cur.fetchone()[0]
+        return cached
 
-            self._db.execute("""
-            DELETE FROM DB_CACHE
-            WHERE FILENAME = ?
-            """,
-            (old_filename,))
+    def push(self, filename: str, image_data: bytes, codec: str = None) -> int:
+
+        table_count = self.get_count()
+        evictions = 0
 
+        # see if we need to remove any data to keep table in max_size
+        if table_count >= self.get_capacity():
+            evictions = self.evict(1)
+
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         self._db.execute("""
-        INSERT INTO DB_CACHE
-        VALUES (?, ?, ?)
+        INSERT INTO DB_CACHE(FILENAME, IMAGEBLOB, LAST_USED_DATE, CODEC, CREATED_ON, HITS)
+        VALUES (?, ?, ?, ?, ?, 0)
         """,
-        (filename, image_data, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        (filename, image_data, now, codec, now))
+        count_stats(self._db, inserts=1, evictions=evictions, bytes_written=len(image_data))
 
         return table_count # putting this here to be useful for debugging later
 
 
+    def push_many(self, rows: list[tuple[str, bytes, str]]) -> int:
+        '''
+        inserts (filename, image_data, codec) rows in a single transaction, evicting least recently used rows so the
+        table stays within max_size. filenames already cached are skipped and at most max_size rows are inserted.
+        returns how many rows were inserted
+        '''
+        rows = list({row[0]: row for row in rows}.values())
+        if not rows:
+            return 0
+
+        placeholders = ','.join('?' for _ in rows)
+        cur = self._db.execute(f'SELECT FILENAME FROM DB_CACHE WHERE FILENAME IN ({placeholders})', [row[0] for row in rows])
+        cached = {row[0] for row in cur.fetchall()}
+        cur.close()
+        rows = [row for row in rows if row[0] not in cached][:self.get_capacity()]
+
+        overflow = self.get_count() + len(rows) - self.get_capacity()
+        evictions = 0
+        if overflow > 0:
+            evictions = self.evict(overflow)
+
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self._db.executemany("""
+        INSERT INTO DB_CACHE(FILENAME, IMAGEBLOB, LAST_USED_DATE, CODEC, CREATED_ON, HITS)
+        VALUES (?, ?, ?, ?, ?, 0)
+        """,
+        [(filename, image_data, now, codec, now) for filename, image_data, codec in rows])
+        count_stats(self._db, inserts=len(rows), evictions=evictions,
+                    bytes_written=sum(len(image_data) for _, image_data, _ in rows))
+        self._db.commit()
+
+        return len(rows)
+
+    def evict(self, n: int) -> int:
+        '''
+        deletes the n least recently used rows that aren't pinned, returns how many were deleted
+        '''
+        pinned = list(self._pinned)
+        return self._db.execute(f"""
+        DELETE FROM DB_CACHE
+        WHERE FILENAME IN (
+            SELECT FILENAME
+            FROM DB_CACHE
+            WHERE FILENAME NOT IN ({','.join('?' for _ in pinned)})
+            ORDER BY LAST_USED_DATE ASC
+            LIMIT ?
+        )
+        """,
+        (*pinned, n)).rowcount
+
+    @contextmanager
+    def pinned(self, filenames: list[str]):
+        '''
+        keeps filenames in the cache until the block ends, the cache grows past max_size to hold every pinned poster
+        '''
+        filenames = {filename for filename in filenames if filename}
+        self._pinned.update(filenames)
+        try:
+            yield
+        finally:
+            self._pinned.subtract(filenames)
+            self._pinned = +self._pinned
+
+    def get_max_size(self) -> int:
+        return self._max_size
+
+    def get_capacity(self) -> int:
+        # max_size, or more while running tasks have more posters pinned
+        return max(self._max_size, len(self._pinned))
+
     def get_count(self) -> int:
 
         cur = self._db.execute('SELECT COUNT(*) FROM DB_CACHE')
@@ -82,4 +255,41 @@ class dbCache:
         cur.close()
         if not count:
             return -1
-        return count[0]
\ No newline at end of file
+        return count[0]
+
+
+class TestPinnedPosters(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        create_tables(self.db, ['DB_CACHE', 'CACHE_STATS'])
+        self.cache = dbCache(3, self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def cached(self) -> set:
+        return {row[0] for row in self.db.execute('SELECT FILENAME FROM DB_CACHE')}
+
+    def test_more_films_than_max_size(self):
+        self.cache.push_many([(f'old{i}', b'x', 'raw') for i in range(3)])
+        films = [f'film{i}' for i in range(8)]
+        with self.cache.pinned(films + [None]):
+            # posters arrive in batches like download_all writes them
+            self.cache.push_many([(film, b'x', 'raw') for film in films[:5]])
+            self.cache.push_many([(film, b'x', 'raw') for film in films[5:]])
+            self.assertEqual(self.cached(), set(films))
+        self.cache.push_many([('next', b'x', 'raw')])
+        self.assertEqual(len(self.cached()), 3)
+        self.assertIn('next', self.cached())
+
+    def test_pins_overlap(self):
+        with self.cache.pinned(['a', 'b']):
+            with self.cache.pinned(['b', 'c', 'd']):
+                self.assertEqual(self.cache.get_capacity(), 4)
+            self.assertEqual(self.cache.get_capacity(), 3)
+            self.cache.push_many([(name, b'x', 'raw') for name in 'abcde'])
+            self.assertTrue({'a', 'b'} <= self.cached())
+        self.assertEqual(self.cache.get_capacity(), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+'''
+per-task time budget so one slow letterboxd/tmdb response can't hold up the whole queue.
+"deadlines" in config.json gives seconds per stage (feed, metadata, posters, render). budgets are cumulative,
+time a stage doesn't use carries over to the stages after it.
+when metadata or posters run out of time the task renders with what it has (empty directors, NoPoster.png)
+and the fallback is counted in the task's metrics as fallback_{name} so budgets can be tuned from /metrics.
+'''
+
+import json
+from time import monotonic
+from metrics import TaskMetrics
+
+# stages in the order the worker runs them
+DEADLINE_STAGES = ['feed', 'metadata', 'posters', 'render']
+DEFAULT_DEADLINES = {'feed': 10, 'metadata': 20, 'posters': 25, 'render': 30}
+
+def load_deadlines(path: str) -> dict:
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return {**DEFAULT_DEADLINES, **config.get('deadlines', {})}
+
+
+class TaskDeadline:
+    '''
+    budgets of None means no deadline, until() and remaining() then return None
+    '''
+    _budgets: dict
+    _metrics: TaskMetrics
+
+    def __init__(self, budgets: dict, metrics: TaskMetrics = None) -> None:
+        self._budgets = budgets
+        self._metrics = metrics or TaskMetrics(None)
+        self._start = monotonic()
+
+    def until(self, stage: str) -> float:
+        '''
+        monotonic() time by which `stage` has to be done
+        '''
+        if self._budgets is None:
+            return None
+        total = 0
+        for name in DEADLINE_STAGES[:DEADLINE_STAGES.index(stage) + 1]:
+            total += self._budgets[name]
+        return self._start + total
+
+    def remaining(self, stage: str) -> float:
+        until = self.until(stage)
+        if until is None:
+            return None
+        return max(0.0, until - monotonic())
+
+    def fallback(self, name: str, n: int = 1) -> None:
+        if n:
+            self._metrics.count(f'fallback_{name}', n)
+
+
+def time_left(deadline: float) -> float:
+    '''
+    seconds until a monotonic() deadline, None when there is no deadline
+    '''
+    if deadline is None:
+        return None
+    return max(0.0, deadline - monotonic())
+
+def past(deadline: float) -> bool:
+    return deadline is not None and monotonic() >= deadline
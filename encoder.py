@@ -0,0 +1,150 @@
+'''
+encodes finished mosaics into every format listed under "output_formats" in config.json.
+png is always produced because /download serves it, formats the local Pillow can't write (e.g. avif without
+a plugin) are skipped. server.py picks which stored format to send from the client's Accept header (see formats.py).
+"preview" in config.json describes the downscaled copy the result page shows first, it is made from the same
+canvas so the mosaic is only ever composited once.
+'''
+
+import json
+import struct
+import zlib
+from io import BytesIO
+from typing import BinaryIO
+from PIL import Image, ImageChops
+from metrics import TaskMetrics
+from deadline import past
+from formats import FORMATS
+
+DEFAULT_OUTPUT_FORMATS = {'png': {}}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_FILTER_SUB = b'\x01'
+DEFAULT_PREVIEW = {'max_width': 800, 'formats': {'jpeg': {'quality': 80}}}
+
+def load_config(path: str) -> dict:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def load_output_formats(path: str) -> dict:
+    output_formats = load_config(path).get('output_formats', DEFAULT_OUTPUT_FORMATS)
+    # png has to exist for downloads even if config leaves it out
+    return {'png': {}, **output_formats}
+
+def load_preview_config(path: str) -> dict:
+    return {**DEFAULT_PREVIEW, **load_config(path).get('preview', {})}
+
+def can_encode(fmt: str) -> bool:
+    if fmt not in FORMATS:
+        return False
+    Image.init()
+    return FORMATS[fmt][0] in Image.SAVE
+
+def drop_unused_alpha(image: Image.Image) -> Image.Image:
+    '''
+    mosaics are opaque, RGBA only costs encode time and bytes. keeps alpha if any pixel actually uses it
+    '''
+    if image.mode == 'RGBA' and image.getchannel('A').getextrema()[0] == 255:
+        return image.convert('RGB')
+    return image
+
+def encode(image: Image.Image, fmt: str, options: dict) -> bytes:
+    pil_format, _ = FORMATS[fmt]
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+def encode_all(image: Image.Image, output_formats: dict, metrics: TaskMetrics, deadline: float = None) -> dict:
+    '''
+    returns {format name: encoded bytes}, encode time and size of each format is recorded in metrics.
+    png is always encoded first, the other formats are skipped once the monotonic() deadline has passed
+    '''
+    encoded = {}
+    with metrics.stage('encode'):
+        image = drop_unused_alpha(image)
+        for fmt, options in sorted(output_formats.items(), key=lambda item: item[0] != 'png'):
+            if fmt != 'png' and past(deadline):
+                metrics.count('fallback_formats')
+                continue
+            if not can_encode(fmt):
+                print(f'skipping {fmt} output, not supported by this Pillow build')
+                continue
+            if fmt == 'jpeg' and image.mode == 'RGBA':
+                # jpeg would flatten transparency the mosaic relies on
+                continue
+            with metrics.stage(f'encode_{fmt}'):
+                encoded[fmt] = encode(image, fmt, options)
+            metrics.count(f'bytes_{fmt}', len(encoded[fmt]))
+    return encoded
+
+def encode_preview(image: Image.Image, preview_config: dict, metrics: TaskMetrics, deadline: float = None) -> dict:
+    '''
+    downscales the composited mosaic to at most preview_config['max_width'] wide and encodes it in the preview formats.
+    returns {format name: encoded bytes}, nothing is downscaled if the mosaic is already narrow enough.
+    past the deadline no preview is made, /preview falls back to the full image
+    '''
+    encoded = {}
+    if past(deadline):
+        metrics.count('fallback_preview')
+        return encoded
+    with metrics.stage('encode_preview'):
+        max_width = preview_config['max_width']
+        if image.width > max_width:
+            image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+        image = drop_unused_alpha(image)
+        for fmt, options in preview_config['formats'].items():
+            if not can_encode(fmt) or (fmt == 'jpeg' and image.mode == 'RGBA'):
+                continue
+            encoded[fmt] = encode(image, fmt, options)
+            metrics.count(f'bytes_preview_{fmt}', len(encoded[fmt]))
+    return encoded
+
+
+class PngStreamWriter:
+    '''
+    writes an 8 bit RGB png a stripe of rows at a time, used for mosaics too big to hold as one canvas.
+    rows use the png Sub filter (each byte minus the byte one pixel to its left), computed by Pillow
+    with subtract_modulo so no per-pixel python runs
+    '''
+    _f: BinaryIO
+    _width: int
+    _height: int
+    _rows: int
+
+    def __init__(self, f: BinaryIO, width: int, height: int, compress_level: int = 6) -> None:
+        self._f = f
+        self._width = width
+        self._height = height
+        self._rows = 0
+        self._compressor = zlib.compressobj(compress_level)
+        f.write(PNG_SIGNATURE)
+        # width, height, bit depth 8, color type 2 (RGB), default compression, filtering and no interlace
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, kind: bytes, data: bytes) -> None:
+        self._f.write(struct.pack('>I', len(data)))
+        self._f.write(kind)
+        self._f.write(data)
+        self._f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_stripe(self, stripe: Image.Image) -> None:
+        if stripe.width != self._width or self._rows + stripe.height > self._height:
+            raise ValueError(f'stripe {stripe.size} does not fit a {self._width}x{self._height} png at row {self._rows}')
+        stripe = stripe.convert('RGB')
+        left = Image.new('RGB', stripe.size)
+        left.paste(stripe, (1, 0))
+        filtered = ImageChops.subtract_modulo(stripe, left).tobytes()
+        del left
+        stride = self._width * 3
+        rows = b''.join(PNG_FILTER_SUB + filtered[i:i + stride] for i in range(0, len(filtered), stride))
+        data = self._compressor.compress(rows)
+        if data:
+            self.write_chunk(b'IDAT', data)
+        self._rows += stripe.height
+
+    def close(self) -> None:
+        if self._rows != self._height:
+            raise ValueError(f'png closed after {self._rows} of {self._height} rows')
+        self.write_chunk(b'IDAT', self._compressor.flush())
+        self.write_chunk(b'IEND', b'')
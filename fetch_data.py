@@ -3,54 +3,228 @@ Fetch Data from rss feed then transform data into MovieClass objects.
 Maybe we split this up into a fetch_data.py and a transform_data.py?
 """
 
-from bs4 import BeautifulSoup
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
-from tmdb_fetch import get_director, get_tmdb_poster_url
+from tmdb_fetch import get_director, get_tmdb_poster_url, get_poster_size, set_poster_size, async_get_director, async_get_tmdb_poster_url
 import aiohttp
 import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
 import aiofiles
 from moviecell import MovieCell
 import os
+import json
+from functools import lru_cache
 from PIL import Image
 from io import BytesIO
+from poster_codec import encode_poster
 from db_cache import dbCache
+from tmdb_cache import tmdbCache, NOT_FOUND
+from negative_cache import negativeCache
+from watch_history import watchHistory, WatchEntry, parse_feed, select_entries
+from metrics import TaskMetrics
+from deadline import TaskDeadline, time_left
+from rate_limiter import get_limiter, retry_delay, RETRY_STATUSES
+
+FETCH_CONCURRENCY = 8 # posters downloaded at once per task
+FETCH_TIMEOUT = 20 # seconds per attempt
+CONNECT_TIMEOUT = 5
+FETCH_RETRIES = 3
+WRITE_BATCH_SIZE = 50
+TRANSFORM_THREADS = os.cpu_count() or 2 # Pillow releases the GIL while decoding/resizing/encoding
+METADATA_THREADS = 8 # tmdb lookups running at once in the sync worker
+FEED_THREADS = 8 # member feeds fetched at once for a group mosaic in the sync worker
+NO_METADATA = ('', None) # what a film renders with when tmdb didn't answer in time: no director, NoPoster.png
+
+RSS_HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
+
+_transform_executor: ThreadPoolExecutor = None
+
+def get_transform_executor() -> ThreadPoolExecutor:
+    global _transform_executor
+    if _transform_executor is None:
+        _transform_executor = ThreadPoolExecutor(max_workers=TRANSFORM_THREADS, thread_name_prefix='poster-resize')
+    return _transform_executor
+
+@lru_cache(maxsize=None)
+def load_thumbnail_size(config_path: str = 'config.json') -> tuple[int, int]:
+    with open(config_path, 'r') as f:
+        return tuple(json.load(f)['thumbnail_size'])
+
+def resize_poster(image_data: bytes, size: tuple[int, int] = None) -> tuple[bytes, str]:
+    '''
+    resizes downloaded poster bytes to thumbnail size and returns the (blob, codec) stored in DB_CACHE.
+    jpegs are decoded at reduced resolution with draft(), libjpeg scales by 1/2, 1/4 or 1/8 while decoding
+    and picks the smallest scale that is still at least `size`, lanczos does the rest
+    '''
+    size = size or load_thumbnail_size()
+    with Image.open(BytesIO(image_data)) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', size)
+        elif img.mode == 'P':
+            # palette images would be resized with nearest neighbour
+            img = img.convert('RGBA')
+        img = img.resize(size, Image.LANCZOS)
+        # stored in the codec from "poster_storage" in config.json
+        return encode_poster(img)
+
+def title_to_image_path(title: str) -> str:
+    '''
+    DB_CACHE key for a film's poster
+    '''
+    # make sure we are only taking alphanumeric characters
+    title = re.sub(r'[^a-zA-Z0-9]', '', title)
+    images_dir = os.environ['IMAGES_DIR']
+    return images_dir + '/' + title.replace(' ', '-') + '.png'
+
+async def fetch_poster(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore, metrics: TaskMetrics) -> bytes:
+    '''
+    returns the poster bytes, or None once FETCH_RETRIES attempts have failed.
+    requests take a token from the shared 'tmdb_images' bucket (see rate_limiter.py). timeouts, connection errors and
+    429/5xx responses are retried after Retry-After or a jittered exponential backoff, other errors aren't
+    '''
+    limiter = get_limiter('tmdb_images')
+    for attempt in range(FETCH_RETRIES):
+        retry_after, status = None, None
+        try:
+            # the token is taken once a slot is free, coroutines waiting for one don't use up the budget
+            async with semaphore:
+                await limiter.acquire_async()
+                async with session.get(url) as response:
+                    if response.status not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        return await response.read()
+                    err = f'status {response.status}'
+                    retry_after, status = response.headers.get('Retry-After'), response.status
+        except aiohttp.ClientResponseError as e:
+            print(f'could not download {url}: status {e.status}')
+            metrics.count('poster_failures')
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            err = f'{type(e).__name__}: {e}'
+
+        if attempt + 1 < FETCH_RETRIES:
+            metrics.count('poster_retries')
+            delay = retry_delay(attempt, retry_after)
+            if status == 429:
+                # every process waits this out in acquire_async()
+                metrics.count('poster_throttled')
+                await limiter.throttled_async(delay)
+            else:
+                await asyncio.sleep(delay)
+
+    print(f'giving up on {url} after {FETCH_RETRIES} attempts: {err}')
+    metrics.count('poster_failures')
+    return None
 
-async def download(name_url: tuple[str], session, db_cache: dbCache):
+async def download(name_url: tuple[str], session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, queue: asyncio.Queue, metrics: TaskMetrics):
+    '''
+    fetch stage -> transform stage for one poster, the resized poster is handed to the writer through queue
+    '''
     filename, url = name_url
 
-    # file already exists or there is no poster to download
-    if db_cache.lookup(filename) or not url:
+    image_data = await fetch_poster(session, url, semaphore, metrics)
+    if image_data is None:
         return
-    
-    # stream image data from requests
-    image_data: bytes
-    async with session.get(url) as response:
-        image_data = await response.read()
+    metrics.count('posters_downloaded')
+    metrics.count('poster_bytes', len(image_data))
+
+    # decoding and resizing would stall every other download if it ran on the event loop
+    try:
+        resized = await asyncio.get_running_loop().run_in_executor(get_transform_executor(), resize_poster, image_data)
+    except (OSError, ValueError) as e:
+        print(f'could not resize {url}: {e}')
+        metrics.count('poster_failures')
+        return
+    await queue.put((filename, *resized))
 
-    with Image.open(BytesIO(image_data)) as img:
-        img = img.resize((120, 180))
-        format = img.format if img.format else 'PNG'
-        with BytesIO() as buffer:
-            img.save(buffer, format=format)
-            resized_image_data = buffer.getvalue()
-
-    db_cache.push(filename=filename, image_data=resized_image_data)
-
-    # put in shared cache object here
-    # it will check if 'filename' already exists
-    # if it does then just return no further action needed
-    # else call function regularly
-    # async with session.get(url) as response:
-    #     async with aiofiles.open(filename, "wb") as f:
-    #         await f.write(await response.read())
-
-async def download_all(name_urls: list[tuple], db_cache: dbCache):
-    async with aiohttp.ClientSession() as session:
-        await asyncio.gather(
-            *[download(name_url, session=session, db_cache=db_cache) for name_url in name_urls]
-        )
+async def write_posters(queue: asyncio.Queue, db_cache: dbCache) -> None:
+    '''
+    writer stage, the only place DB_CACHE is written during a download. a None on the queue means everything is in
+    '''
+    rows = []
+    while True:
+        row = await queue.get()
+        if row is None:
+            break
+        rows.append(row)
+        if len(rows) >= WRITE_BATCH_SIZE:
+            db_cache.push_many(rows)
+            rows = []
+    if rows:
+        db_cache.push_many(rows)
+
+async def download_all(name_urls: list[tuple], db_cache: dbCache, metrics: TaskMetrics, session: aiohttp.ClientSession = None, deadline: float = None):
+    '''
+    downloads posters missing from DB_CACHE. downloads still running at the monotonic() deadline are cancelled,
+    those films render with NoPoster.png
+    '''
+    # posters without a url are skipped and cached ones are found with a single query before any network i/o
+    name_urls = dict((filename, url) for filename, url in name_urls if url)
+    cached = db_cache.lookup_many(list(name_urls))
+    metrics.count('posters_cached', len(cached))
+    name_urls = [(filename, url) for filename, url in name_urls.items() if filename not in cached]
+    if not name_urls:
+        return
+
+    if session is None:
+        # one-off session, the async worker passes in one that lives for the whole process
+        async with aiohttp.ClientSession(timeout=get_poster_timeout()) as session:
+            return await download_missing(name_urls, db_cache, metrics, session, deadline)
+    await download_missing(name_urls, db_cache, metrics, session, deadline)
+
+async def download_missing(name_urls: list[tuple], db_cache: dbCache, metrics: TaskMetrics, session: aiohttp.ClientSession, deadline: float = None):
+    '''
+    download_all() after the cache lookup, every (filename, url) in name_urls is fetched
+    '''
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    queue = asyncio.Queue()
+    writer = asyncio.create_task(write_posters(queue, db_cache))
+    downloads = [
+        asyncio.create_task(download(name_url, session=session, semaphore=semaphore, queue=queue, metrics=metrics))
+        for name_url in name_urls
+    ]
+    _, pending = await asyncio.wait(downloads, timeout=time_left(deadline))
+    if pending:
+        for job in pending:
+            job.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        metrics.count('fallback_posters', len(pending))
+    # posters that made it in are still written
+    await queue.put(None)
+    await writer
+
+def get_poster_timeout() -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(total=FETCH_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+async def fetch_rss_feed(session: aiohttp.ClientSession, username: str) -> bytes:
+    '''
+    async Scraper.load_rss_feed()
+    '''
+    async with session.get(f'https://letterboxd.com/{username}/rss/', headers=RSS_HEADERS) as response:
+        return await response.read()
+
+def valid_rss_feed(rss_feed: bytes) -> bool:
+    return not "<title>Letterboxd - Not Found</title>" in rss_feed.decode("utf-8")
+
+def get_selection(mode: int, date: datetime, date_range: tuple[datetime, datetime] = None) -> tuple[datetime, datetime, int]:
+    '''
+    (first day, last day, max films) a mosaic in mode covers on date, None where there is no bound
+    '''
+    if mode == 0:
+        # movies watched this month
+        first_day = datetime(date.year, date.month, 1)
+        return (first_day, (first_day + timedelta(days=32)).replace(day=1) - timedelta(days=1), None)
+    elif mode == 1:
+        # last 30 movies (change 30 to config.json val?)
+        return (None, None, 30)
+    elif mode == 2:
+        # year in review
+        return (datetime(date.year, 1, 1), datetime(date.year, 12, 31), None)
+    elif mode == 3:
+        # custom date range
+        return (*(date_range or (None, None)), None)
+    return (None, None, None)
 
 # going to make this into a class to avoid duplicate calls because front-end makes calls here to determine if user valid
 # every instance of Scraper needs to be tied to a server-side session
@@ -61,25 +235,41 @@ class Scraper:
     '''
     _rss_feed: bytes
     _username: str
+    _timeout: float
 
     
-    def __init__(self, username: str) -> None:
+    def __init__(self, username: str, timeout: float = None) -> None:
         print('scraper created!')
         self._username = username
+        self._timeout = timeout
         self.load_rss_feed()
 
     def load_rss_feed(self) -> None:
         url = f'https://letterboxd.com/{self._username}/rss/'
-        headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
-        r = requests.get(url, headers=headers)
+        r = requests.get(url, headers=RSS_HEADERS, timeout=self._timeout)
         self._rss_feed = r.content
     
     def valid_rss_feed(self) -> bool:
-        return not "<title>Letterboxd - Not Found</title>" in self._rss_feed.decode("utf-8")
+        return valid_rss_feed(self._rss_feed)
 
     def get_rss_feed(self) -> bytes:
         return self._rss_feed
 
+    @classmethod
+    def load_many(cls, usernames: list[str], timeout: float = None) -> dict[str, "Scraper"]:
+        '''
+        fetches every member's feed of a group mosaic at once, members whose feed didn't arrive are left out
+        '''
+        scrapers = {}
+        with ThreadPoolExecutor(max_workers=min(len(usernames), FEED_THREADS) or 1, thread_name_prefix='rss') as pool:
+            futures = {username: pool.submit(cls, username, timeout) for username in usernames}
+        for username, future in futures.items():
+            try:
+                scrapers[username] = future.result()
+            except requests.RequestException as e:
+                print(f'could not fetch rss feed for {username}: {type(e).__name__}: {e}')
+        return scrapers
+
 class Transformer:
     '''
     Takes data from rss feed and transforms into usable state for building MovieCell objects.
@@ -87,155 +277,272 @@ class Transformer:
     _username: str
     _mode: int
     _date: datetime
-    _movies: list[str]
+    _movies: list[WatchEntry]
     _feed_content: bytes
+    _tmdb_cache: tmdbCache
+    _watch_history: watchHistory
+    _metadata: list[tuple[str, str]]
+    _metadata_fallbacks: int
+    _date_range: tuple[datetime, datetime]
 
-    def __init__(self, username: str, mode: int, date: datetime, feed_content: bytes):
+    def __init__(self, username: str, mode: int, date: datetime, feed_content: bytes, tmdb_cache: tmdbCache = None, date_range: tuple[datetime, datetime] = None, watch_history: watchHistory = None):
         self._username = username
         self._mode = mode
         self._date = date
         self._feed_content = feed_content
+        self._tmdb_cache = tmdb_cache
+        self._watch_history = watch_history
+        # (first day, last day) watched, only used by mode 3
+        self._date_range = date_range
+        self._metadata = None
+        self._metadata_fallbacks = 0
         print('transformer created!')
     
     def load_movies(self) -> None:
-        self._movies = self.get_valid_movies()
-
-    def get_items(self) -> list[str]:
-        # remove duplicate items here to avoid complicating things downstream
-
-
-        soup = BeautifulSoup(self._feed_content, 'xml')
-        return soup.find_all('item')
-
-    def remove_duplicate_movies(self, items: list):
-        # abomination of a function :)
-        def get_movie_title(item) -> str:
-            return item.find('letterboxd:filmTitle').string
-        
-
-        title_locs = {}
-        for index, item in enumerate(items):
-            title = get_movie_title(item)
-            if title in title_locs:
-                title_locs[title].append(index)
-            else:
-                title_locs[title] = [index]
-
-        keep_indices = set([loc[0] for loc in title_locs.values()])
-        return [item for index, item in enumerate(items) if index in keep_indices]
+        if self._watch_history:
+            # only entries newer than the stored history are parsed, the selection is an indexed query
+            self._watch_history.ingest(self._username, self._feed_content)
+            self._movies = self._watch_history.query(self._username, *self.get_selection())
+        else:
+            self._movies = self.get_valid_movies()
+
+    def get_selection(self) -> tuple[datetime, datetime, int]:
+        return get_selection(self._mode, self._date, self._date_range)
+
+    def get_valid_movies(self) -> list[WatchEntry]:
+        # without a watch history everything comes from this feed
+        items = sorted(parse_feed(self._feed_content, self._username), key=lambda entry: entry.watched_date, reverse=True)
+        return select_entries(items, *self.get_selection())
+    
+    def get_movies(self) -> list[WatchEntry]:
+        return self._movies
 
-    def get_valid_movies(self):
-        def is_movie(item) -> bool:
-            return str(item.find('link')).find(f'https://letterboxd.com/{self._username}/list/') == -1 
+    def get_members(self) -> list[str]:
+        # only group mosaics have members
+        return None
 
-        def watched_this_month(item) -> bool:
-            # if 'Departed' in str(item):
-            #     print(f'DEPARTED WATCH DATE {get_watched_date(item)} MONTH: {get_watched_date(item).month}')
-            watched_date = get_watched_date(item)
-            return watched_date.month == self._date.month and watched_date.year == self._date.year
-        
-        def has_watched_date(item) -> bool:
-            watched_date = item.find('letterboxd:watchedDate')
-            return not watched_date is None
-        
-        def get_watched_date(item) -> datetime:
-            date_val = item.find('letterboxd:watchedDate')
-            date_split = date_val.string.split('-')
-            # date_split = re.split(pattern='<|>', string=str(item.find("letterboxd:watchedDate")))[2].split('-')
-            return datetime(year=int(date_split[0]), month=int(date_split[1]), day=int(date_split[2]))
-
-        # ensure item has watched date field
-        items = list(filter(has_watched_date, self.get_items()))
-
-        # remove duplicate items
-        items = self.remove_duplicate_movies(items)
-
-        # sorting movies by date
-        items = sorted(filter(is_movie, items), key=lambda x: get_watched_date(x), reverse=True)
-
-        # going to remove this 
-        if self._mode == 0:
-            # getting movies watched this month
-            items = list(filter(watched_this_month, items))
-        elif self._mode == 1:
-            # getting last 30 movies (change 30 to config.json val?)
-            items = list(items)[:30]
-
-        return items
-    
     def get_last_movie_date(self) -> datetime:
-        def get_watched_date(item) -> datetime:
-            date_split = re.split(pattern='<|>', string=str(item.find("letterboxd:watchedDate")))[2].split('-')
-            date = datetime(year=int(date_split[0]), month=int(date_split[1]), day=int(date_split[2]))
-            # print(f'getwatched date returning: {date.month}')
-            return date
-
         if not self._movies:
             return None
 
-        return get_watched_date(self._movies[-1])        
+        return self._movies[-1].watched_date
     
     def get_movie_titles(self) -> list:
-        def get_movie_title(item) -> str:
-            return re.split(pattern='<|>', string=str(item.find("letterboxd:filmTitle")))[2]
-
-        return list(map(get_movie_title, self._movies))
+        return [entry.title for entry in self._movies]
 
     def get_movie_ratings(self) -> list:
-        def get_movie_rating(item) -> int:
-            rating_tag = item.find("letterboxd:memberRating")
-            if not rating_tag: return -1
-            return float(re.split(pattern='<|>', string=str(rating_tag))[2])
-
-        return list(map(get_movie_rating, self._movies))
+        return [entry.rating for entry in self._movies]
     
-    def get_movie_directors(self) -> list:
-        def get_tmdb_id(item) -> tuple[int, str]:
-            # make this into a proper function ??
-            # tmdb_movie_id = int(re.split(pattern='<|>', string=str(item.find("tmdb:movieId")))[0])
-            # if tmdb_movie_id == -1:
-                # tmdb_tv_id = int(re.split(pattern='<|>', string=str(item.find("tmdb:tvId")))[0])
-            # we need to pass a flag to our tmdb_fetch functions telling them if it's a tv show or a movie**
-            tmdb_id = item.find('tmdb:movieId')
-            tmdb_type = 'mv'
-            if not tmdb_id:
-                tmdb_id = item.find('tmdb:tvId')
-                tmdb_type = 'tv'
-
-            return (int((tmdb_id.string)), tmdb_type)
-        
-        return [get_director(id, t) for id, t in map(get_tmdb_id, self._movies)]
+    def get_tmdb_ids(self) -> list[tuple[int, str]]:
+        # we need to pass a flag to our tmdb_fetch functions telling them if it's a tv show or a movie**
+        return [(entry.tmdb_id, entry.tmdb_type) for entry in self._movies]
+
+    def get_movie_metadata(self, deadline: float = None) -> list[tuple[str, str]]:
+        '''
+        returns (director, poster_url) for every movie.
+        looked up in the tmdb cache first (when there is one) so each id costs at most one round of api calls.
+        ids that fail or aren't resolved by the monotonic() deadline get NO_METADATA and aren't cached
+        '''
+        if self._metadata is not None:
+            return self._metadata
+
+        ids = self.get_tmdb_ids()
+        cached = [self._tmdb_cache.lookup(tmdb_id, tmdb_type) if self._tmdb_cache else None for tmdb_id, tmdb_type in ids]
+        missing = list(dict.fromkeys(id_type for id_type, metadata in zip(ids, cached) if not metadata))
+
+        def resolve(tmdb_id: int, tmdb_type: str) -> tuple[str, str]:
+            return (get_director(tmdb_id, tmdb_type), get_tmdb_poster_url(tmdb_id, tmdb_type))
+
+        resolved = {}
+        if missing:
+            # lookups left running at the deadline finish in the background, tmdb.REQUESTS_TIMEOUT bounds them
+            pool = ThreadPoolExecutor(max_workers=METADATA_THREADS, thread_name_prefix='tmdb')
+            futures = {pool.submit(resolve, *id_type): id_type for id_type in missing}
+            done, _ = wait(futures, timeout=time_left(deadline))
+            pool.shutdown(wait=False, cancel_futures=True)
+            for future in done:
+                try:
+                    resolved[futures[future]] = future.result()
+                except requests.HTTPError as e:
+                    if e.response is not None and e.response.status_code == 404:
+                        resolved[futures[future]] = NOT_FOUND
+                    else:
+                        print(f'could not get tmdb metadata for {futures[future]}: {type(e).__name__}: {e}')
+                except (requests.RequestException, ValueError) as e:
+                    print(f'could not get tmdb metadata for {futures[future]}: {type(e).__name__}: {e}')
+
+        self._metadata = self.merge_metadata(ids, cached, resolved)
+        return self._metadata
+
+    async def load_movie_metadata_async(self, session: aiohttp.ClientSession, deadline: float = None) -> None:
+        '''
+        async get_movie_metadata(), ids missing from the tmdb cache are all looked up at once on a shared session
+        '''
+        ids = self.get_tmdb_ids()
+        cached = [self._tmdb_cache.lookup(tmdb_id, tmdb_type) if self._tmdb_cache else None for tmdb_id, tmdb_type in ids]
+
+        async def resolve(tmdb_id: int, tmdb_type: str) -> tuple[str, str]:
+            director, poster_url = await asyncio.gather(
+                async_get_director(session, tmdb_id, tmdb_type), async_get_tmdb_poster_url(session, tmdb_id, tmdb_type))
+            return (director, poster_url)
+
+        missing = list(dict.fromkeys(id_type for id_type, metadata in zip(ids, cached) if not metadata))
+        resolved = {}
+        if missing:
+            lookups = {asyncio.create_task(resolve(*id_type)): id_type for id_type in missing}
+            done, pending = await asyncio.wait(lookups, timeout=time_left(deadline))
+            for job in pending:
+                job.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for job in done:
+                try:
+                    resolved[lookups[job]] = job.result()
+                except aiohttp.ClientResponseError as e:
+                    if e.status == 404:
+                        resolved[lookups[job]] = NOT_FOUND
+                    else:
+                        print(f'could not get tmdb metadata for {lookups[job]}: {type(e).__name__}: {e}')
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f'could not get tmdb metadata for {lookups[job]}: {type(e).__name__}: {e}')
+
+        self._metadata = self.merge_metadata(ids, cached, resolved)
+
+    def merge_metadata(self, ids: list[tuple[int, str]], cached: list[tuple[str, str]], resolved: dict) -> list[tuple[str, str]]:
+        '''
+        caches what was resolved (NOT_FOUND included) and fills in NO_METADATA for what wasn't,
+        counting those in get_metadata_fallbacks()
+        '''
+        if self._tmdb_cache:
+            for (tmdb_id, tmdb_type), metadata in resolved.items():
+                self._tmdb_cache.push(tmdb_id, tmdb_type, *metadata)
+
+        metadata = [cached_metadata or resolved.get(id_type) for id_type, cached_metadata in zip(ids, cached)]
+        self._metadata_fallbacks = sum(1 for film_metadata in metadata if film_metadata is None)
+        return [NO_METADATA if film_metadata in (None, NOT_FOUND) else film_metadata for film_metadata in metadata]
+
+    def get_metadata_fallbacks(self) -> int:
+        return self._metadata_fallbacks
 
-        # return list(map(get_director, map(get_tmdb_id, self._movies)))
+    def get_movie_directors(self) -> list:
+        return [director for director, _ in self.get_movie_metadata()]
     
     def get_movie_poster_paths(self) -> list:
-        def title_to_image_path(title: str):
-            # make sure we are only taking alphanumeric characters
-            title = re.sub(r'[^a-zA-Z0-9]', '', title)
-            images_dir = os.environ['IMAGES_DIR']
-            return images_dir + '/' + title.replace(' ', '-') + '.png'
-
         return list(map(title_to_image_path, self.get_movie_titles()))
     
     def get_movie_poster_urls(self) -> list:
-        def get_tmdb_id(item) -> int:
+        # smallest tmdb size covering the thumbnail instead of the w500 the urls were built with
+        poster_size = get_poster_size(load_thumbnail_size())
+        return [set_poster_size(poster_url, poster_size) for _, poster_url in self.get_movie_metadata()]
+
+    def valid_movies_exist(self) -> bool:
+        return len(self._movies)
+
+class GroupTransformer(Transformer):
+    '''
+    Transformer over several members' feeds for a group mosaic. films are the union of what the members watched in
+    the mode's window, one per tmdb id at its most recent watch, so metadata and posters are resolved once per film
+    however many members logged it. ratings are tuples in member order, None for members who didn't log the film.
+    '''
+    _members: list[str]
+    _feeds: dict[str, bytes]
+    _ratings: list[tuple]
+    _entry_count: int
+
+    def __init__(self, feeds: dict[str, bytes], mode: int, date: datetime, tmdb_cache: tmdbCache = None, date_range: tuple[datetime, datetime] = None, watch_history: watchHistory = None):
+        super().__init__(username=', '.join(feeds), mode=mode, date=date, feed_content=None, tmdb_cache=tmdb_cache, date_range=date_range, watch_history=watch_history)
+        self._members = list(feeds)
+        self._feeds = feeds
+        self._ratings = []
+        self._entry_count = 0
 
-            # tmdb_movie_id = int(re.split(pattern='<|>', string=str(item.find("tmdb:movieId")))[0])
-            # if tmdb_movie_id == -1:
-                # tmdb_tv_id = int(re.split(pattern='<|>', string=str(item.find("tmdb:tvId")))[0])
-            # we need to pass a flag to our tmdb_fetch functions telling them if it's a tv show or a movie**
-            tmdb_id = item.find('tmdb:movieId')
-            tmdb_type = 'mv'
-            if not tmdb_id:
-                tmdb_id = item.find('tmdb:tvId')
-                tmdb_type = 'tv'
+    def load_movies(self) -> None:
+        films = {}
+        for index, member in enumerate(self._members):
+            transformer = Transformer(username=member, mode=self._mode, date=self._date, feed_content=self._feeds[member], date_range=self._date_range, watch_history=self._watch_history)
+            transformer.load_movies()
+            self._entry_count += len(transformer.get_movies())
+            for entry in transformer.get_movies():
+                key = (entry.tmdb_id, entry.tmdb_type)
+                if key not in films:
+                    films[key] = (entry, [None] * len(self._members))
+                elif entry.watched_date > films[key][0].watched_date:
+                    films[key] = (entry, films[key][1])
+                films[key][1][index] = entry.rating
+
+        # newest first like a single user's mosaic, films watched the same day keep member order
+        ordered = sorted(films.values(), key=lambda film: film[0].watched_date, reverse=True)[:self.get_selection()[2]]
+        self._movies = [entry for entry, _ in ordered]
+        self._ratings = [tuple(ratings) for _, ratings in ordered]
+
+    def get_members(self) -> list[str]:
+        return self._members
 
-            return (int((tmdb_id.string)), tmdb_type)
+    def get_movie_ratings(self) -> list:
+        return self._ratings
 
-        return [get_tmdb_poster_url(id, t) for id, t in map(get_tmdb_id, self._movies)]
+    def get_entry_count(self) -> int:
+        # films across every member before deduplication, what separate mosaics would have resolved
+        return self._entry_count
 
-    def valid_movies_exist(self) -> bool:
-        return len(self._movies)
+def get_movie_data(transformer: Transformer) -> list:
+    '''
+    [titles, directors, ratings, poster paths, poster urls, last movie date, members] for MovieCellBuilder,
+    members is None unless it's a group mosaic
+    '''
+    movie_data = [
+        transformer.get_movie_titles(),       # 0
+        transformer.get_movie_directors(),    # 1
+        transformer.get_movie_ratings(),      # 2
+        transformer.get_movie_poster_paths(), # 3
+        transformer.get_movie_poster_urls(),  # 4
+        transformer.get_last_movie_date(),    # 5
+        transformer.get_members()             # 6
+    ]
+
+    # we need to make sure poster paths are taken out if there is no url
+    for index, url in enumerate(movie_data[4]):
+        if not url:
+            movie_data[3][index] = None
+
+    return movie_data
+
+def skip_unknown_members(members: list[str], negative_cache: negativeCache, metrics: TaskMetrics) -> list[str]:
+    # members letterboxd recently had no feed for aren't fetched again
+    if not negative_cache:
+        return members
+    known = [member for member in members if not negative_cache.lookup('username', member.lower())]
+    if len(known) < len(members):
+        metrics.count('negative_cache_hits', len(members) - len(known))
+    return known
+
+def valid_group_feeds(feeds: dict[str, bytes], negative_cache: negativeCache, deadline: TaskDeadline) -> dict[str, bytes]:
+    '''
+    {member: feed or None when it didn't arrive} -> the members whose feed has something to show, in member order
+    '''
+    valid = {}
+    for member, feed in feeds.items():
+        if feed is None:
+            deadline.fallback('feed')
+        elif not valid_rss_feed(feed):
+            if negative_cache:
+                negative_cache.push('username', member.lower())
+        else:
+            valid[member] = feed
+    return valid
+
+def count_group(metrics: TaskMetrics, transformer: GroupTransformer) -> None:
+    metrics.count('group_members', len(transformer.get_members()))
+    metrics.count('group_entries', transformer.get_entry_count())
+
+async def fetch_member_feed(session: aiohttp.ClientSession, username: str, timeout: float) -> bytes:
+    '''
+    fetch_rss_feed() for one member of a group, None if it didn't arrive in time
+    '''
+    try:
+        return await asyncio.wait_for(fetch_rss_feed(session, username), timeout)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f'could not fetch rss feed for {username}: {type(e).__name__}: {e}')
+        return None
 
 '''
 ==MCB=CLASS==
@@ -254,16 +561,22 @@ class MovieCellBuilder:
     _mode: int
     _movie_data: list
     _status: tuple[bool, str]
+    _metrics: TaskMetrics
+    _deadline: TaskDeadline
 
-    def __init__(self, username: str, mode: int, db_cache: dbCache, status: tuple[bool, str] = None, movie_data: list = None) -> None:
+    def __init__(self, username: str, mode: int, db_cache: dbCache, status: tuple[bool, str] = None, movie_data: list = None, metrics: TaskMetrics = None, tmdb_cache: tmdbCache = None, date_range: tuple[datetime, datetime] = None, deadline: TaskDeadline = None, watch_history: watchHistory = None, negative_cache: negativeCache = None, members: list[str] = None) -> None:
 
         self._username = username
         self._mode = mode
         self._movie_data = None
         self._db_cache = db_cache
+        # stage timings are only kept when the caller passes its own TaskMetrics
+        self._metrics = metrics or TaskMetrics(None)
+        # no budgets unless the worker passes the task's deadline
+        self._deadline = deadline or TaskDeadline(None, self._metrics)
 
-        if status and status[0]:
-            # class has been rehydrated and it has no good data
+        if status is not None:
+            # class has been rehydrated with its status (and movie data when the status is good)
             self._status = status
             self._movie_data = movie_data
             return
@@ -274,37 +587,160 @@ class MovieCellBuilder:
             self._movie_data = movie_data
             return
 
+        if members:
+            self.load_group(members, tmdb_cache, date_range, watch_history, negative_cache)
+            return
+
+        # usernames letterboxd recently had no feed for aren't fetched again
+        if negative_cache and negative_cache.lookup('username', username.lower()):
+            self._metrics.count('negative_cache_hits')
+            self._status = (False, f'{self._username} has no rss feed (most likely no letterboxd account)')
+            return
+
         # attempt to scrape data and set status to false is no data to scrape
-        scraper = Scraper(username=username)
+        try:
+            with self._metrics.stage('rss_fetch'):
+                scraper = Scraper(username=username, timeout=self._deadline.remaining('feed'))
+        except requests.RequestException as e:
+            # nothing to render without the feed
+            print(f'could not fetch rss feed for {username}: {type(e).__name__}: {e}')
+            self._deadline.fallback('feed')
+            self._status = (False, f"letterboxd didn't answer in time for {self._username}, try again in a bit")
+            return
         if not scraper.valid_rss_feed():
+            if negative_cache:
+                negative_cache.push('username', username.lower())
             self._status = (False, f'{self._username} has no rss feed (most likely no letterboxd account)')
             return
 
         # attempt to transform scraped data and set status to false if data not viable
-        transformer = Transformer(username=username, mode=self._mode, date=datetime.now(), feed_content=scraper.get_rss_feed())
-        transformer.load_movies()
+        with self._metrics.stage('rss_parse'):
+            transformer = Transformer(username=username, mode=self._mode, date=datetime.now(), feed_content=scraper.get_rss_feed(), tmdb_cache=tmdb_cache, date_range=date_range, watch_history=watch_history)
+            transformer.load_movies()
         if not transformer.valid_movies_exist():
             self._status = (False, f'{self._username} has no valid movies according to the criteria')
             return
 
         # transform good data and store
-        self._movie_data = [
-            transformer.get_movie_titles(),       # 0
-            transformer.get_movie_directors(),    # 1
-            transformer.get_movie_ratings(),      # 2
-            transformer.get_movie_poster_paths(), # 3
-            transformer.get_movie_poster_urls(),  # 4
-            transformer.get_last_movie_date()
-        ]
-
-        # we need to make sure poster paths are taken out if there is no url
-        for index, url in enumerate(self._movie_data[4]):
-            if not url:
-                self._movie_data[3][index] = None
+        with self._metrics.stage('tmdb_resolve'):
+            transformer.get_movie_metadata(self._deadline.until('metadata'))
+            self._movie_data = get_movie_data(transformer)
+        self._metrics.count('films', len(self._movie_data[0]))
+        self._deadline.fallback('metadata', transformer.get_metadata_fallbacks())
 
         # set status so we know data is good
         self._status = (True, f'movie data for {self._username} good')
 
+    def load_group(self, members: list[str], tmdb_cache: tmdbCache, date_range: tuple[datetime, datetime], watch_history: watchHistory, negative_cache: negativeCache) -> None:
+        '''
+        __init__ for a group mosaic, every member's feed is fetched at once and the films they logged are
+        resolved once for all of them
+        '''
+        label = ', '.join(members)
+        members = skip_unknown_members(members, negative_cache, self._metrics)
+
+        with self._metrics.stage('rss_fetch'):
+            scrapers = Scraper.load_many(members, timeout=self._deadline.remaining('feed'))
+        feeds = {member: scrapers[member].get_rss_feed() if member in scrapers else None for member in members}
+        feeds = valid_group_feeds(feeds, negative_cache, self._deadline)
+        if not feeds:
+            self._status = (False, f'none of {label} have an rss feed letterboxd answered with, check the usernames')
+            return
+
+        with self._metrics.stage('rss_parse'):
+            transformer = GroupTransformer(feeds=feeds, mode=self._mode, date=datetime.now(), tmdb_cache=tmdb_cache, date_range=date_range, watch_history=watch_history)
+            transformer.load_movies()
+        if not transformer.valid_movies_exist():
+            self._status = (False, f'{label} have no valid movies according to the criteria')
+            return
+
+        with self._metrics.stage('tmdb_resolve'):
+            transformer.get_movie_metadata(self._deadline.until('metadata'))
+            self._movie_data = get_movie_data(transformer)
+        self._metrics.count('films', len(self._movie_data[0]))
+        count_group(self._metrics, transformer)
+        self._deadline.fallback('metadata', transformer.get_metadata_fallbacks())
+
+        self._status = (True, f'movie data for {label} good')
+
+    @classmethod
+    async def load_async(cls, username: str, mode: int, db_cache: dbCache, letterboxd_session: aiohttp.ClientSession,
+                         tmdb_session: aiohttp.ClientSession, metrics: TaskMetrics = None, tmdb_cache: tmdbCache = None,
+                         date_range: tuple[datetime, datetime] = None, executor=None, deadline: TaskDeadline = None,
+                         watch_history: watchHistory = None, negative_cache: negativeCache = None,
+                         members: list[str] = None) -> "MovieCellBuilder":
+        '''
+        same steps as __init__ on shared aiohttp sessions for the async worker.
+        feed parsing runs in executor unless there is a watch history, its sqlite connection belongs to this thread
+        and only new entries are parsed anyway
+        '''
+        metrics = metrics or TaskMetrics(None)
+        deadline = deadline or TaskDeadline(None, metrics)
+
+        def failed(err: str) -> "MovieCellBuilder":
+            return cls(username, mode, db_cache, status=(False, err), metrics=metrics, deadline=deadline)
+
+        if members:
+            label = ', '.join(members)
+            members = skip_unknown_members(members, negative_cache, metrics)
+            with metrics.stage('rss_fetch'):
+                timeout = deadline.remaining('feed')
+                rss_feeds = await asyncio.gather(*(fetch_member_feed(letterboxd_session, member, timeout) for member in members))
+            feeds = valid_group_feeds(dict(zip(members, rss_feeds)), negative_cache, deadline)
+            if not feeds:
+                return failed(f'none of {label} have an rss feed letterboxd answered with, check the usernames')
+
+            with metrics.stage('rss_parse'):
+                transformer = GroupTransformer(feeds=feeds, mode=mode, date=datetime.now(), tmdb_cache=tmdb_cache, date_range=date_range, watch_history=watch_history)
+                if watch_history:
+                    transformer.load_movies()
+                else:
+                    await asyncio.get_running_loop().run_in_executor(executor, transformer.load_movies)
+            if not transformer.valid_movies_exist():
+                return failed(f'{label} have no valid movies according to the criteria')
+
+            with metrics.stage('tmdb_resolve'):
+                await transformer.load_movie_metadata_async(tmdb_session, deadline.until('metadata'))
+                movie_data = get_movie_data(transformer)
+            metrics.count('films', len(movie_data[0]))
+            count_group(metrics, transformer)
+            deadline.fallback('metadata', transformer.get_metadata_fallbacks())
+
+            return cls(username, mode, db_cache, status=(True, f'movie data for {label} good'), movie_data=movie_data, metrics=metrics, deadline=deadline)
+
+        if negative_cache and negative_cache.lookup('username', username.lower()):
+            metrics.count('negative_cache_hits')
+            return failed(f'{username} has no rss feed (most likely no letterboxd account)')
+
+        try:
+            with metrics.stage('rss_fetch'):
+                rss_feed = await asyncio.wait_for(fetch_rss_feed(letterboxd_session, username), deadline.remaining('feed'))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'could not fetch rss feed for {username}: {type(e).__name__}: {e}')
+            deadline.fallback('feed')
+            return failed(f"letterboxd didn't answer in time for {username}, try again in a bit")
+        if not valid_rss_feed(rss_feed):
+            if negative_cache:
+                negative_cache.push('username', username.lower())
+            return failed(f'{username} has no rss feed (most likely no letterboxd account)')
+
+        with metrics.stage('rss_parse'):
+            transformer = Transformer(username=username, mode=mode, date=datetime.now(), feed_content=rss_feed, tmdb_cache=tmdb_cache, date_range=date_range, watch_history=watch_history)
+            if watch_history:
+                transformer.load_movies()
+            else:
+                await asyncio.get_running_loop().run_in_executor(executor, transformer.load_movies)
+        if not transformer.valid_movies_exist():
+            return failed(f'{username} has no valid movies according to the criteria')
+
+        with metrics.stage('tmdb_resolve'):
+            await transformer.load_movie_metadata_async(tmdb_session, deadline.until('metadata'))
+            movie_data = get_movie_data(transformer)
+        metrics.count('films', len(movie_data[0]))
+        deadline.fallback('metadata', transformer.get_metadata_fallbacks())
+
+        return cls(username, mode, db_cache, status=(True, f'movie data for {username} good'), movie_data=movie_data, metrics=metrics, deadline=deadline)
+
     def get_last_movie_date(self) -> datetime:
         if not self._movie_data or self._mode == 0:
             return None
@@ -313,11 +749,41 @@ class MovieCellBuilder:
     def get_status(self) -> tuple[bool, str]:
         return self._status
 
+    def get_movie_poster_paths(self) -> list[str]:
+        # DB_CACHE keys of the posters the mosaic needs, None for films without a poster
+        return self._movie_data[3]
+
+    def get_members(self) -> list[str]:
+        '''
+        members with a rating column on a group mosaic, None for a single user's mosaic
+        '''
+        if not self._movie_data:
+            return None
+        return self._movie_data[6]
+
     def build_cells(self) -> list[MovieCell]:
         # download posters
-        asyncio.run(download_all(zip(self._movie_data[3], self._movie_data[4]), self._db_cache))
+        with self._metrics.stage('poster_download'):
+            asyncio.run(download_all(zip(self._movie_data[3], self._movie_data[4]), self._db_cache, self._metrics,
+                                     deadline=self._deadline.until('posters')))
+
+        return self.get_cells()
+
+    async def build_cells_async(self, session: aiohttp.ClientSession) -> list[MovieCell]:
+        with self._metrics.stage('poster_download'):
+            await download_all(zip(self._movie_data[3], self._movie_data[4]), self._db_cache, self._metrics, session,
+                               self._deadline.until('posters'))
+
+        return self.get_cells()
 
+    def get_cells(self) -> list[MovieCell]:
         # collect all needed components of MovieCell from self._transformer
+        if self.get_members():
+            # group ratings are drawn per member, there is no single rating
+            return [
+                MovieCell(title, director, -1, im_path, member_ratings=ratings)
+                for title, director, ratings, im_path in zip(*self._movie_data[:4])
+            ]
         return [
             MovieCell(*movie_tuple)
             for movie_tuple in zip(
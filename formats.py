@@ -0,0 +1,27 @@
+'''
+output formats a mosaic can be stored and served in. kept apart from encoder.py so server.py and result_store.py
+can negotiate formats without importing Pillow, encoder.py is only needed where images are made.
+'''
+
+# format name -> (Pillow format, mimetype)
+FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'avif': ('AVIF', 'image/avif'),
+}
+# served to clients that don't send a usable Accept header, every browser can show these
+FALLBACK_FORMATS = ['png', 'jpeg']
+
+def get_mimetype(fmt: str) -> str:
+    return FORMATS[fmt][1]
+
+def choose_format(accept_mimetypes, available: dict) -> str:
+    '''
+    picks the smallest available format the client accepts, png (or jpeg for previews) if it accepts none of them.
+    available is {format name: size in bytes}
+    '''
+    acceptable = [fmt for fmt in available if fmt in FORMATS and accept_mimetypes.quality(get_mimetype(fmt)) > 0]
+    if not acceptable:
+        return next((fmt for fmt in FALLBACK_FORMATS if fmt in available), None)
+    return min(acceptable, key=lambda fmt: available[fmt] or 0)
@@ -1,7 +1,19 @@
 """
-Functions for getting grid size for image_builder
+Functions for getting grid size and layout for image_builder
+plan_grid() works out where everything goes on a mosaic once per (film count, thumbnail size, gap, header height,
+info box width) and keeps it, the same few counts come up again and again (a month is at most 31 films)
 """
 
+import unittest
+from dataclasses import dataclass
+from functools import lru_cache
+from math import isqrt
+
+MIN_RATIO = 1
+MAX_RATIO = 2.5
+STAR_W, STAR_H = 12, 12 # make this into config.json val
+INFO_LINE_HEIGHT = 20
+
 def get_factors(n: int) -> tuple:
 	return [(i, n // i) for i in range(1, int(n**0.5)+1) if n % i == 0]
 
@@ -17,16 +29,126 @@ def valid_ratio_exists(ratios: list, max_ratio: float, min_ratio: float) -> bool
 			return True
 	return False
 
+def get_best_factors(n: int) -> tuple:
+	'''
+	(width, height) factor pair of n whose ratio is closest to the middle of MIN_RATIO..MAX_RATIO, None if none is in range.
+	only heights that can give a ratio in range are tried, ties go to the smaller height like they always have
+	'''
+	best, best_dist = None, None
+	for height in range(max(1, isqrt(int(n / MAX_RATIO))), isqrt(n) + 1):
+		if n % height:
+			continue
+		ratio = (n // height) / height
+		if ratio < MIN_RATIO or ratio > MAX_RATIO:
+			continue
+		dist = abs(ratio - (MIN_RATIO + MAX_RATIO)/2)
+		if best is None or dist < best_dist:
+			best, best_dist = (n // height, height), dist
+	return best
+
+@lru_cache(maxsize=None)
 def get_grid_size(n: int) -> tuple:
-	MIN_RATIO = 1
-	MAX_RATIO = 2.5
+	'''
+	(width, height) of the grid for n films, the first count from n up that factors into a ratio in range
+	'''
+	while True:
+		factors = get_best_factors(n)
+		if factors:
+			return factors
+		n += 1
+
+
+@dataclass(frozen=True)
+class GridLayout:
+	'''
+	coordinates are top left corners in canvas pixels, one per film in row-major order.
+	info_lines are the origins of each film's info line, the star strip and the text sit on it
+	'''
+	grid_size: tuple
+	canvas_size: tuple
+	thumbnails: tuple
+	info_lines: tuple
+	star_strips: tuple
+	text_lines: tuple
+
+@lru_cache(maxsize=256)
+def plan_grid(n: int, thumbnail_size: tuple, image_gap: int, username_box_height: int, info_box_width: int) -> GridLayout:
+	grid_width, grid_height = get_grid_size(n)
+	thumb_width, thumb_height = thumbnail_size
+	canvas_size = (thumb_width * grid_width + image_gap * (grid_width + 1) + info_box_width,
+				   thumb_height * grid_height + image_gap * (grid_height + 1) + username_box_height)
+	txt_x = grid_width * thumb_width + image_gap * (grid_width + 1)
+
+	thumbnails, info_lines = [], []
+	for index in range(n):
+		j, i = divmod(index, grid_width)
+		row_y = j * thumb_height + image_gap * (j + 1) + username_box_height
+		thumbnails.append((i * thumb_width + image_gap * (i + 1), row_y))
+		# a row's info lines are stacked from the top of its thumbnails
+		info_lines.append((txt_x, row_y + i * INFO_LINE_HEIGHT))
+
+	return GridLayout(
+		grid_size=(grid_width, grid_height),
+		canvas_size=canvas_size,
+		thumbnails=tuple(thumbnails),
+		info_lines=tuple(info_lines),
+		star_strips=tuple((x, y + STAR_H // 2 - 1) for x, y in info_lines),
+		text_lines=tuple((x + STAR_W * 5, y) for x, y in info_lines)
+	)
 
+
+def search_grid_size(n: int) -> tuple:
+	# the search get_grid_size replaced, kept as the reference its results are tested against
 	while True:
 		factors = list(map(reorder_pair, get_factors(n)))
 		factor_ratios = list(map(factor_to_ratio, factors))
-		
+
 		if not valid_ratio_exists(factor_ratios, MAX_RATIO, MIN_RATIO):
 			n+=1
 			continue
 		dist_list = list(map(lambda x: abs(x - (MIN_RATIO + MAX_RATIO)/2), factor_ratios))
 		return factors[dist_list.index(min(dist_list))]
+
+
+class TestGridLayout(unittest.TestCase):
+	MAX_FILMS = 400
+	CONFIGS = [((120, 180), 10, 50, 500), ((90, 135), 10, 50, 730), ((30, 45), 4, 0, 0)]
+
+	def test_grid_size_matches_search(self):
+		for n in range(1, self.MAX_FILMS + 1):
+			self.assertEqual(get_grid_size(n), search_grid_size(n), n)
+
+	def test_layout_matches_inline_coordinates(self):
+		# what image_builder.build computed inline before plan_grid
+		for thumbnail_size, image_gap, username_box_height, info_box_width in self.CONFIGS:
+			thumb_width, thumb_height = thumbnail_size
+			for n in range(1, self.MAX_FILMS + 1):
+				layout = plan_grid(n, thumbnail_size, image_gap, username_box_height, info_box_width)
+				grid_width, grid_height = search_grid_size(n)
+				self.assertEqual(layout.grid_size, (grid_width, grid_height))
+				self.assertEqual(layout.canvas_size, (
+					thumb_width * grid_width + image_gap * (grid_width + 1) + info_box_width,
+					thumb_height * grid_height + image_gap * (grid_height + 1) + username_box_height))
+
+				thumbnails, info_lines = [], []
+				for j in range(grid_height):
+					for i in range(grid_width):
+						if len(thumbnails) >= n: break
+						thumbnails.append((i * thumb_width + image_gap * (i+1), j * thumb_height + image_gap * (j+1) + username_box_height))
+						txt_x = grid_width * thumb_width + image_gap * (grid_width+1)
+						txt_y = (j % grid_width) * thumb_height + image_gap * ((j % grid_width) + 1) + (i*INFO_LINE_HEIGHT) + username_box_height
+						info_lines.append((txt_x, txt_y))
+				self.assertEqual(layout.thumbnails, tuple(thumbnails), n)
+				self.assertEqual(layout.info_lines, tuple(info_lines), n)
+
+	def test_star_strips_and_text_follow_info_lines(self):
+		layout = plan_grid(7, (120, 180), 10, 50, 500)
+		for (x, y), star, text in zip(layout.info_lines, layout.star_strips, layout.text_lines):
+			self.assertEqual(star, (x, y + STAR_H // 2 - 1))
+			self.assertEqual(text, (x + STAR_W * 5, y))
+
+	def test_layout_is_cached(self):
+		self.assertIs(plan_grid(30, (120, 180), 10, 50, 500), plan_grid(30, (120, 180), 10, 50, 500))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -3,18 +3,27 @@ Functions for building movie grid image.
 To build call build(list[MovieCell], username: str)
 """
 
-from PIL import Image, ImageDraw, ImageFont
-from grid_shape import get_grid_size
+from PIL import Image, ImageDraw, ImageFont, ImageChops
+from grid_shape import plan_grid, STAR_W, STAR_H, INFO_LINE_HEIGHT
 import json
-from functools import partial
+from dataclasses import replace
+from functools import partial, lru_cache
 import datetime
 from math import ceil
 import os
 from io import BytesIO
 import sqlite3
+from cache import TileCache
+from metrics import TaskMetrics
+from poster_codec import decode_poster
 
 ICONS_DIR = os.environ['ICONS_DIR']
-STAR_W, STAR_H = 12, 12 # make this into config.json val
+FONT_PATH = './font/JuliaMono-Bold.ttf'
+BACKGROUND_COLOR = (50, 50, 50)
+MEMBER_COLUMN_GAP = STAR_W // 2 # between members' star columns on group mosaics
+
+# rendered info lines (stars + text) are reused across every build the worker does
+TILE_CACHE = TileCache(max_bytes=int(os.environ.get('TILE_CACHE_BYTES', 32 * 1024 * 1024)))
 
 def trans_paste(fg_img, bg_img, alpha=1.0, box=(0, 0)):
     fg_img_trans = Image.new("RGBA", fg_img.size)
@@ -31,9 +40,12 @@ def build_image_from_blob(image_blob: bytes) -> Image:
     # buffer.close()
     return image    
 
-def get_blob(db:sqlite3.Connection, filename: str) -> bytes:
+def get_blob(db:sqlite3.Connection, filename: str) -> tuple[bytes, str]:
+    '''
+    (blob, codec) of a cached poster or None
+    '''
     cur = db.execute("""
-        SELECT IMAGEBLOB FROM DB_CACHE
+        SELECT IMAGEBLOB, CODEC FROM DB_CACHE
         WHERE FILENAME = ?
                      """,(filename,))
     
@@ -42,23 +54,19 @@ def get_blob(db:sqlite3.Connection, filename: str) -> bytes:
     if not blob_tuple:
         return None
     
-    return blob_tuple[0]
+    return blob_tuple
 
 
 def build_thumbnail(cell: "MovieCell", db: sqlite3.Connection) -> Image:
-	if not cell.im_path:
+	# poster can be missing from the cache if another process evicted it after it was downloaded
+	image_blob = get_blob(db, cell.im_path) if cell.im_path else None
+	if not image_blob:
 		return Image.open(os.environ['STATIC_DIR'] + '/NoPoster.png')
-	return build_image_from_blob(get_blob(db, cell.im_path))
+	return decode_poster(*image_blob)
 
 
-def build_background(thumbnail_width: int, thumbnail_height: int,
-					 grid_width: int, grid_height: int, text_width: int,
-					 username_box_height: int, image_gap: int) -> Image:
-	return Image.new(
-		mode='RGBA', 
-		size=(thumbnail_width * grid_width + image_gap * (grid_width + 1) + text_width,
-			thumbnail_height * grid_height + image_gap * (grid_height + 1) + username_box_height),
-		color=(50, 50, 50))
+def build_background(canvas_size: tuple) -> Image:
+	return Image.new(mode='RGBA', size=canvas_size, color=BACKGROUND_COLOR)
 
 def get_max_text_size(text_drawer: ImageDraw, font: ImageFont, text_list: list) -> int:
 	MIN_WIDTH = 300
@@ -103,6 +111,33 @@ def build_rating_image(movie_cell: "Moviecell", full_star: Image, half_star: Ima
 
     return backdrop
 
+def get_rating_width(movie_cell: "MovieCell") -> int:
+    # stars in front of an info line, one set per member on group mosaics
+    if movie_cell.member_ratings is None:
+        return STAR_W * 5
+    return len(movie_cell.member_ratings) * (STAR_W * 5 + MEMBER_COLUMN_GAP)
+
+def build_member_ratings_image(movie_cell: "MovieCell", full_star: Image, half_star: Image, empty_star: Image) -> Image:
+    '''
+    every member's stars side by side, the column of a member who didn't log the film is left empty
+    '''
+    backdrop = Image.new(mode='RGBA', size=(get_rating_width(movie_cell), STAR_H), color=(255, 0, 0, 0))
+    for index, rating in enumerate(movie_cell.member_ratings):
+        if rating is None:
+            continue
+        stars = build_rating_image(replace(movie_cell, rating=rating), full_star, half_star, empty_star)
+        backdrop.paste(im=stars, box=(index * (STAR_W * 5 + MEMBER_COLUMN_GAP), 0))
+    return backdrop
+
+def draw_member_columns(text_drawer: ImageDraw, members: list[str], x: int, y: int, font: ImageFont.FreeTypeFont, font_color: tuple) -> None:
+    '''
+    members' names over their star columns, cut short to the width of the stars
+    '''
+    for index, member in enumerate(members):
+        name = member
+        while name and font.getlength(name) > STAR_W * 5:
+            name = name[:-1]
+        text_drawer.text((x + index * (STAR_W * 5 + MEMBER_COLUMN_GAP), y), name, font=font, fill=font_color)
 
 def build_movie_text(movie_cell: "MovieCell") -> str:
     mv_text = f' - {movie_cell.title} - {movie_cell.director}'
@@ -117,6 +152,67 @@ def get_text_dimensions(text_string: str, font: ImageFont.truetype):
 
     return (text_width, text_height)
 
+@lru_cache(maxsize=None)
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, size, encoding='utf-8')
+
+@lru_cache(maxsize=None)
+def load_star_icons() -> tuple[Image.Image]:
+    star_icons = tuple(Image.open(ICONS_DIR + '/' + fp) for fp in ['full_rz.png', 'half_rz.png', 'empty_rz.png'])
+    for icon in star_icons:
+        icon.load()
+    return star_icons
+
+def build_info_tile(movie_cell: "MovieCell", font: ImageFont.FreeTypeFont, font_color: tuple, star_icons: tuple) -> tuple[Image.Image, int, int]:
+    '''
+    renders a movie's info line (rating stars then ` - title - director`) onto a tile the same color as the background.
+    pixels that stayed background color are made transparent so overlapping lines paste like they were drawn in place.
+    returns (tile, text width used for sizing the info box, y offset of the tile relative to the line's text origin)
+    '''
+    text = build_movie_text(movie_cell)
+    text_x = get_rating_width(movie_cell)
+    star_y = STAR_H // 2 - 1
+    left, top, right, bottom = font.getbbox(text)
+    y_offset = min(0, top)
+
+    tile = Image.new(
+        mode='RGBA',
+        size=(max(text_x + right, text_x), max(bottom, star_y + STAR_H) - y_offset),
+        color=BACKGROUND_COLOR + (255,))
+    ImageDraw.Draw(tile).text((text_x, -y_offset), text, font=font, fill=font_color)
+    rating_image = build_member_ratings_image(movie_cell, *star_icons) if movie_cell.member_ratings else build_rating_image(movie_cell, *star_icons)
+    trans_paste(rating_image, tile, alpha=1.0, box=(0, star_y - y_offset))
+
+    background = Image.new(mode='RGB', size=tile.size, color=BACKGROUND_COLOR)
+    mask = ImageChops.difference(tile.convert('RGB'), background).convert('L').point(lambda v: 255 if v else 0)
+    tile.putalpha(mask)
+
+    # the info box already leaves room for one set of stars, group mosaics need room for the rest
+    return (tile, get_text_dimensions(text, font)[0] + text_x - STAR_W * 5, y_offset)
+
+def get_info_tile(movie_cell: "MovieCell", font_size: int, font_color: tuple) -> tuple[Image.Image, int, int]:
+    key = (movie_cell.title, movie_cell.director, movie_cell.rating, movie_cell.member_ratings, FONT_PATH, font_size, font_color, BACKGROUND_COLOR)
+    tile = TILE_CACHE.get(key)
+    if tile is None:
+        tile = build_info_tile(movie_cell, load_font(FONT_PATH, font_size), font_color, load_star_icons())
+        TILE_CACHE.put(key, tile)
+    return tile
+
+def build_username_str(username: str, last_watch_date: datetime.datetime, end_date: datetime.datetime = None) -> str:
+    my_date = end_date or datetime.datetime.now()
+    username_str = f'{username} - '
+    if last_watch_date:
+        username_str = f'{username_str}{last_watch_date.strftime("%B")} {last_watch_date.strftime("%Y")} - {my_date.strftime("%B")} {my_date.strftime("%Y")}'		
+    else:
+        username_str = f'{username_str}{my_date.strftime("%B")} {my_date.strftime("%Y")}'
+    return username_str
+
+def get_group_label(members: list[str]) -> str:
+    # what goes where the username would on a group mosaic
+    if len(members) <= 3:
+        return ' & '.join(members)
+    return f'{members[0]}, {members[1]} & {len(members) - 2} more'
+
 def load_config(path: str) -> list:
 	config: dict
 	with open(path, 'r') as f:
@@ -132,86 +228,63 @@ def load_config(path: str) -> list:
 			)
 
 
-def build(movie_cells: list["MovieCell"], username: str, config_path: str, last_watch_date: datetime.datetime, db: sqlite3.Connection) -> Image.Image:
+def build(movie_cells: list["MovieCell"], username: str, config_path: str, last_watch_date: datetime.datetime, db: sqlite3.Connection, metrics: TaskMetrics = None, members: list[str] = None) -> Image.Image:
     '''
     Takes in list of MovieCell's and generates MovieMosaic image
+    members is given for group mosaics, their names head the rating columns in a band under the username
     '''
     # loading config file
     image_gap, info_box_width, \
 	username_box_height, movie_info_font_size, \
 	username_font_size, font_color, thumbnail_size \
 	= load_config(config_path)
+    font_color = tuple(font_color)
 
 
-    # create dynamically sized grid
-    grid_width, grid_height = get_grid_size(len(movie_cells))
-
     # creating thumbnails
     thumbnails = list(map(partial(build_thumbnail, db=db), movie_cells))
     thumb_width, thumb_height = thumbnails[0].size
     
+    # defining fonts
+    username_font = load_font(FONT_PATH, username_font_size)
 
-    star_icons = [Image.open(ICONS_DIR + '/' + fp) for fp in ['full_rz.png', 'half_rz.png', 'empty_rz.png']]
-    
-    build_rating_image(movie_cells[0], *star_icons)
+    # info lines come out of the tile cache, only films it hasn't seen with this rating get rendered
+    stats_before = TILE_CACHE.stats()
+    info_tiles = [get_info_tile(cell, movie_info_font_size, font_color) for cell in movie_cells]
+    if metrics:
+        stats_after = TILE_CACHE.stats()
+        metrics.count('tile_hits', stats_after['hits'] - stats_before['hits'])
+        metrics.count('tile_misses', stats_after['misses'] - stats_before['misses'])
 
-    
-    # defining fonts
-    info_font = ImageFont.truetype('./font/JuliaMono-Bold.ttf', movie_info_font_size, encoding='utf-8')
-    username_font = ImageFont.truetype('./font/JuliaMono-Bold.ttf', username_font_size, encoding='utf-8')
+    # find max width of movie text
+    info_box_width = max(info_box_width, max(text_width for _, text_width, _ in info_tiles) + image_gap)
 
-    # load all movie_texts into a list then find max width
-    movie_text = [build_movie_text(movie_cells[i]) for i in range(len(movie_cells))]
-    # get_text_dimensions(username_str, info_font)
-    max_movie_text = max(movie_text, key=lambda x: get_text_dimensions(x, info_font)[0])
-    # print(max_movie_text)
-    info_box_width = max(info_box_width, get_text_dimensions(max_movie_text, info_font)[0] + image_gap)
+    # grid shape and where every thumbnail and info line goes
+    header_height = username_box_height + (INFO_LINE_HEIGHT if members else 0)
+    layout = plan_grid(len(movie_cells), (thumb_width, thumb_height), image_gap, header_height, info_box_width)
 
     # create background
-    bg = build_background(thumb_width, thumb_height, grid_width, grid_height,
-						  info_box_width, username_box_height, image_gap)
+    bg = build_background(layout.canvas_size)
     text_drawer = ImageDraw.Draw(bg)
 
     # writing username and date to image
-    my_date = datetime.datetime.now()
-    username_str = f'{username} - '
-    if last_watch_date:
-        username_str = f'{username_str}{last_watch_date.strftime("%B")} {last_watch_date.strftime("%Y")} - {my_date.strftime("%B")} {my_date.strftime("%Y")}'		
-    else:
-        username_str = f'{username_str}{my_date.strftime("%B")} {my_date.strftime("%Y")}'
-    
+    username_str = build_username_str(get_group_label(members) if members else username, last_watch_date)
     username_width, username_height = get_text_dimensions(username_str, username_font)
     username_x = bg._size[0]//2 - username_width//2
     username_y = username_box_height//2 - username_height//2
 
-    text_drawer.text((username_x, username_y), username_str, font=username_font,fill=tuple(font_color))
-
-    cell_index = 0
-	
-    # paste thumbnails, text, and stars to background
-    for j in range(grid_height):
-        for i in range(grid_width):
-            if cell_index >= len(movie_cells): break
-
-            # thumbnails
-            im_x = i * thumb_width + image_gap * (i+1)
-            im_y = j * thumb_height + image_gap * (j+1) + username_box_height
-            bg.paste(thumbnails[cell_index], (im_x, im_y))
-
-            # text
-            txt_x = grid_width * thumb_width + image_gap * (grid_width+1)
-            txt_y = (j % grid_width) * thumb_height + image_gap * ((j % grid_width) + 1) + (i*20) + username_box_height
-
-            txt_str = movie_text[cell_index]
-
-            text_drawer.text((txt_x + (STAR_W*5), txt_y), txt_str, font=info_font, fill=tuple(font_color))
+    text_drawer.text((username_x, username_y), username_str, font=username_font,fill=font_color)
 
-            # bg.paste(build_rating_image(movie_cells[cell_index], *star_icons), (txt_x, txt_y + 5))
+    if members:
+        draw_member_columns(text_drawer, members, layout.info_lines[0][0], username_box_height,
+                            load_font(FONT_PATH, movie_info_font_size), font_color)
 
-            # bg.paste(star, (im_x, im_y + star.size[1] - star.size[1]))
+    # paste thumbnails and info tiles (stars + text) to background
+    for cell_index, thumbnail in enumerate(thumbnails):
+        bg.paste(thumbnail, layout.thumbnails[cell_index])
 
-            # bg = trans_paste(star, bg, alpha=1.0, box=(im_x, im_y + star.size[1] - star.size[1]))
-            bg = trans_paste(build_rating_image(movie_cells[cell_index], *star_icons), bg, alpha=1.0, box=(txt_x, txt_y+(STAR_H//2) - 1))
-            cell_index += 1
+        txt_x, txt_y = layout.info_lines[cell_index]
+        tile, _, y_offset = info_tiles[cell_index]
+        bg.paste(tile, (txt_x, txt_y + y_offset), tile)
 
     return bg
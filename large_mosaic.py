@@ -0,0 +1,183 @@
+"""
+Large-mosaic mode (year in review, custom date ranges) for grids of hundreds of films.
+image_builder.build keeps every thumbnail and the whole RGBA canvas in memory, which doesn't fit on small hosts
+once a mosaic gets big. build_striped lays the grid out first and then renders it one grid row (stripe) at a time,
+loading only that row's thumbnails and streaming each stripe into encoder.PngStreamWriter.
+The thumbnail scale is picked so the estimated peak memory stays under "max_rss_mb" in config.json.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+from typing import BinaryIO
+from PIL import Image, ImageDraw
+from grid_shape import get_grid_size, plan_grid
+from image_builder import (load_config, load_font, build_thumbnail, build_movie_text, build_username_str,
+                           get_info_tile, get_text_dimensions, get_rating_width, get_group_label, draw_member_columns,
+                           FONT_PATH, BACKGROUND_COLOR, INFO_LINE_HEIGHT, STAR_W)
+from encoder import PngStreamWriter
+from metrics import TaskMetrics
+
+DEFAULT_LARGE_MOSAIC = {'min_films': 60, 'max_rss_mb': 256, 'thumbnail_scales': [1, 0.75, 0.5, 0.375, 0.25]}
+PNG_RATIO = 0.6 # compressed png size / raw RGB size for mosaics, used when the png is built in memory
+STRIPE_COPIES = 4 # stripe, shifted copy, filtered bytes and filtered rows all exist while a stripe is encoded
+
+def load_large_mosaic_config(path: str) -> dict:
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return {**DEFAULT_LARGE_MOSAIC, **config.get('large_mosaic', {})}
+
+def use_striped(film_count: int, large_config: dict) -> bool:
+    return film_count >= large_config['min_films']
+
+def get_current_rss() -> int:
+    '''
+    resident memory of this process in bytes, 0 where /proc isn't available
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+def estimate_peak_bytes(canvas_size: tuple, thumb_size: tuple, grid_width: int, source_size: tuple,
+                        stripe_height: int, in_memory: bool) -> int:
+    canvas_width, canvas_height = canvas_size
+    stripe = canvas_width * stripe_height * 3 * STRIPE_COPIES
+    # a row's decoded posters and their resized copies
+    thumbnails = grid_width * (source_size[0] * source_size[1] + thumb_size[0] * thumb_size[1]) * 4
+    output = canvas_width * canvas_height * 3 * PNG_RATIO if in_memory else 0
+    return int(stripe + thumbnails + output)
+
+def plan_layout(film_count: int, thumbnail_size: tuple, image_gap: int, username_box_height: int,
+                info_box_width: int, large_config: dict, in_memory: bool) -> dict:
+    '''
+    picks the largest thumbnail scale whose estimated peak memory fits in max_rss_mb (minus what the process
+    already uses). info lines are only drawn when a row's lines fit next to its thumbnails
+    '''
+    grid_width, grid_height = get_grid_size(film_count)
+    budget = large_config['max_rss_mb'] * 1024 * 1024 - get_current_rss()
+
+    for scale in sorted(large_config['thumbnail_scales'], reverse=True):
+        thumb_width, thumb_height = round(thumbnail_size[0] * scale), round(thumbnail_size[1] * scale)
+        show_info = grid_width * INFO_LINE_HEIGHT <= thumb_height
+        text_width = info_box_width if show_info else 0
+        canvas_size = plan_grid(film_count, (thumb_width, thumb_height), image_gap, username_box_height, text_width).canvas_size
+        stripe_height = max(thumb_height + image_gap, username_box_height)
+        peak_bytes = estimate_peak_bytes(canvas_size, (thumb_width, thumb_height), grid_width, thumbnail_size,
+                                         stripe_height, in_memory)
+        if peak_bytes <= budget:
+            break
+
+    return {
+        'grid_size': (grid_width, grid_height),
+        'thumb_size': (thumb_width, thumb_height),
+        'canvas_size': canvas_size,
+        'show_info': show_info,
+        'peak_bytes': peak_bytes,
+    }
+
+def render_header(canvas_width: int, username_box_height: int, username_str: str, username_font, font_color: tuple) -> Image.Image:
+    stripe = Image.new(mode='RGB', size=(canvas_width, username_box_height), color=BACKGROUND_COLOR)
+    username_width, username_height = get_text_dimensions(username_str, username_font)
+    username_x = canvas_width // 2 - username_width // 2
+    username_y = username_box_height // 2 - username_height // 2
+    ImageDraw.Draw(stripe).text((username_x, username_y), username_str, font=username_font, fill=font_color)
+    return stripe
+
+def render_member_band(canvas_width: int, members: list[str], x: int, font, font_color: tuple) -> Image.Image:
+    # group mosaics: members' names over their rating columns, under the username
+    stripe = Image.new(mode='RGB', size=(canvas_width, INFO_LINE_HEIGHT), color=BACKGROUND_COLOR)
+    draw_member_columns(ImageDraw.Draw(stripe), members, x, 0, font, font_color)
+    return stripe
+
+def render_row(row_cells: list["MovieCell"], layout: dict, image_gap: int, info_font_size: int, font_color: tuple,
+               db: sqlite3.Connection) -> Image.Image:
+    '''
+    renders one grid row with the gap above it, thumbnails are decoded and dropped within the row
+    '''
+    grid_width, _ = layout['grid_size']
+    thumb_width, thumb_height = layout['thumb_size']
+    stripe = Image.new(mode='RGB', size=(layout['canvas_size'][0], thumb_height + image_gap), color=BACKGROUND_COLOR)
+    txt_x = grid_width * thumb_width + image_gap * (grid_width + 1)
+
+    for i, cell in enumerate(row_cells):
+        with build_thumbnail(cell, db) as thumbnail:
+            if thumbnail.size != (thumb_width, thumb_height):
+                thumbnail = thumbnail.resize((thumb_width, thumb_height), Image.LANCZOS)
+            stripe.paste(thumbnail.convert('RGB'), (i * thumb_width + image_gap * (i + 1), image_gap))
+
+        if layout['show_info']:
+            tile, _, y_offset = get_info_tile(cell, info_font_size, font_color)
+            stripe.paste(tile, (txt_x, image_gap + i * INFO_LINE_HEIGHT + y_offset), tile)
+
+    return stripe
+
+def build_striped(movie_cells: list["MovieCell"], username: str, config_path: str, last_watch_date: datetime.datetime,
+                  db: sqlite3.Connection, out: BinaryIO, metrics: TaskMetrics = None, end_date: datetime.datetime = None,
+                  in_memory: bool = True, preview_width: int = None, members: list[str] = None) -> Image.Image:
+    '''
+    renders the mosaic for movie_cells stripe by stripe and writes it to `out` as a png.
+    in_memory says whether `out` is a buffer (its size counts against the memory ceiling) or a file.
+    members is given for group mosaics (see image_builder.build).
+    returns a downscaled copy at most preview_width wide built from the same stripes, None without preview_width
+    '''
+    metrics = metrics or TaskMetrics(None)
+    image_gap, info_box_width, \
+    username_box_height, movie_info_font_size, \
+    username_font_size, font_color, thumbnail_size \
+    = load_config(config_path)
+    font_color = tuple(font_color)
+    large_config = load_large_mosaic_config(config_path)
+
+    # the info box is sized from text widths alone, tiles are only rendered for the stripe that uses them
+    info_font = load_font(FONT_PATH, movie_info_font_size)
+    info_box_width = max(info_box_width, max(
+        get_text_dimensions(build_movie_text(cell), info_font)[0] + get_rating_width(cell) - STAR_W * 5 for cell in movie_cells) + image_gap)
+
+    header_height = username_box_height + (INFO_LINE_HEIGHT if members else 0)
+    layout = plan_layout(len(movie_cells), tuple(thumbnail_size), image_gap, header_height,
+                         info_box_width, large_config, in_memory)
+    grid_width, grid_height = layout['grid_size']
+    canvas_width, canvas_height = layout['canvas_size']
+    metrics.count('estimated_peak_bytes', layout['peak_bytes'])
+    metrics.count('thumbnail_width', layout['thumb_size'][0])
+
+    preview, preview_scale, preview_y = None, None, 0
+    if preview_width:
+        preview_width = min(preview_width, canvas_width)
+        preview_scale = preview_width / canvas_width
+        preview = Image.new(mode='RGB', size=(preview_width, round(canvas_height * preview_scale)), color=BACKGROUND_COLOR)
+
+    writer = PngStreamWriter(out, canvas_width, canvas_height, large_config.get('compress_level', 6))
+
+    def emit(stripe: Image.Image, y: int) -> None:
+        writer.write_stripe(stripe)
+        metrics.count('stripes')
+        if preview:
+            top, bottom = round(y * preview_scale), round((y + stripe.height) * preview_scale)
+            if bottom > top:
+                preview.paste(stripe.resize((preview.width, bottom - top), Image.LANCZOS), (0, top))
+
+    username_font = load_font(FONT_PATH, username_font_size)
+    username_str = build_username_str(get_group_label(members) if members else username, last_watch_date, end_date)
+    emit(render_header(canvas_width, username_box_height, username_str, username_font, font_color), 0)
+    if members:
+        # without info lines there are no rating columns to name
+        names = members if layout['show_info'] else []
+        txt_x = grid_width * layout['thumb_size'][0] + image_gap * (grid_width + 1)
+        emit(render_member_band(canvas_width, names, txt_x, info_font, font_color), username_box_height)
+
+    y = header_height
+    for j in range(grid_height):
+        row_cells = movie_cells[j * grid_width:(j + 1) * grid_width]
+        stripe = render_row(row_cells, layout, image_gap, movie_info_font_size, font_color, db)
+        emit(stripe, y)
+        y += stripe.height
+
+    # gap below the last row
+    emit(Image.new(mode='RGB', size=(canvas_width, canvas_height - y), color=BACKGROUND_COLOR), y)
+    writer.close()
+
+    return preview
@@ -0,0 +1,270 @@
+'''
+per-task stage timings and counters.
+worker.py records a TaskMetrics for every task and pushes it to the TASK_METRICS table,
+server.py renders the aggregates at /metrics in prometheus text format.
+
+rows in 'TASK_METRICS' table are structured like this
+| ID: str | STATUS: str | FINISHED_ON: str(datetime) | TOTAL_SECONDS: float | STAGES: str(json) | COUNTS: str(json) |
+database_janitor.py prunes them, so the counters and histograms in /metrics are running totals kept in 'METRIC_TOTALS'
+| NAME: str | LABELS: str(prometheus labels) | VALUE: float |
+written in the same transaction as the task's row. gauges and quantiles are computed over the last QUANTILE_WINDOW tasks
+'''
+
+import json
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import monotonic
+from db_cache import get_cache_report
+from rate_limiter import get_budgets
+
+# stages in the order the worker runs them
+STAGES = ['rss_fetch', 'rss_parse', 'tmdb_resolve', 'poster_download', 'compositing', 'encode', 'result_insert']
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+QUANTILES = [0.5, 0.9, 0.99]
+QUANTILE_WINDOW = 500 # quantiles are computed over this many recent tasks
+RATE_WINDOW_MINUTES = 5
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class TaskMetrics:
+    '''
+    collects monotonic stage durations and counters for a single task
+    '''
+    task_id: str
+    stages: dict
+    counts: dict
+
+    def __init__(self, task_id: str) -> None:
+        self.task_id = task_id
+        self.stages = {}
+        self.counts = {}
+        self._start = monotonic()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + monotonic() - start
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def total_seconds(self) -> float:
+        return monotonic() - self._start
+
+    def push(self, db: sqlite3.Connection, status: str) -> None:
+        add_totals(db, self.stages, self.counts)
+        db.execute(
+            """
+            INSERT INTO TASK_METRICS(id, status, finished_on, total_seconds, stages, counts)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (self.task_id, status, datetime.now().strftime(DATE_FORMAT),
+             self.total_seconds(), json.dumps(self.stages), json.dumps(self.counts))
+        )
+        db.commit()
+
+    def __str__(self) -> str:
+        stages = ' '.join(f'{name}={seconds:.2f}s' for name, seconds in self.stages.items())
+        return f'{self.task_id} total={self.total_seconds():.2f}s {stages} {self.counts}'
+
+
+def add_totals(db: sqlite3.Connection, stages: dict, counts: dict) -> None:
+    '''
+    adds a task's stage timings and counters to the METRIC_TOTALS running totals, the caller commits
+    '''
+    totals = []
+    for stage, seconds in stages.items():
+        totals.extend(('stage_seconds_bucket', f'stage="{stage}",le="{bucket}"', 1) for bucket in BUCKETS if seconds <= bucket)
+        totals.append(('stage_seconds_bucket', f'stage="{stage}",le="+Inf"', 1))
+        totals.append(('stage_seconds_sum', f'stage="{stage}"', seconds))
+        totals.append(('stage_seconds_count', f'stage="{stage}"', 1))
+    totals.extend(('task_count_total', f'name="{name}"', n) for name, n in counts.items())
+    db.executemany(
+        """
+        INSERT INTO METRIC_TOTALS(NAME, LABELS, VALUE) VALUES (?, ?, ?)
+        ON CONFLICT(NAME, LABELS) DO UPDATE SET VALUE = VALUE + excluded.VALUE
+        """,
+        totals)
+
+def get_totals(db: sqlite3.Connection) -> dict:
+    '''
+    {name: {labels: value}} of every running total
+    '''
+    cur = db.execute('SELECT NAME, LABELS, VALUE FROM METRIC_TOTALS')
+    totals = {}
+    for name, labels, value in cur.fetchall():
+        totals.setdefault(name, {})[labels] = value
+    cur.close()
+    return totals
+
+def quantile(values: list, q: float) -> float:
+    '''
+    nearest-rank quantile of an already sorted list
+    '''
+    if not values:
+        return float('nan')
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+def get_recent_metrics(db: sqlite3.Connection, limit: int = -1) -> list:
+    '''
+    newest first. TASK_METRICS is pruned by database_janitor.py so the default of no limit stays bounded
+    '''
+    cur = db.execute(
+        """
+        SELECT STATUS, TOTAL_SECONDS, STAGES, COUNTS FROM TASK_METRICS
+        ORDER BY FINISHED_ON DESC
+        LIMIT ?
+        """, (limit,))
+    rows = cur.fetchall()
+    cur.close()
+    return [(status, total, json.loads(stages), json.loads(counts)) for status, total, stages, counts in rows]
+
+def get_typical_task_seconds(db: sqlite3.Connection, limit: int = 50) -> float:
+    '''
+    median total time of the last `limit` completed tasks, None if there aren't any yet
+    '''
+    cur = db.execute(
+        """
+        SELECT TOTAL_SECONDS FROM TASK_METRICS
+        WHERE STATUS = 'COMPLETE'
+        ORDER BY FINISHED_ON DESC
+        LIMIT ?
+        """, (limit,))
+    totals = sorted(row[0] for row in cur.fetchall())
+    cur.close()
+    if not totals:
+        return None
+    return quantile(totals, 0.5)
+
+def get_queue_stats(db: sqlite3.Connection) -> tuple[int, dict]:
+    '''
+    returns (queue depth, {status: age in seconds of the oldest task with that status})
+    '''
+    cur = db.execute("SELECT COUNT(*) FROM TASKS WHERE STATUS IN ('READY', 'QUEUED')")
+    depth = cur.fetchone()[0]
+    cur.execute(
+        """
+        SELECT STATUS, MIN(CREATED_ON) FROM TASKS
+        WHERE STATUS IN ('READY', 'QUEUED') AND CREATED_ON IS NOT NULL
+        GROUP BY STATUS
+        """)
+    now = datetime.now()
+    oldest = {
+        status: (now - datetime.strptime(created_on, DATE_FORMAT)).total_seconds()
+        for status, created_on in cur.fetchall()
+    }
+    cur.close()
+    return depth, oldest
+
+def get_tasks_per_minute(db: sqlite3.Connection) -> float:
+    since = (datetime.now() - timedelta(minutes=RATE_WINDOW_MINUTES)).strftime(DATE_FORMAT)
+    cur = db.execute("SELECT COUNT(*) FROM TASK_METRICS WHERE FINISHED_ON >= ?", (since,))
+    count = cur.fetchone()[0]
+    cur.close()
+    return count / RATE_WINDOW_MINUTES
+
+def render_histogram(lines: list, name: str, labels: str, totals: dict) -> None:
+    # totals are METRIC_TOTALS rows, a bucket no task fell into has no row yet
+    buckets = totals.get(f'{name}_bucket', {})
+    for bucket in [*BUCKETS, '+Inf']:
+        bucket_labels = f'{labels},le="{bucket}"'
+        lines.append(f'moviemosaic_{name}_bucket{{{bucket_labels}}} {buckets.get(bucket_labels, 0):.0f}')
+    lines.append(f'moviemosaic_{name}_sum{{{labels}}} {totals.get(f"{name}_sum", {}).get(labels, 0):.6f}')
+    lines.append(f'moviemosaic_{name}_count{{{labels}}} {totals.get(f"{name}_count", {}).get(labels, 0):.0f}')
+
+def render_cache_metrics(lines: list, db: sqlite3.Connection) -> None:
+    report = get_cache_report(db, top_n=0)
+
+    lines.append('# HELP moviemosaic_poster_cache_total Poster cache (DB_CACHE) events since the database was created.')
+    lines.append('# TYPE moviemosaic_poster_cache_total counter')
+    for name, value in report['stats'].items():
+        lines.append(f'moviemosaic_poster_cache_total{{event="{name}"}} {value}')
+
+    lines.append('# HELP moviemosaic_poster_cache_entries Posters in the cache by how long ago they were last used.')
+    lines.append('# TYPE moviemosaic_poster_cache_entries gauge')
+    for bucket, rows in report['last_used'].items():
+        lines.append(f'moviemosaic_poster_cache_entries{{last_used="{bucket}"}} {rows}')
+
+    lines.append('# HELP moviemosaic_poster_cache_bytes Bytes of poster data in the cache.')
+    lines.append('# TYPE moviemosaic_poster_cache_bytes gauge')
+    lines.append(f'moviemosaic_poster_cache_bytes {report["bytes"]}')
+
+def render_prometheus(db: sqlite3.Connection) -> str:
+    '''
+    renders queue and task aggregates in prometheus text exposition format
+    '''
+    rows = get_recent_metrics(db, QUANTILE_WINDOW)
+    running_totals = get_totals(db)
+    depth, oldest = get_queue_stats(db)
+    lines = []
+
+    lines.append('# HELP moviemosaic_queue_depth Tasks waiting for the worker (READY or QUEUED).')
+    lines.append('# TYPE moviemosaic_queue_depth gauge')
+    lines.append(f'moviemosaic_queue_depth {depth}')
+
+    lines.append('# HELP moviemosaic_oldest_task_age_seconds Age of the oldest waiting task per status.')
+    lines.append('# TYPE moviemosaic_oldest_task_age_seconds gauge')
+    for status in ['READY', 'QUEUED']:
+        lines.append(f'moviemosaic_oldest_task_age_seconds{{status="{status}"}} {oldest.get(status, 0):.1f}')
+
+    lines.append(f'# HELP moviemosaic_tasks_per_minute Tasks finished per minute over the last {RATE_WINDOW_MINUTES} minutes.')
+    lines.append('# TYPE moviemosaic_tasks_per_minute gauge')
+    lines.append(f'moviemosaic_tasks_per_minute {get_tasks_per_minute(db):.2f}')
+
+    lines.append(f'# HELP moviemosaic_tasks The last {QUANTILE_WINDOW} tasks by final status.')
+    lines.append('# TYPE moviemosaic_tasks gauge')
+    for status in sorted({row[0] for row in rows}):
+        lines.append(f'moviemosaic_tasks{{status="{status}"}} {sum(1 for row in rows if row[0] == status)}')
+
+    lines.append('# HELP moviemosaic_stage_seconds Time spent in each worker stage.')
+    lines.append('# TYPE moviemosaic_stage_seconds histogram')
+    stage_labels = running_totals.get('stage_seconds_count', {})
+    stage_names = STAGES + sorted({labels[len('stage="'):-1] for labels in stage_labels} - set(STAGES))
+    for stage in stage_names:
+        if f'stage="{stage}"' in stage_labels:
+            render_histogram(lines, 'stage_seconds', f'stage="{stage}"', running_totals)
+
+    lines.append('# HELP moviemosaic_task_seconds Total task time quantiles over recent tasks.')
+    lines.append('# TYPE moviemosaic_task_seconds summary')
+    totals = sorted(row[1] for row in rows[:QUANTILE_WINDOW])
+    for q in QUANTILES:
+        lines.append(f'moviemosaic_task_seconds{{quantile="{q}"}} {quantile(totals, q):.6f}')
+    lines.append(f'moviemosaic_task_seconds_sum {sum(totals):.6f}')
+    lines.append(f'moviemosaic_task_seconds_count {len(totals)}')
+
+    # estimated_ms is counted by scheduler.py when the task is taken off the queue
+    ratios = sorted(row[1] * 1000 / row[3]['estimated_ms'] for row in rows[:QUANTILE_WINDOW] if row[3].get('estimated_ms'))
+    lines.append('# HELP moviemosaic_estimate_ratio Actual over estimated task time quantiles, 1 is a perfect estimate.')
+    lines.append('# TYPE moviemosaic_estimate_ratio summary')
+    for q in QUANTILES:
+        lines.append(f'moviemosaic_estimate_ratio{{quantile="{q}"}} {quantile(ratios, q):.6f}')
+    lines.append(f'moviemosaic_estimate_ratio_sum {sum(ratios):.6f}')
+    lines.append(f'moviemosaic_estimate_ratio_count {len(ratios)}')
+
+    render_cache_metrics(lines, db)
+
+    budgets = get_budgets(db)
+    lines.append('# HELP moviemosaic_rate_limit_tokens Requests each tmdb rate limit bucket can make right now.')
+    lines.append('# TYPE moviemosaic_rate_limit_tokens gauge')
+    for name, tokens, _, _ in budgets:
+        lines.append(f'moviemosaic_rate_limit_tokens{{bucket="{name}"}} {tokens:.2f}')
+    lines.append('# HELP moviemosaic_rate_limit_blocked_seconds Time left before a bucket throttled by a 429 is usable again.')
+    lines.append('# TYPE moviemosaic_rate_limit_blocked_seconds gauge')
+    for name, _, blocked, _ in budgets:
+        lines.append(f'moviemosaic_rate_limit_blocked_seconds{{bucket="{name}"}} {blocked:.2f}')
+    lines.append('# HELP moviemosaic_rate_limit_throttled_total 429 responses from tmdb per bucket.')
+    lines.append('# TYPE moviemosaic_rate_limit_throttled_total counter')
+    for name, _, _, throttled in budgets:
+        lines.append(f'moviemosaic_rate_limit_throttled_total{{bucket="{name}"}} {throttled}')
+
+    lines.append('# HELP moviemosaic_task_count_total Per-task counters summed over every task.')
+    lines.append('# TYPE moviemosaic_task_count_total counter')
+    for labels, value in sorted(running_totals.get('task_count_total', {}).items()):
+        lines.append(f'moviemosaic_task_count_total{{{labels}}} {value:.0f}')
+
+    return '\n'.join(lines) + '\n'
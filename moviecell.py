@@ -8,4 +8,6 @@ class MovieCell:
     title: str
     director: str
     rating: int
-    im_path: str
\ No newline at end of file
+    im_path: str
+    # group mosaics: each member's rating in column order, None where the member didn't log the film
+    member_ratings: tuple = None
\ No newline at end of file
@@ -0,0 +1,67 @@
+'''
+negativeCache class:
+remembers lookups that failed in a way that will fail the same way again for a while, so typos and bots don't cost
+a letterboxd or tmdb request every time. each kind of failure has its own ttl, set in seconds under "negative_cache"
+in config.json and kept much shorter than the positive caches (accounts get created, posters get uploaded).
+
+kinds stored here:
+username - letterboxd has no rss feed for the user, checked by server.py before a task is queued and by the worker
+
+tmdb lookups that come back empty are kept in TMDB_CACHE itself and expire with these ttls (see tmdbCache):
+tmdb_not_found - tmdb answered 404 for the id
+tmdb_no_poster - the film has no poster on tmdb
+tmdb_no_director - the film has no Director credit
+
+rows in 'NEGATIVE_CACHE' table are structured like this | KIND: str | KEY: str | CREATED_ON: str(datetime) |
+'''
+
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_NEGATIVE_TTLS = {'username': 3600, 'tmdb_not_found': 86400, 'tmdb_no_poster': 86400, 'tmdb_no_director': 3 * 86400}
+
+def load_negative_ttls(path: str = 'config.json') -> dict:
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return {**DEFAULT_NEGATIVE_TTLS, **config.get('negative_cache', {})}
+
+
+class negativeCache:
+    _db: sqlite3.Connection
+    _ttls: dict
+    def __init__(self, db: sqlite3.Connection, ttls: dict = None) -> None:
+        self._db = db
+        self._ttls = ttls or load_negative_ttls()
+
+    def lookup(self, kind: str, key: str) -> bool:
+        '''
+        true if key failed as kind within the kind's ttl
+        '''
+        oldest = (datetime.now() - timedelta(seconds=self._ttls[kind])).strftime(DATE_FORMAT)
+        cur = self._db.execute(
+            'SELECT 1 FROM NEGATIVE_CACHE WHERE KIND = ? AND KEY = ? AND CREATED_ON >= ?', (kind, key, oldest))
+        data = cur.fetchone()
+        cur.close()
+        return data is not None
+
+    def push(self, kind: str, key: str) -> None:
+        self._db.execute(
+            """
+            INSERT OR REPLACE INTO NEGATIVE_CACHE(KIND, KEY, CREATED_ON)
+            VALUES (?, ?, ?)
+            """,
+            (kind, key, datetime.now().strftime(DATE_FORMAT)))
+        self._db.commit()
+
+    def remove_expired(self) -> int:
+        '''
+        removes rows past their kind's ttl, returns how many were removed
+        '''
+        removed = 0
+        for kind, ttl in self._ttls.items():
+            oldest = (datetime.now() - timedelta(seconds=ttl)).strftime(DATE_FORMAT)
+            removed += self._db.execute('DELETE FROM NEGATIVE_CACHE WHERE KIND = ? AND CREATED_ON < ?', (kind, oldest)).rowcount
+        self._db.commit()
+        return removed
@@ -0,0 +1,97 @@
+'''
+how resized posters are stored in DB_CACHE. "poster_storage" in config.json picks the codec new posters are
+written with (webp, jpeg, png or raw pixels) and its Pillow save options. the codec is recorded in each row's
+CODEC column so rows written with different settings can be read side by side. NULL is a row from before
+CODEC existed, Pillow detects those from their bytes.
+raw rows are stored as 'raw:{mode}:{width}x{height}', they skip decoding entirely at the cost of size.
+
+transcode_cache() (python server_utils.py cache transcode [codec]) rewrites existing rows in the configured codec
+'''
+
+import sqlite3
+from functools import lru_cache
+from io import BytesIO
+from PIL import Image
+from encoder import load_config, encode, can_encode, drop_unused_alpha
+
+CODECS = ['webp', 'jpeg', 'png', 'raw']
+DEFAULT_POSTER_STORAGE = {'codec': 'webp', 'webp': {'quality': 85, 'method': 4}}
+TRANSCODE_BATCH_SIZE = 200
+
+@lru_cache(maxsize=None)
+def load_poster_storage(path: str = 'config.json', codec: str = None) -> tuple[str, dict]:
+    '''
+    (codec, save options) for new posters, or the configured save options of another codec
+    '''
+    storage = {**DEFAULT_POSTER_STORAGE, **load_config(path).get('poster_storage', {})}
+    codec = codec or storage['codec']
+    if codec not in CODECS:
+        raise ValueError(f'unknown poster codec `{codec}`, expected one of {CODECS}')
+    return (codec, storage.get(codec, {}))
+
+def encode_poster(image: Image.Image, codec: str = None, options: dict = None) -> tuple[bytes, str]:
+    '''
+    returns (blob, CODEC value), defaults to the configured codec.
+    posters that really use transparency are kept as png when the codec is jpeg
+    '''
+    if codec is None:
+        codec, options = load_poster_storage()
+    options = options or {}
+    image = drop_unused_alpha(image)
+
+    if codec == 'raw':
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        return (image.tobytes(), f'raw:{image.mode}:{image.width}x{image.height}')
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    if not can_encode(codec) or (codec == 'jpeg' and image.mode == 'RGBA'):
+        codec, options = 'png', {}
+    return (encode(image, codec, options), codec)
+
+def decode_poster(blob: bytes, codec: str = None) -> Image.Image:
+    if codec and codec.startswith('raw:'):
+        _, mode, size = codec.split(':')
+        width, height = size.split('x')
+        return Image.frombytes(mode, (int(width), int(height)), blob)
+    return Image.open(BytesIO(blob))
+
+def codec_name(codec: str) -> str:
+    # CODEC values -> CODECS entries, rows from before CODEC existed count as 'unknown'
+    if not codec:
+        return 'unknown'
+    return codec.split(':')[0]
+
+def transcode_cache(db: sqlite3.Connection, codec: str = None) -> tuple[int, int, int]:
+    '''
+    re-encodes every DB_CACHE row not already stored as codec (the configured one by default).
+    rows are only ever transcoded once per codec so lossy codecs don't lose quality on repeat runs.
+    returns (rows transcoded, bytes before, bytes after)
+    '''
+    codec, options = load_poster_storage(codec=codec)
+
+    cur = db.execute('SELECT FILENAME, CODEC FROM DB_CACHE')
+    pending = [filename for filename, row_codec in cur.fetchall() if codec_name(row_codec) != codec]
+    cur.close()
+
+    rows, before, after = 0, 0, 0
+    for i in range(0, len(pending), TRANSCODE_BATCH_SIZE):
+        batch = pending[i:i + TRANSCODE_BATCH_SIZE]
+        placeholders = ','.join('?' for _ in batch)
+        cur = db.execute(f'SELECT FILENAME, IMAGEBLOB, CODEC FROM DB_CACHE WHERE FILENAME IN ({placeholders})', batch)
+        updates = []
+        for filename, blob, row_codec in cur.fetchall():
+            try:
+                with decode_poster(blob, row_codec) as image:
+                    image.load()
+                    new_blob, new_codec = encode_poster(image, codec, options)
+            except (OSError, ValueError) as e:
+                print(f'could not transcode {filename}: {e}')
+                continue
+            updates.append((new_blob, new_codec, filename))
+            before, after = before + len(blob), after + len(new_blob)
+        cur.close()
+        db.executemany('UPDATE DB_CACHE SET IMAGEBLOB = ?, CODEC = ? WHERE FILENAME = ?', updates)
+        db.commit()
+        rows += len(updates)
+    return (rows, before, after)
@@ -0,0 +1,165 @@
+'''
+prefork worker runtime, started with `python worker.py --prefork` (or WORKER_MODE=prefork).
+the parent imports everything once and warms what every task needs (fonts, star icons, Pillow's format plugins,
+config files), then forks executor processes as tasks come in. executors start out with all of that already in
+memory and open their own sqlite connections after the fork, connections can't cross a fork.
+nothing that holds a connection or a thread (rate limiters, the poster resize pool) is touched before forking.
+
+the parent only claims tasks from TASKS and hands each one to an idle executor over a pipe, forking another
+executor when they're all busy. executors keep running tasks (so their tile cache and poster cache stay warm) and
+exit after PREFORK_IDLE_TIMEOUT seconds without one, PREFORK_MIN_EXECUTORS are forked up front and stay.
+'''
+
+import multiprocessing
+import os
+import sqlite3
+from multiprocessing.connection import Connection
+from time import sleep
+from PIL import Image
+from databases import connect, load_databases
+from db_cache import dbCache, DEFAULT_MAX_SIZE
+from tmdb_cache import tmdbCache
+from metrics import TaskMetrics
+from profiling import profile_task
+from image_builder import load_config, load_font, load_star_icons, FONT_PATH
+from fetch_data import load_thumbnail_size
+from poster_codec import load_poster_storage
+from rate_limiter import load_rate_limits
+from scheduler import TaskScheduler
+from worker import get_new_tasks, update_task_status, push_result, run_task, get_date_range, get_members
+
+MIN_EXECUTORS = int(os.environ.get('PREFORK_MIN_EXECUTORS', 1))
+MAX_EXECUTORS = int(os.environ.get('PREFORK_MAX_EXECUTORS', os.cpu_count() or 2))
+IDLE_TIMEOUT = int(os.environ.get('PREFORK_IDLE_TIMEOUT', 300)) # seconds
+MAX_FILMS_PER_MOSAIC = 30
+POLL_INTERVAL = 1 # seconds between checks for new tasks
+
+class Executor:
+    '''
+    a forked executor and the task it is running (None when idle)
+    '''
+    process: multiprocessing.Process
+    conn: Connection
+    task: tuple
+
+    def __init__(self, process: multiprocessing.Process, conn: Connection) -> None:
+        self.process = process
+        self.conn = conn
+        self.task = None
+
+def warm(config_path: str = 'config.json') -> None:
+    '''
+    loads what the first task of every executor would otherwise load for itself
+    '''
+    _, _, _, movie_info_font_size, username_font_size, _, _ = load_config(config_path)
+    load_font(FONT_PATH, movie_info_font_size)
+    load_font(FONT_PATH, username_font_size)
+    load_star_icons()
+    # Pillow registers its format plugins on first use
+    Image.init()
+    load_thumbnail_size(config_path)
+    load_poster_storage(config_path)
+    load_rate_limits(config_path)
+    load_databases(config_path)
+
+def run_executor(conn: Connection, idle_timeout: float) -> None:
+    '''
+    executor process, runs the tasks sent over conn until none comes for idle_timeout seconds (None waits forever)
+    '''
+    # opened after the fork, the parent's connection is never used here
+    db = connect()
+    # room for every executor's posters so they don't evict each other's before rendering
+    db_cache = dbCache(max(DEFAULT_MAX_SIZE, MAX_EXECUTORS * MAX_FILMS_PER_MOSAIC * 2), db)
+    tmdb_cache = tmdbCache(db)
+
+    while conn.poll(idle_timeout):
+        task, estimate = conn.recv()
+        metrics = TaskMetrics(task[0])
+        estimate.count(metrics)
+        status = 'ERROR'
+        try:
+            with profile_task(task[0], task[1], metrics) as checkpoint:
+                status = run_task(db, db_cache, tmdb_cache, task, metrics, checkpoint)
+        except Exception as e:
+            # the executor stays up for the next task
+            print(f'TASK {task[0]} FAILED: {type(e).__name__}: {e}')
+            update_task_status(db, task[0], 'ERROR', "I BROKE IT :(", 'something went wrong building your mosaic, try again soon')
+            push_result(db, task[0], None)
+        metrics.push(db, status)
+        conn.send(task[0])
+    db.close()
+
+def spawn(context: multiprocessing.context.BaseContext, idle_timeout: float) -> Executor:
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=run_executor, args=(child_conn, idle_timeout), daemon=True)
+    process.start()
+    child_conn.close()
+    return Executor(process, conn)
+
+def queue(waiting: TaskScheduler, task: tuple) -> None:
+    waiting.push(task, get_members(task) or [task[1]], get_date_range(task))
+
+def reap(db: sqlite3.Connection, executors: list[Executor], waiting: TaskScheduler) -> None:
+    '''
+    marks executors that finished their task idle and drops the ones that exited.
+    an executor that timed out just as a task was sent never saw it, the task is queued again and keeps its place in line
+    '''
+    for executor in list(executors):
+        try:
+            while executor.conn.poll():
+                executor.conn.recv()
+                executor.task = None
+        except (EOFError, OSError):
+            pass
+        if executor.process.is_alive():
+            continue
+        executors.remove(executor)
+        executor.conn.close()
+        if not executor.task:
+            continue
+        if executor.process.exitcode == 0:
+            queue(waiting, executor.task)
+        else:
+            print(f'EXECUTOR {executor.process.pid} DIED ({executor.process.exitcode}) RUNNING TASK {executor.task[0]}')
+            update_task_status(db, executor.task[0], 'ERROR', "I BROKE IT :(", 'something went wrong building your mosaic, try again soon')
+            push_result(db, executor.task[0], None)
+
+def dispatch(executors: list[Executor], waiting: TaskScheduler, spawn_executor) -> None:
+    # hands the cheapest expected tasks to idle executors (see scheduler.py), forking more up to MAX_EXECUTORS
+    while waiting:
+        executor = next((executor for executor in executors if executor.task is None), None)
+        if executor is None:
+            if len(executors) >= MAX_EXECUTORS:
+                return
+            executor = spawn_executor()
+            executors.append(executor)
+        task, estimate = waiting.pop()
+        try:
+            executor.conn.send((task, estimate))
+        except (BrokenPipeError, OSError):
+            # exited since the last reap, reap() drops it
+            queue(waiting, task)
+            executor.task = ()
+            continue
+        executor.task = task
+
+def main(db: sqlite3.Connection) -> None:
+    warm()
+    context = multiprocessing.get_context('fork')
+    executors = [spawn(context, None) for _ in range(MIN_EXECUTORS)]
+    waiting = TaskScheduler(db)
+    print(f'PREFORK: {MIN_EXECUTORS} EXECUTORS WARM, UP TO {MAX_EXECUTORS}')
+
+    while True:
+        sleep(POLL_INTERVAL)
+        reap(db, executors, waiting)
+        # replace warm executors that crashed
+        while len(executors) < MIN_EXECUTORS:
+            executors.append(spawn(context, None))
+
+        # set status of all new tasks to queued
+        for task in get_new_tasks(db):
+            queue(waiting, task)
+            update_task_status(db, task[0], 'QUEUED', "I'M WAITING :/")
+
+        dispatch(executors, waiting, lambda: spawn(context, IDLE_TIMEOUT))
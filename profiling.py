@@ -0,0 +1,137 @@
+'''
+opt-in cProfile and tracemalloc hooks for worker tasks.
+nothing is profiled unless one of these environment variables is set:
+
+PROFILE_USERS - comma separated usernames whose tasks are always profiled
+PROFILE_SAMPLE_RATE - profile 1 in N tasks (picked from the task id so a task is either always or never sampled)
+
+PROFILES_DIR - where {task_id}.prof and {task_id}.tracemalloc are written (default ./profiles)
+PROFILE_RETENTION - how many profiled tasks to keep, oldest are removed first (default 50)
+
+summarize with `python server_utils.py profile [task_id]`
+'''
+
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+import zlib
+from contextlib import contextmanager
+from glob import glob
+from metrics import TaskMetrics
+
+TRACE_FRAMES = 10
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+]
+
+def get_profiles_dir() -> str:
+    return os.environ.get('PROFILES_DIR', './profiles')
+
+def should_profile(task_id: str, username: str) -> bool:
+    users = {user.strip().lower() for user in os.environ.get('PROFILE_USERS', '').split(',') if user.strip()}
+    if username.lower() in users:
+        return True
+
+    sample_rate = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    return sample_rate > 0 and zlib.crc32(task_id.encode('utf-8')) % sample_rate == 0
+
+def enforce_retention(profiles_dir: str, retention: int) -> int:
+    '''
+    removes the oldest profiled tasks so at most `retention` are kept
+    returns how many tasks were removed
+    '''
+    profiles = sorted(glob(os.path.join(profiles_dir, '*.prof')), key=os.path.getmtime, reverse=True)
+    for prof_path in profiles[retention:]:
+        os.remove(prof_path)
+        snapshot_path = prof_path[:-len('.prof')] + '.tracemalloc'
+        if os.path.isfile(snapshot_path):
+            os.remove(snapshot_path)
+    return max(0, len(profiles) - retention)
+
+@contextmanager
+def profile_task(task_id: str, username: str, metrics: TaskMetrics = None):
+    '''
+    wraps a task in cProfile and tracemalloc when should_profile() says so, otherwise does nothing.
+    yields a checkpoint() callable: the task calls it while its big objects are still alive
+    (e.g. right after the mosaic is encoded) and the largest checkpoint snapshot is the one saved
+    '''
+    if not should_profile(task_id, username):
+        yield lambda: None
+        return
+
+    profiles_dir = get_profiles_dir()
+    os.makedirs(profiles_dir, exist_ok=True)
+
+    # tracemalloc may already be running if the worker was started with PYTHONTRACEMALLOC
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACE_FRAMES)
+    tracemalloc.reset_peak()
+    largest = {'size': -1, 'snapshot': None}
+
+    def checkpoint() -> None:
+        size, _ = tracemalloc.get_traced_memory()
+        if size > largest['size']:
+            largest['size'] = size
+            largest['snapshot'] = tracemalloc.take_snapshot()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield checkpoint
+    finally:
+        profiler.disable()
+        checkpoint()
+        snapshot = largest['snapshot'].filter_traces(SNAPSHOT_FILTERS)
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        profiler.dump_stats(os.path.join(profiles_dir, f'{task_id}.prof'))
+        snapshot.dump(os.path.join(profiles_dir, f'{task_id}.tracemalloc'))
+        if metrics:
+            metrics.count('tracemalloc_peak_bytes', peak)
+
+        enforce_retention(profiles_dir, int(os.environ.get('PROFILE_RETENTION', 50)))
+        print(f'PROFILED TASK {task_id} -> {profiles_dir}')
+
+def list_profiles() -> list:
+    '''
+    returns task ids that have a profile on disk, newest first
+    '''
+    profiles = sorted(glob(os.path.join(get_profiles_dir(), '*.prof')), key=os.path.getmtime, reverse=True)
+    return [os.path.basename(path)[:-len('.prof')] for path in profiles]
+
+def summarize(task_id: str, limit: int = 20) -> str:
+    '''
+    returns the hottest functions (by cumulative and own time) and biggest allocation sites for a profiled task
+    '''
+    profiles_dir = get_profiles_dir()
+    prof_path = os.path.join(profiles_dir, f'{task_id}.prof')
+    snapshot_path = os.path.join(profiles_dir, f'{task_id}.tracemalloc')
+    if not os.path.isfile(prof_path):
+        return f'no profile found for task {task_id} in {profiles_dir}'
+
+    out = io.StringIO()
+    stats = pstats.Stats(prof_path, stream=out)
+    stats.strip_dirs()
+    out.write('==== HOTTEST FUNCTIONS (cumulative) ====\n')
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    out.write('==== HOTTEST FUNCTIONS (own time) ====\n')
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(limit)
+
+    if os.path.isfile(snapshot_path):
+        snapshot = tracemalloc.Snapshot.load(snapshot_path)
+        top_stats = snapshot.statistics('lineno')
+        out.write('==== BIGGEST ALLOCATION SITES (at the largest checkpoint) ====\n')
+        for index, stat in enumerate(top_stats[:limit]):
+            frame = stat.traceback[0]
+            out.write(f'{index:<4} {stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  {frame.filename}:{frame.lineno}\n')
+        total = sum(stat.size for stat in top_stats)
+        out.write(f'total traced: {total / 1024:.1f} KiB\n')
+
+    return out.getvalue()
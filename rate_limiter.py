@@ -0,0 +1,159 @@
+'''
+token bucket rate limits for tmdb, shared by every process that uses the same DATABASE (sync worker, async worker,
+batch pool processes, cache warmup) so together they stay under tmdb's request rate instead of each one assuming
+it has the whole allowance. "rate_limits" in config.json sets requests per second and burst size per bucket.
+
+every request takes a token with reserve(), which returns how long the caller has to wait for it. tokens can go
+negative, waiting callers are spaced out at the bucket's rate instead of retrying in a thundering herd.
+a 429 blocks the bucket for every process until its Retry-After has passed.
+
+rows in 'RATE_LIMITS' table are structured like this
+| NAME: str | TOKENS: float | UPDATED_AT: float(unix time) | BLOCKED_UNTIL: float(unix time) | RATE: float | BURST: float | THROTTLED: int |
+THROTTLED counts 429 responses, get_budgets() reports the tokens left in each bucket for /metrics
+'''
+
+import email.utils
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from schema import create_tables
+
+DEFAULT_RATE_LIMITS = {'tmdb_api': {'rate': 40, 'burst': 20}, 'tmdb_images': {'rate': 100, 'burst': 50}}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BASE_DELAY = 0.5 # seconds, doubled every retry and jittered by +-50% when there is no Retry-After
+MAX_RETRY_AFTER = 60
+# reserve() calls of async callers run here, sqlite serialises them on the write lock anyway
+LIMITER_THREADS = 1
+
+_limiter_executor: ThreadPoolExecutor = None
+
+def get_limiter_executor() -> ThreadPoolExecutor:
+    global _limiter_executor
+    if _limiter_executor is None:
+        _limiter_executor = ThreadPoolExecutor(max_workers=LIMITER_THREADS, thread_name_prefix='rate-limit')
+    return _limiter_executor
+
+@lru_cache(maxsize=None)
+def load_rate_limits(path: str = 'config.json') -> dict:
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return {**DEFAULT_RATE_LIMITS, **config.get('rate_limits', {})}
+
+def parse_retry_after(value: str) -> float:
+    '''
+    seconds to wait from a Retry-After header (delay in seconds or an http date), None if it can't be read
+    '''
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+def retry_delay(attempt: int, retry_after: str = None) -> float:
+    delay = parse_retry_after(retry_after)
+    if delay is None:
+        delay = RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+    return delay
+
+
+class RateLimiter:
+    '''
+    one bucket in RATE_LIMITS. sqlite connections can't be shared between threads so each thread opens its own
+    '''
+    name: str
+    rate: float
+    burst: float
+
+    def __init__(self, name: str, rate: float, burst: float, database: str = None) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self._database = database or os.environ['DATABASE']
+        self._local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        if not hasattr(self._local, 'db'):
+            # autocommit so reserve() controls its own IMMEDIATE transaction
+            self._local.db = sqlite3.connect(self._database, timeout=30, isolation_level=None)
+            create_tables(self._local.db, ['RATE_LIMITS'])
+        return self._local.db
+
+    def reserve(self) -> float:
+        '''
+        takes a token and returns the seconds until it may be used
+        '''
+        db = self.connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = db.execute('SELECT TOKENS, UPDATED_AT, BLOCKED_UNTIL FROM RATE_LIMITS WHERE NAME = ?', (self.name,)).fetchone()
+            tokens, updated_at, blocked_until = row or (self.burst, now, 0)
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate) - 1
+            db.execute(
+                """
+                INSERT INTO RATE_LIMITS(NAME, TOKENS, UPDATED_AT, BLOCKED_UNTIL, RATE, BURST, THROTTLED)
+                VALUES (?, ?, ?, 0, ?, ?, 0)
+                ON CONFLICT(NAME) DO UPDATE SET TOKENS = excluded.TOKENS, UPDATED_AT = excluded.UPDATED_AT,
+                RATE = excluded.RATE, BURST = excluded.BURST
+                """,
+                (self.name, tokens, now, self.rate, self.burst))
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+        return max(0.0, -tokens / self.rate, (blocked_until or 0) - now)
+
+    def acquire(self) -> None:
+        time.sleep(self.reserve())
+
+    async def acquire_async(self) -> None:
+        # imported here so the server (which only reads budgets for /metrics) doesn't load asyncio
+        import asyncio
+        # reserve() can wait up to 30s on a busy writer, that mustn't stall every other task on the loop
+        delay = await asyncio.get_running_loop().run_in_executor(get_limiter_executor(), self.reserve)
+        await asyncio.sleep(delay)
+
+    def throttled(self, retry_after: float) -> None:
+        '''
+        tmdb answered 429, nobody gets a token from this bucket for retry_after seconds
+        '''
+        self.connect().execute(
+            """
+            UPDATE RATE_LIMITS
+            SET BLOCKED_UNTIL = MAX(COALESCE(BLOCKED_UNTIL, 0), ?), THROTTLED = COALESCE(THROTTLED, 0) + 1
+            WHERE NAME = ?
+            """,
+            (time.time() + retry_after, self.name))
+
+    async def throttled_async(self, retry_after: float) -> None:
+        import asyncio
+        await asyncio.get_running_loop().run_in_executor(get_limiter_executor(), self.throttled, retry_after)
+
+
+@lru_cache(maxsize=None)
+def get_limiter(name: str) -> RateLimiter:
+    limits = load_rate_limits()[name]
+    return RateLimiter(name, limits['rate'], limits['burst'])
+
+def get_budgets(db: sqlite3.Connection) -> list[tuple[str, float, float, int]]:
+    '''
+    [(bucket, tokens available now, seconds still blocked by a 429, 429s seen)]
+    '''
+    cur = db.execute('SELECT NAME, TOKENS, UPDATED_AT, BLOCKED_UNTIL, RATE, BURST, THROTTLED FROM RATE_LIMITS ORDER BY NAME')
+    now = time.time()
+    budgets = [
+        (name, min(burst, tokens + (now - updated_at) * rate), max(0.0, (blocked_until or 0) - now), throttled or 0)
+        for name, tokens, updated_at, blocked_until, rate, burst, throttled in cur.fetchall()
+    ]
+    cur.close()
+    return budgets
@@ -0,0 +1,228 @@
+'''
+where finished mosaics are kept and how they are streamed back out.
+RESULT_STORE=sqlite (default) - image bytes live in RESULTS.RESULT as a BLOB and are read back in chunks with blobopen
+RESULT_STORE=fs - image bytes live in {RESULTS_DIR}/{id[:2]}/{id[2:4]}/{id}.{format} ({id}.preview.{format} for previews),
+                  RESULTS only holds metadata
+
+either way RESULTS rows are
+| ID: str | RESULT: BLOB or NULL | CREATED_ON: str(datetime) | SIZE: int | HASH: str(sha256) | FORMAT: str | RENDITION: str |
+a task has one row per encoded format of each rendition (see encoder.py), 'full' is the mosaic and 'preview' the
+downscaled copy shown on the result page. NULL FORMAT / RENDITION on rows written before they existed mean png / full.
+a task that errored still gets a row (SIZE 0) so database_janitor.py can expire it.
+rows written before SIZE existed hold a base64 string in RESULT and are decoded whole (they expire within the hour).
+'''
+
+import base64
+from abc import ABC, abstractmethod
+import hashlib
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+from typing import Iterator
+from databases import connect, get_schema
+from formats import FORMATS
+from schema import create_tables
+
+RENDITIONS = ['full', 'preview']
+
+CHUNK_SIZE = 64 * 1024
+
+class ResultStore(ABC):
+    _db: sqlite3.Connection
+
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self._db = db
+
+    @abstractmethod
+    def put(self, task_id: str, data: bytes, fmt: str = 'png', rendition: str = 'full') -> None:
+        '''
+        stores one format of one rendition of the result for a task, data is None for tasks that errored
+        '''
+
+    @abstractmethod
+    def read_chunks(self, task_id: str, rowid: int, size: int, fmt: str, rendition: str) -> Iterator[bytes]:
+        '''
+        yields the stored bytes of a result (RESULTS row rowid) in pieces of up to CHUNK_SIZE
+        '''
+
+    def remove_data(self, task_ids: list) -> None:
+        '''
+        removes anything kept outside of the RESULTS table, rows are deleted by delete()
+        '''
+        pass
+
+    def insert_row(self, task_id: str, result: bytes, size: int, digest: str, fmt: str, rendition: str) -> None:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self._db.execute(
+            """
+            INSERT INTO RESULTS(id, result, created_on, size, hash, format, rendition)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (task_id, result, now, size, digest, fmt, rendition))
+        self._db.commit()
+
+    def get_meta(self, task_id: str, fmt: str = 'png', rendition: str = 'full') -> tuple[int, int, str]:
+        '''
+        returns (rowid, size, hash) or None if there is no mosaic in format fmt for task_id
+        '''
+        cur = self._db.execute(
+            """
+            SELECT ROWID, SIZE, HASH, RESULT IS NOT NULL AND RESULT != 'NULL' FROM RESULTS
+            WHERE ID = ? AND COALESCE(FORMAT, 'png') = ? AND COALESCE(RENDITION, 'full') = ?
+            """, (task_id, fmt, rendition))
+        row = cur.fetchone()
+        cur.close()
+        if not row:
+            return None
+        rowid, size, digest, has_result = row
+        if size is None and has_result:
+            # legacy base64 row
+            return (rowid, None, None)
+        if not size:
+            return None
+        return (rowid, size, digest)
+
+    def formats(self, task_id: str, rendition: str = 'full') -> dict:
+        '''
+        returns {format: size} of every format of a rendition stored for task_id, legacy rows have a size of None
+        '''
+        cur = self._db.execute(
+            """
+            SELECT COALESCE(FORMAT, 'png'), SIZE FROM RESULTS
+            WHERE ID = ? AND COALESCE(RENDITION, 'full') = ?
+            AND (SIZE > 0 OR (SIZE IS NULL AND RESULT IS NOT NULL AND RESULT != 'NULL'))
+            """, (task_id, rendition))
+        formats = dict(cur.fetchall())
+        cur.close()
+        return formats
+
+    def stream(self, task_id: str, fmt: str = 'png', rendition: str = 'full') -> tuple[int, str, Iterator[bytes]]:
+        '''
+        returns (size, hash, chunk iterator) or None if there is no mosaic in format fmt for task_id.
+        size and hash are None for legacy rows
+        '''
+        meta = self.get_meta(task_id, fmt, rendition)
+        if not meta:
+            return None
+        rowid, size, digest = meta
+        if size is None:
+            return (None, None, self.read_legacy(rowid))
+        return (size, digest, self.read_chunks(task_id, rowid, size, fmt, rendition))
+
+    def read_legacy(self, rowid: int) -> Iterator[bytes]:
+        cur = self._db.execute('SELECT RESULT FROM RESULTS WHERE ROWID = ?', (rowid,))
+        result = cur.fetchone()[0]
+        cur.close()
+        yield base64.b64decode(result)
+
+    def delete(self, task_ids: list) -> None:
+        if not task_ids:
+            return
+        self.remove_data(task_ids)
+        placeholders = ','.join('?' for _ in task_ids)
+        self._db.execute(f'DELETE FROM RESULTS WHERE ID IN ({placeholders})', task_ids)
+        self._db.commit()
+
+
+class SqliteResultStore(ResultStore):
+
+    def put(self, task_id: str, data: bytes, fmt: str = 'png', rendition: str = 'full') -> None:
+        if data is None:
+            self.insert_row(task_id, None, 0, None, fmt, rendition)
+            return
+        self.insert_row(task_id, sqlite3.Binary(data), len(data), hashlib.sha256(data).hexdigest(), fmt, rendition)
+
+    def read_chunks(self, task_id: str, rowid: int, size: int, fmt: str, rendition: str) -> Iterator[bytes]:
+        # blobopen doesn't search attached files like queries do, RESULTS may live in RESULTS_DATABASE
+        with self._db.blobopen('RESULTS', 'RESULT', rowid, readonly=True, name=get_schema(self._db, 'RESULTS')) as blob:
+            while True:
+                chunk = blob.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class FileResultStore(ResultStore):
+    _results_dir: str
+
+    def __init__(self, db: sqlite3.Connection, results_dir: str) -> None:
+        super().__init__(db)
+        self._results_dir = results_dir
+
+    def get_path(self, task_id: str, fmt: str = 'png', rendition: str = 'full') -> str:
+        name = task_id if rendition == 'full' else f'{task_id}.{rendition}'
+        # two levels of 256 directories keep any one directory small
+        return os.path.join(self._results_dir, task_id[:2], task_id[2:4], f'{name}.{fmt}')
+
+    def put(self, task_id: str, data: bytes, fmt: str = 'png', rendition: str = 'full') -> None:
+        if data is None:
+            self.insert_row(task_id, None, 0, None, fmt, rendition)
+            return
+        path = self.get_path(task_id, fmt, rendition)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name so readers never see half a file
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{path}.tmp', path)
+        self.insert_row(task_id, None, len(data), hashlib.sha256(data).hexdigest(), fmt, rendition)
+
+    def read_chunks(self, task_id: str, rowid: int, size: int, fmt: str, rendition: str) -> Iterator[bytes]:
+        with open(self.get_path(task_id, fmt, rendition), 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def remove_data(self, task_ids: list) -> None:
+        for task_id in task_ids:
+            for fmt in FORMATS:
+                for rendition in RENDITIONS:
+                    path = self.get_path(task_id, fmt, rendition)
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+
+def get_result_store(db: sqlite3.Connection) -> ResultStore:
+    if os.environ.get('RESULT_STORE', 'sqlite') == 'fs':
+        results_dir = os.environ.get('RESULTS_DIR', os.path.join(os.environ.get('IMAGES_DIR', '.'), 'results'))
+        return FileResultStore(db, results_dir)
+    return SqliteResultStore(db)
+
+
+class TestSqliteResultStore(unittest.TestCase):
+    def read_back(self, environ: dict) -> tuple[bytes, bytes]:
+        # (bytes put, bytes streamed back) through a store on a connection opened with environ
+        saved = {name: os.environ.get(name) for name in environ}
+        os.environ.update(environ)
+        db = connect()
+        try:
+            create_tables(db, ['RESULTS'])
+            store = SqliteResultStore(db)
+            data = os.urandom(CHUNK_SIZE * 2 + 1)
+            store.put('task', data)
+            size, digest, chunks = store.stream('task')
+            self.assertEqual((size, digest), (len(data), hashlib.sha256(data).hexdigest()))
+            return data, b''.join(chunks)
+        finally:
+            db.close()
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name)
+                else:
+                    os.environ[name] = value
+
+    def test_read_from_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data, read = self.read_back({'DATABASE': os.path.join(tmp, 'queue.db'), 'RESULTS_DATABASE': ''})
+        self.assertEqual(read, data)
+
+    def test_read_from_results_database(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data, read = self.read_back({'DATABASE': os.path.join(tmp, 'queue.db'), 'RESULTS_DATABASE': os.path.join(tmp, 'results.db')})
+        self.assertEqual(read, data)
+
+if __name__ == "__main__":
+    unittest.main()
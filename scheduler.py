@@ -0,0 +1,224 @@
+'''
+orders waiting tasks by how long they are expected to take instead of when they came in, so a month with three
+films doesn't wait behind a queue of cold "last 30" builds. used by every worker runtime (sync, async and prefork).
+
+a task's cost is estimated when it is queued, without touching the network:
+films - the entries its window selects from the user's stored watch history (what the last feed fetch left in
+        WATCH_HISTORY), for users without history the median film count of recent tasks in the same mode
+downloads - films whose poster isn't in DB_CACHE, for users without history the recent share of posters that missed
+seconds - fixed + films * film + downloads * download, per-film and per-download seconds come from the stage
+          timings of recent completed tasks in TASK_METRICS and are refreshed every MODEL_REFRESH seconds
+
+the cheapest task goes first, every second a task waits takes aging_rate seconds off its estimate and tasks that
+have waited max_wait seconds go first in the order they came in, so expensive tasks can't starve.
+"scheduler" in config.json sets both. the estimate and the wait are counted into the task's TASK_METRICS row
+(estimated_ms, estimated_films, estimated_downloads, queue_wait_ms) next to what actually happened, /metrics
+reports how far off the estimates are. the estimate is also kept in TASKS.ESTIMATED_SECONDS so the server can tell
+a waiting user how many tasks will run before theirs (get_tasks_ahead)
+'''
+
+import json
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import count
+from time import monotonic
+from metrics import TaskMetrics, quantile, DATE_FORMAT
+
+DEFAULT_SCHEDULER = {'aging_rate': 0.5, 'max_wait': 120}
+RUNNING_STATUSES = ('COLLECTING DATA', 'BUILDING MOSAIC')
+# seconds, used until there are completed tasks to measure
+DEFAULT_COSTS = {'fixed': 2.0, 'film': 0.1, 'download': 0.4, 'cached_share': 0.5}
+DEFAULT_FILMS = {0: 10, 1: 30, 2: 30, 3: 15}
+FIXED_STAGES = ['rss_fetch', 'rss_parse', 'encode', 'result_insert']
+FILM_STAGES = ['tmdb_resolve', 'compositing']
+MODEL_WINDOW = 200 # recent tasks the costs are measured over
+MODEL_REFRESH = 60 # seconds
+
+def load_scheduler_config(path: str = 'config.json') -> dict:
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return {**DEFAULT_SCHEDULER, **config.get('scheduler', {})}
+
+def get_costs(db: sqlite3.Connection, limit: int = MODEL_WINDOW) -> tuple[dict, dict]:
+    '''
+    ({fixed, film, download, cached_share}, {mode: median films}) measured over the last `limit` completed tasks
+    '''
+    cur = db.execute(
+        """
+        SELECT TASKS.MODE, TASK_METRICS.STAGES, TASK_METRICS.COUNTS FROM TASK_METRICS
+        LEFT JOIN TASKS ON TASKS.ID = TASK_METRICS.ID
+        WHERE TASK_METRICS.STATUS = 'COMPLETE'
+        ORDER BY TASK_METRICS.FINISHED_ON DESC
+        LIMIT ?
+        """, (limit,))
+    rows = [(mode, json.loads(stages), json.loads(counts)) for mode, stages, counts in cur.fetchall()]
+    cur.close()
+
+    samples = {name: [] for name in DEFAULT_COSTS}
+    films = {}
+    for mode, stages, counts in rows:
+        samples['fixed'].append(sum(stages.get(stage, 0.0) for stage in FIXED_STAGES))
+        if counts.get('films'):
+            samples['film'].append(sum(stages.get(stage, 0.0) for stage in FILM_STAGES) / counts['films'])
+            samples['cached_share'].append(min(1.0, counts.get('posters_cached', 0) / counts['films']))
+            if mode is not None:
+                films.setdefault(int(mode), []).append(counts['films'])
+        if counts.get('posters_downloaded'):
+            samples['download'].append(stages.get('poster_download', 0.0) / counts['posters_downloaded'])
+
+    costs = {name: quantile(sorted(values), 0.5) if values else DEFAULT_COSTS[name] for name, values in samples.items()}
+    return costs, {mode: quantile(sorted(values), 0.5) for mode, values in films.items()}
+
+def get_priority(seconds: float, waited: float, arrival: int, config: dict) -> tuple:
+    # lowest runs first, tasks past max_wait go in the order they came in
+    if waited >= config['max_wait']:
+        return (0, arrival)
+    return (1, seconds - waited * config['aging_rate'], arrival)
+
+def get_tasks_ahead(db: sqlite3.Connection, task_id: str, default_seconds: float, config: dict = None,
+                    since: str = '') -> tuple[int, float]:
+    '''
+    (tasks that will finish before task_id, estimated seconds until task_id is done) by the rules pop() follows.
+    running tasks are always ahead. tasks the worker hasn't estimated yet (READY) count in the order they came in,
+    at default_seconds each. tasks created before `since` are left out. the answer holds until a cheaper task arrives
+    '''
+    config = config or load_scheduler_config()
+    cur = db.execute(
+        f"""
+        SELECT ID, ROWID, STATUS, ESTIMATED_SECONDS, CREATED_ON FROM TASKS
+        WHERE STATUS IN ('READY', 'QUEUED', {','.join('?' for _ in RUNNING_STATUSES)}) AND CREATED_ON >= ?
+        """, (*RUNNING_STATUSES, since))
+    rows = cur.fetchall()
+    cur.close()
+    now = datetime.now()
+
+    def priority(row: tuple) -> tuple:
+        _, rowid, _, seconds, created_on = row
+        try:
+            waited = (now - datetime.strptime(created_on, DATE_FORMAT)).total_seconds()
+        except (TypeError, ValueError):
+            waited = 0.0
+        return get_priority(seconds or default_seconds, waited, rowid, config)
+
+    own = next((row for row in rows if row[0] == task_id), None)
+    if own is None:
+        return (0, default_seconds)
+    ahead = [
+        row for row in rows if row[0] != task_id and (
+            row[2] in RUNNING_STATUSES
+            or ((row[3] is None or own[3] is None) and row[1] < own[1])
+            or (row[3] is not None and own[3] is not None and priority(row) < priority(own)))
+    ]
+    return (len(ahead), sum(row[3] or default_seconds for row in ahead) + (own[3] or default_seconds))
+
+def get_cached_posters(db: sqlite3.Connection, filenames: list[str]) -> int:
+    # a plain read, dbCache.lookup_many would count these as hits and mark them used
+    filenames = list(dict.fromkeys(filenames))
+    if not filenames:
+        return 0
+    cur = db.execute(f'SELECT COUNT(*) FROM DB_CACHE WHERE FILENAME IN ({",".join("?" for _ in filenames)})', filenames)
+    cached = cur.fetchone()[0]
+    cur.close()
+    return cached
+
+
+@dataclass
+class CostEstimate:
+    films: int
+    downloads: int
+    seconds: float
+    waited: float = 0.0 # seconds between the task being created and taken off the queue
+
+    def count(self, metrics: TaskMetrics) -> None:
+        metrics.count('estimated_ms', round(self.seconds * 1000))
+        metrics.count('estimated_films', self.films)
+        metrics.count('estimated_downloads', self.downloads)
+        metrics.count('queue_wait_ms', round(self.waited * 1000))
+
+
+class TaskScheduler:
+    '''
+    waiting tasks of one worker process, pop() hands out the one to run next
+    '''
+    _db: sqlite3.Connection
+    _config: dict
+    _waiting: dict
+    def __init__(self, db: sqlite3.Connection, config: dict = None) -> None:
+        self._db = db
+        self._config = config or load_scheduler_config()
+        # task id -> (task, estimate, created on, arrival order)
+        self._waiting = {}
+        self._arrivals = count()
+        # imported here so the server (which only asks get_tasks_ahead) doesn't load PIL/aiohttp/lxml
+        from watch_history import watchHistory
+        self._watch_history = watchHistory(db)
+        self._costs = None
+        self._costs_loaded = None
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    def get_costs(self) -> tuple[dict, dict]:
+        if self._costs is None or monotonic() - self._costs_loaded > MODEL_REFRESH:
+            self._costs = get_costs(self._db)
+            self._costs_loaded = monotonic()
+        return self._costs
+
+    def estimate(self, usernames: list[str], mode: int, date_range: tuple[datetime, datetime] = None) -> CostEstimate:
+        from fetch_data import get_selection, title_to_image_path
+        from watch_history import select_entries
+        costs, typical_films = self.get_costs()
+        start, end, limit = get_selection(mode, datetime.now(), date_range)
+
+        # a group's films are the union of its members', newest first
+        entries, unknown = [], 0
+        for username in usernames:
+            if self._watch_history.get_count(username):
+                entries.extend(self._watch_history.query(username, start, end, limit))
+            else:
+                unknown += 1
+        entries = select_entries(sorted(entries, key=lambda entry: entry.watched_date, reverse=True), limit=limit)
+
+        films = len(entries)
+        downloads = films - get_cached_posters(self._db, [title_to_image_path(entry.title) for entry in entries])
+        if unknown:
+            # nothing stored to count, assume a typical task in this mode
+            guess = typical_films.get(mode, DEFAULT_FILMS.get(mode, DEFAULT_FILMS[1]))
+            extra = round(guess * unknown) if limit is None else max(0, min(limit, round(guess)) - films)
+            films += extra
+            downloads += round(extra * (1 - costs['cached_share']))
+
+        seconds = costs['fixed'] + films * costs['film'] + downloads * costs['download']
+        return CostEstimate(films, downloads, seconds)
+
+    def push(self, task: tuple, usernames: list[str], date_range: tuple[datetime, datetime] = None) -> CostEstimate:
+        '''
+        queues task, usernames are the user or a group's members. a task pushed again keeps its place in line
+        '''
+        estimate = self.estimate(usernames, int(task[2]), date_range)
+        try:
+            created_on = datetime.strptime(task[6], DATE_FORMAT)
+        except (TypeError, ValueError):
+            created_on = datetime.now()
+        self._waiting[task[0]] = (task, estimate, created_on, next(self._arrivals))
+        self._db.execute('UPDATE TASKS SET ESTIMATED_SECONDS = ? WHERE ID = ?', (estimate.seconds, task[0]))
+        self._db.commit()
+        return estimate
+
+    def pop(self) -> tuple[tuple, CostEstimate]:
+        '''
+        removes and returns the task to run next and its estimate, None if nothing is waiting
+        '''
+        if not self._waiting:
+            return None
+        now = datetime.now()
+
+        def priority(item: tuple) -> tuple:
+            _, estimate, created_on, arrival = item
+            return get_priority(estimate.seconds, (now - created_on).total_seconds(), arrival, self._config)
+
+        task, estimate, created_on, _ = min(self._waiting.values(), key=priority)
+        del self._waiting[task[0]]
+        estimate.waited = max(0.0, (now - created_on).total_seconds())
+        return task, estimate
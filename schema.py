@@ -0,0 +1,83 @@
+'''
+table definitions shared by server.py, worker.py, database_janitor.py and server_utils.py
+create_tables() creates any missing table and adds any column that is missing from an older database file.
+tables are created in the file of the store they belong to (see databases.py)
+'''
+
+import sqlite3
+from databases import get_schema, get_shadowed_tables
+
+TABLES = {
+    'TASKS': ['id', 'user', 'mode', 'progress_msg', 'status', 'error_msg', 'created_on', 'client', 'range_start', 'range_end', 'members', 'estimated_seconds'],
+    'RESULTS': ['id', 'result', 'created_on', 'size', 'hash', 'format', 'rendition'],
+    'DB_CACHE': ['FILENAME', 'IMAGEBLOB', 'LAST_USED_DATE', 'CODEC', 'CREATED_ON', 'HITS'],
+    'CACHE_STATS': ['NAME', 'VALUE'],
+    'NEGATIVE_CACHE': ['KIND', 'KEY', 'CREATED_ON'],
+    'RATE_LIMITS': ['NAME', 'TOKENS', 'UPDATED_AT', 'BLOCKED_UNTIL', 'RATE', 'BURST', 'THROTTLED'],
+    'TASK_METRICS': ['id', 'status', 'finished_on', 'total_seconds', 'stages', 'counts'],
+    'METRIC_TOTALS': ['NAME', 'LABELS', 'VALUE'],
+    'TMDB_CACHE': ['TMDB_ID', 'TMDB_TYPE', 'DIRECTOR', 'POSTER_URL', 'CREATED_ON'],
+    'WATCH_HISTORY': ['USERNAME', 'GUID', 'TITLE', 'WATCHED_DATE', 'RATING', 'TMDB_ID', 'TMDB_TYPE', 'ADDED_ON'],
+}
+
+# indexes are created with the table they belong to
+INDEXES = {
+    'TASKS': [
+        'CREATE INDEX IF NOT EXISTS TASKS_STATUS ON TASKS(STATUS, CREATED_ON)',
+        'CREATE INDEX IF NOT EXISTS TASKS_USER ON TASKS(USER, CREATED_ON)',
+        'CREATE INDEX IF NOT EXISTS TASKS_CLIENT ON TASKS(CLIENT, CREATED_ON)',
+    ],
+    'RESULTS': [
+        'CREATE INDEX IF NOT EXISTS RESULTS_ID ON RESULTS(ID)',
+        'CREATE INDEX IF NOT EXISTS RESULTS_CREATED_ON ON RESULTS(CREATED_ON)',
+    ],
+    'CACHE_STATS': ['CREATE UNIQUE INDEX IF NOT EXISTS CACHE_STATS_NAME ON CACHE_STATS(NAME)'],
+    'NEGATIVE_CACHE': ['CREATE UNIQUE INDEX IF NOT EXISTS NEGATIVE_CACHE_KEY ON NEGATIVE_CACHE(KIND, KEY)'],
+    'METRIC_TOTALS': ['CREATE UNIQUE INDEX IF NOT EXISTS METRIC_TOTALS_NAME ON METRIC_TOTALS(NAME, LABELS)'],
+    'RATE_LIMITS': ['CREATE UNIQUE INDEX IF NOT EXISTS RATE_LIMITS_NAME ON RATE_LIMITS(NAME)'],
+    'TMDB_CACHE': ['CREATE UNIQUE INDEX IF NOT EXISTS TMDB_CACHE_ID ON TMDB_CACHE(TMDB_ID, TMDB_TYPE)'],
+    'WATCH_HISTORY': [
+        'CREATE UNIQUE INDEX IF NOT EXISTS WATCH_HISTORY_GUID ON WATCH_HISTORY(USERNAME, GUID)',
+        'CREATE INDEX IF NOT EXISTS WATCH_HISTORY_DATE ON WATCH_HISTORY(USERNAME, WATCHED_DATE)',
+    ],
+}
+
+def get_columns(db: sqlite3.Connection, table: str, schema: str = 'main') -> list:
+    cur = db.execute(f'PRAGMA {schema}.table_info({table})')
+    columns = [row[1] for row in cur.fetchall()]
+    cur.close()
+    return columns
+
+def create_tables(db: sqlite3.Connection, tables: list = None) -> None:
+    '''
+    creates tables (all of TABLES by default) and migrates columns added since the db file was made
+    '''
+    for table in tables or TABLES:
+        columns = TABLES[table]
+        schema = get_schema(db, table)
+        db.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table}({', '.join(columns)})")
+        existing = {column.lower() for column in get_columns(db, table, schema)}
+        for column in columns:
+            if column.lower() not in existing:
+                db.execute(f'ALTER TABLE {schema}.{table} ADD COLUMN {column}')
+        for index in INDEXES.get(table, []):
+            db.execute(index.replace('IF NOT EXISTS ', f'IF NOT EXISTS {schema}.'))
+    db.commit()
+
+def split_databases(db: sqlite3.Connection) -> dict:
+    '''
+    moves tables created in DATABASE before their store got its own file into that file.
+    db has to come from databases.connect(check_shadowed=False), returns {table: rows moved}
+    '''
+    moved = {}
+    for table in get_shadowed_tables(db):
+        schema = get_schema(db, table)
+        create_tables(db, [table])
+        # only the columns the old table has, the rest are filled in with NULL like any migrated column
+        columns = ', '.join(get_columns(db, table, 'main'))
+        cur = db.execute(f'INSERT INTO {schema}.{table}({columns}) SELECT {columns} FROM main.{table}')
+        moved[table] = cur.rowcount
+        cur.close()
+        db.execute(f'DROP TABLE main.{table}')
+        db.commit()
+    return moved
@@ -6,17 +6,43 @@ if os.path.isfile('.env'):
     load_dotenv('.env')
 # =========================================
 
-from flask import Flask, redirect, url_for, request, send_file, render_template, g, flash
-import io
-import base64
+from flask import Flask, redirect, url_for, request, render_template, g, flash, Response, stream_with_context
 import secrets
 from flask_session import Session
 from bleach import clean
 import sqlite3
 from uuid import uuid4
 import time
+from datetime import datetime, timedelta
+from schema import create_tables
+from databases import connect
+from negative_cache import negativeCache
+from metrics import render_prometheus, get_typical_task_seconds
+from result_store import get_result_store
+from formats import choose_format, get_mimetype
+from scheduler import get_tasks_ahead
+from database_janitor import EXPIRY_TIME
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# admission control for start_task()
+MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 50))
+MAX_ESTIMATED_WAIT = int(os.environ.get('MAX_ESTIMATED_WAIT', EXPIRY_TIME // 4)) # seconds
+SUBMIT_WINDOW = 60 # seconds
+MAX_SUBMITS_PER_USER = int(os.environ.get('MAX_SUBMITS_PER_USER', 3)) # per SUBMIT_WINDOW
+MAX_SUBMITS_PER_CLIENT = int(os.environ.get('MAX_SUBMITS_PER_CLIENT', 10)) # per SUBMIT_WINDOW
+# clients are told apart by request.remote_addr. behind reverse proxies set PROXY_COUNT to how many of them set
+# X-Forwarded-For (the Dockerfile sets 1 for the deploy), anything more than really sits in front lets clients
+# pick their own address and skip MAX_SUBMITS_PER_CLIENT
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+DEFAULT_TASK_SECONDS = 20 # used for wait estimates until the worker has finished some tasks
+WAITING_STATUSES = ('READY', 'QUEUED', 'COLLECTING DATA', 'BUILDING MOSAIC')
+MAX_GROUP_MEMBERS = int(os.environ.get('MAX_GROUP_MEMBERS', 12)) # usernames in one group mosaic, the submitter included
+
 # setting up flask app
 app = Flask(__name__)
+if PROXY_COUNT:
+    # so request.remote_addr is the client and not the proxy when rate limiting
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_TYPE"] = "filesystem"
 app.secret_key = secrets.token_urlsafe(16)
@@ -25,14 +51,16 @@ Session(app)
 def get_db():
     db = getattr(g, "_database", None)
     if db is None:
-        db = g._database = sqlite3.connect(os.environ['DATABASE'], timeout=10)
-        cur = db.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS TASKS(id, user, mode, progress_msg, status, error_msg)")
-        cur.execute("CREATE TABLE IF NOT EXISTS RESULTS(id, result, created_on)")
-        cur.close()
-        db.commit()
+        db = g._database = connect(timeout=10)
+        create_tables(db, ['TASKS', 'RESULTS', 'TASK_METRICS', 'METRIC_TOTALS', 'DB_CACHE', 'CACHE_STATS', 'RATE_LIMITS', 'NEGATIVE_CACHE'])
     return db
 
+def count_rows(query: str, params: tuple = ()) -> int:
+    cur = get_db().execute(query, params)
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, "_database", None)
@@ -41,20 +69,32 @@ def close_connection(exception):
 
 @app.route('/img/<string:task_id>')
 def mosaic_route(task_id: str):
-    return get_result(task_id=task_id)
+    response = negotiate_result(task_id, 'full')
+    if response is None:
+        return redirect(url_for('main_form'))
+    return response
+
+@app.route('/preview/<string:task_id>')
+def preview_route(task_id: str):
+    # tasks finished before previews existed only have the full mosaic
+    response = negotiate_result(task_id, 'preview') or negotiate_result(task_id, 'full')
+    if response is None:
+        return redirect(url_for('main_form'))
+    return response
 
 @app.route('/download/<string:username>/<string:task_id>')
 def download_image(username: str, task_id: str):
 
-    image_string = get_result(task_id)
-    if image_string is None:
+    response = stream_result(task_id)
+    if response is None:
         return redirect(url_for('main_form'))
 
-    # render page with generated image_string
-    image_data = base64.b64decode(image_string)
-    buffer = io.BytesIO(image_data)
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name=f'{username}.png', mimetype='image/png/')
+    response.headers.set('Content-Disposition', 'attachment', filename=f'{username}.png')
+    return response
+
+@app.route('/metrics')
+def metrics_route():
+    return Response(render_prometheus(get_db()), mimetype='text/plain; version=0.0.4')
 
 @app.route('/', methods=['GET', 'POST'])
 def main_form():
@@ -68,8 +108,35 @@ def main_form():
     movie_mode = 0
     if request.form.get('movie_mode'):
         movie_mode = 1
+    if request.form.get('year_mode'):
+        movie_mode = 2
+
+    # custom date range (mode 3) when both ends are filled in
+    date_range = None
+    if request.form.get('range_start') and request.form.get('range_end'):
+        date_range, err = parse_date_range(request.form['range_start'], request.form['range_end'])
+        if err:
+            flash(err, 'error')
+            return redirect(url_for('main_form'))
+        movie_mode = 3
 
-    task_id = start_task(submitted_username, movie_mode)
+    # group mosaic when other members are listed
+    members, err = parse_members(submitted_username, request.form.get('group_members', ''))
+    if err:
+        flash(err, 'error')
+        return redirect(url_for('main_form'))
+
+    # usernames the worker recently found no feed for are turned away without queueing a task
+    for username in members or [submitted_username]:
+        if negativeCache(get_db()).lookup('username', username.lower()):
+            flash(f'{username} has no rss feed (most likely no letterboxd account)', 'error')
+            return redirect(url_for('main_form'))
+
+    task_id, err, retry_after = start_task(submitted_username, movie_mode, request.remote_addr, date_range, members)
+    if not task_id:
+        # over capacity: answer straight away instead of queueing something that won't finish in time
+        flash(err, 'error')
+        return render_template('main_form.html'), 503, {'Retry-After': str(retry_after)}
     return redirect(url_for('task_page', task_id=task_id))
 
 @app.route('/task/<string:task_id>')
@@ -100,7 +167,13 @@ def task_page(task_id: str):
             return redirect(url_for('main_form'))
 
         # task still loading
-        return render_template('task_page.html', progress_msg=progress_msg, status=status)
+        tasks_ahead, estimated_wait = None, None
+        if status in ('READY', 'QUEUED'):
+            # the worker runs the cheapest expected task first, not the oldest (see scheduler.py)
+            typical_seconds = get_typical_task_seconds(get_db()) or DEFAULT_TASK_SECONDS
+            tasks_ahead, estimated_wait = get_tasks_ahead(get_db(), task_id, typical_seconds, since=get_expiry_cutoff())
+        return render_template('task_page.html', progress_msg=progress_msg, status=status,
+                               tasks_ahead=tasks_ahead, estimated_wait=estimated_wait)
     else:
         return redirect(url_for('main_form', error_message=f'TASK: {task} | TASK_ID: {task_id}'))
     # serve an html page that uses the meta tag to refresh to display the current progress_msg
@@ -110,11 +183,12 @@ def dynamic_page(username: str, task_id: str):
     '''
     displays image_string from RESULTS table in db after task complete
     '''
-    image_string = get_result(task_id=task_id)
-    if image_string is None:
+    if not get_result_store(get_db()).get_meta(task_id):
         return redirect(url_for('main_form'))
     download_url = url_for('download_image', username=username, task_id=task_id)
-    return render_template('dynamic_page.html', image=image_string, download_url=download_url)
+    image_url = url_for('mosaic_route', task_id=task_id)
+    preview_url = url_for('preview_route', task_id=task_id)
+    return render_template('dynamic_page.html', image_url=image_url, preview_url=preview_url, download_url=download_url)
 
 def num_of_rows():
     cur = get_db().cursor()
@@ -123,39 +197,123 @@ def num_of_rows():
     cur.close()
     return str(cnt[0])
 
-# TASKS(id, user, mode, progress_msg, status, error_msg)")
-def start_task(user: str, mode: int) -> str:
+def get_estimated_wait(tasks_ahead: int) -> int:
+    '''
+    seconds until a task with `tasks_ahead` tasks in front of it should be done, based on recent task times
+    '''
+    typical_seconds = get_typical_task_seconds(get_db()) or DEFAULT_TASK_SECONDS
+    return int((tasks_ahead + 1) * typical_seconds)
+
+def get_expiry_cutoff() -> str:
+    # unfinished tasks older than this were lost by a worker that died, database_janitor.py marks them ERROR
+    return (datetime.now() - timedelta(seconds=EXPIRY_TIME)).strftime('%Y-%m-%d %H:%M:%S')
+
+def check_admission(user: str, client: str) -> tuple[bool, str, int]:
     '''
-    starts task in database and returns corresponding id of task
+    returns (admitted, error message, seconds the client should wait before retrying)
     '''
+    since = (datetime.now() - timedelta(seconds=SUBMIT_WINDOW)).strftime('%Y-%m-%d %H:%M:%S')
+
+    if count_rows("SELECT COUNT(*) FROM TASKS WHERE USER = ? AND CREATED_ON >= ?", (user, since)) >= MAX_SUBMITS_PER_USER:
+        return (False, f'{user} was just submitted a few times, try again in a minute', SUBMIT_WINDOW)
+
+    if client and count_rows("SELECT COUNT(*) FROM TASKS WHERE CLIENT = ? AND CREATED_ON >= ?", (client, since)) >= MAX_SUBMITS_PER_CLIENT:
+        return (False, 'too many mosaics requested from your connection, try again in a minute', SUBMIT_WINDOW)
+
+    queue_depth = count_rows(
+        f"SELECT COUNT(*) FROM TASKS WHERE STATUS IN ({','.join('?' for _ in WAITING_STATUSES)}) AND CREATED_ON >= ?",
+        (*WAITING_STATUSES, get_expiry_cutoff()))
+    estimated_wait = get_estimated_wait(queue_depth)
+    if queue_depth >= MAX_QUEUE_DEPTH or estimated_wait > MAX_ESTIMATED_WAIT:
+        return (False, 'moviemosaic is really busy right now, try again in a few minutes', min(estimated_wait, MAX_ESTIMATED_WAIT))
+
+    return (True, None, 0)
+
+# TASKS(id, user, mode, progress_msg, status, error_msg, created_on, client, range_start, range_end, members, estimated_seconds)
+def parse_members(username: str, group_members: str) -> tuple[list[str], str]:
+    '''
+    username + the comma or space separated usernames of the rest of a group -> (members, None),
+    (None, None) when no one else is listed or (None, error message)
+    '''
+    others = clean(group_members).replace(',', ' ').split()
+    members = list(dict.fromkeys(member.lower() for member in [username, *others]))
+    if len(members) < 2:
+        return (None, None)
+    if len(members) > MAX_GROUP_MEMBERS:
+        return (None, f'a group mosaic can have at most {MAX_GROUP_MEMBERS} members')
+    return (members, None)
+
+def parse_date_range(range_start: str, range_end: str) -> tuple[tuple[str, str], str]:
+    '''
+    returns (('YYYY-MM-DD', 'YYYY-MM-DD'), None) or (None, error message)
+    '''
+    try:
+        start = datetime.strptime(range_start, '%Y-%m-%d')
+        end = datetime.strptime(range_end, '%Y-%m-%d')
+    except ValueError:
+        return (None, 'dates should look like 2024-01-31')
+    if start > end:
+        return (None, 'the start of the date range has to be before the end')
+    return ((start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')), None)
+
+def start_task(user: str, mode: int, client: str = None, date_range: tuple[str, str] = None, members: list[str] = None) -> tuple[str, str, int]:
+    '''
+    starts task in database if there is room for it, a group mosaic when members is given
+    returns (task_id, None, 0) or (None, error message, retry after seconds) when the task was turned away
+    '''
+    # letterboxd usernames aren't case sensitive, "Alice" and "alice" count toward the same limit
+    user = user.lower()
+    admitted, err, retry_after = check_admission(user, client)
+    if not admitted:
+        return (None, err, retry_after)
 
     task_id = str(uuid4())
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     get_db().execute(
         """
-        INSERT INTO TASKS 
-        VALUES (?, ?, ?, ?, ?, ?)
+        INSERT INTO TASKS(id, user, mode, progress_msg, status, error_msg, created_on, client, range_start, range_end, members)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
-        (task_id, user, mode, 'TASK QUEUED', 'READY', 'NULL')
+        (task_id, user, mode, 'TASK QUEUED', 'READY', 'NULL', now, client, *(date_range or (None, None)),
+         ','.join(members) if members else None)
     )
     get_db().commit()
-    return task_id
+    return (task_id, None, 0)
 
-def get_result(task_id: str) -> str:
-    cur = get_db().cursor()
-    cur.execute("""
-    SELECT * FROM RESULTS WHERE ID = ?
-    """, (task_id,))
-
-    result_row = cur.fetchone()
-    cur.close()
+def negotiate_result(task_id: str, rendition: str) -> Response:
+    '''
+    streams the smallest stored format of a rendition the browser says it can show,
+    png for anything that doesn't send Accept. returns None if the rendition doesn't exist for task_id
+    '''
+    fmt = choose_format(request.accept_mimetypes, get_result_store(get_db()).formats(task_id, rendition))
+    response = stream_result(task_id, fmt, rendition) if fmt else None
+    if response is not None:
+        response.vary.add('Accept')
+    return response
 
-    if result_row is None:
+def stream_result(task_id: str, fmt: str = 'png', rendition: str = 'full') -> Response:
+    '''
+    streams a task's mosaic out of the result store in chunks so memory per request doesn't grow with the image
+    returns None if there is no mosaic in format fmt for task_id
+    '''
+    result = get_result_store(get_db()).stream(task_id, fmt, rendition)
+    if result is None:
         return None
+    size, digest, chunks = result
 
-    _, result, _ = result_row
+    if digest and digest in request.if_none_match:
+        return Response(status=304)
 
-    return result
+    response = Response(stream_with_context(chunks), mimetype=get_mimetype(fmt), direct_passthrough=True)
+    if size:
+        response.content_length = size
+    if digest:
+        # a task's mosaic never changes so browsers can keep it until the result expires
+        response.set_etag(digest)
+        response.cache_control.private = True
+        response.cache_control.max_age = EXPIRY_TIME
+    return response
 
 if __name__ == "__main__":
     # clear_data()
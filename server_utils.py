@@ -1,11 +1,23 @@
 '''
 utility functions for server
-USAGE: disco run --project [PROJECT_NAME] "python server_utils.py [cache/refresh]"
+USAGE: disco run --project [PROJECT_NAME] "python server_utils.py [cache/refresh/profile/batch]"
 
 cache - displays contents of DB_CACHE table
 
+cache stats [N] - poster cache hit/miss/eviction totals, entry ages and the N most reused posters
+
+cache warmup [ids/rss/db] [file...], cache import [directory] - pre-fills DB_CACHE (see cache_warmup.py)
+
+cache transcode [codec] - rewrites DB_CACHE posters in the configured (or given) storage codec (see poster_codec.py)
+
 refresh - removes rows from TASKS and RESULTS table. Displays how many rows were removed
 
+databases [split] - file, size and settings of each store, split moves tables into their own store's file (see databases.py)
+
+profile [task_id] - summarizes a task profiled by the worker (see profiling.py)
+
+batch [roster_file] [output_dir] [processes] - builds mosaics offline for a list of users (see batch_builder.py)
+
 '''
 
 
@@ -15,8 +27,11 @@ import sys
 from dotenv import load_dotenv
 if os.path.isfile('.env'):
     load_dotenv('.env')
+from schema import create_tables, split_databases
+from databases import connect, get_schemas, get_path, STORES
 
-db = sqlite3.connect(os.environ['DATABASE'])
+# `databases split` is what fixes the tables connect() otherwise refuses to open with
+db = connect(check_shadowed=sys.argv[1:2] != ['databases'])
 
 def refresh_tables():
     cur = db.cursor()
@@ -28,30 +43,134 @@ def refresh_tables():
     db.execute("DROP TABLE IF EXISTS TASKS")
     db.execute("DROP TABLE IF EXISTS RESULTS")
     db.commit()
-    cur.execute("CREATE TABLE IF NOT EXISTS TASKS(id, user, mode, progress_msg, status, error_msg)")
-    cur.execute("CREATE TABLE IF NOT EXISTS RESULTS(id, result, created_on)")
-    db.commit()
+    create_tables(db, ['TASKS', 'RESULTS'])
     db.close()
 
     print(f'removed {tasks_row_count} rows from TASKS')
     print(f'removed {results_row_count} rows from RESULTS')
 
 def show_cache():
-    cur = db.execute("SELECT * FROM DB_CACHE")
+    cur = db.execute("SELECT FILENAME, IMAGEBLOB, LAST_USED_DATE, CODEC FROM DB_CACHE")
     rows = cur.fetchall()
     cur.close()
     for index, row in enumerate(rows):
-        filename, blob, date = row
-        print(f"{index:<5} {filename:<30} {len(blob):<12} {date:<20}")
+        filename, blob, date, codec = row
+        print(f"{index:<5} {filename:<30} {len(blob):<12} {date:<20} {codec or '':<20}")
+
+USAGE = '''- (cache) display contents of cache
+- (cache stats [N]) poster cache telemetry and the N (default 10) most reused posters
+- (refresh) refresh contents of TASKS and RESULTS table.
+- (databases [split]) show the file behind each store, split moves tables left in DATABASE to their store's own file
+- (profile [task_id]) summarize hottest functions and allocation sites of a profiled task. lists profiled tasks if no task_id
+- (cache warmup [ids/rss/db] [file...]) pre-fill the poster cache from tmdb ids, saved rss feeds or another database
+- (cache import [directory]) load a directory of poster images named after their film into the poster cache
+- (cache transcode [codec]) re-encode cached posters in the poster_storage codec from config.json (or webp/jpeg/png/raw)
+- (batch [roster_file] [output_dir] [processes]) build mosaics for every `username [mode]` line of roster_file into output_dir'''
+
+def show_cache_stats(top_n: int):
+    from db_cache import get_cache_report, DEFAULT_MAX_SIZE
+    report = get_cache_report(db, top_n)
+    stats = report['stats']
+    hit_ratio = f"{report['hit_ratio']:.1%}" if report['hit_ratio'] is not None else 'n/a'
+
+    print(f"{report['entries']} entries (max_size {DEFAULT_MAX_SIZE}), {report['bytes']} bytes")
+    print(f"lookups {stats['lookups']}  hits {stats['hits']}  misses {stats['misses']}  hit ratio {hit_ratio}")
+    print(f"inserts {stats['inserts']}  evictions {stats['evictions']}  bytes written {stats['bytes_written']}")
+    # entries used within the last day/week is the working set, max_size below it means evicting posters still in use
+    print(f"{'':<10} {'inserted':>10} {'last used':>10}")
+    for bucket in report['age']:
+        print(f"{'<' + bucket if bucket not in ('older', 'unknown') else bucket:<10} {report['age'][bucket]:>10} {report['last_used'][bucket]:>10}")
+    print(f'top {top_n} most reused posters')
+    for filename, hits, created_on in report['top_reused']:
+        print(f"{hits:<8} {filename:<40} {created_on or '':<20}")
+
+def cache_command(args: list):
+    create_tables(db, ['DB_CACHE', 'CACHE_STATS', 'TMDB_CACHE'])
+    if args[0] == 'stats' and len(args) <= 2:
+        show_cache_stats(int(args[1]) if len(args) == 2 else 10)
+        return
+
+    # imported here so the other commands don't pay for PIL/bs4/aiohttp
+    import cache_warmup
+    from db_cache import dbCache, DEFAULT_MAX_SIZE
+    db_cache = dbCache(DEFAULT_MAX_SIZE, db)
+
+    if args[0] == 'import' and len(args) == 2:
+        cache_warmup.import_directory(db, db_cache, args[1])
+    elif args[0] == 'warmup' and len(args) >= 3 and args[1] == 'ids':
+        cache_warmup.warm_from_ids(db, db_cache, args[2])
+    elif args[0] == 'warmup' and len(args) >= 3 and args[1] == 'rss':
+        cache_warmup.warm_from_rss(db, db_cache, args[2:])
+    elif args[0] == 'warmup' and len(args) == 3 and args[1] == 'db':
+        cache_warmup.warm_from_db(db, db_cache, args[2])
+    elif args[0] == 'transcode' and len(args) <= 2:
+        transcode_cache(args[1] if len(args) == 2 else None)
+    else:
+        print(f'invalid cache args `{" ".join(args)}`\n{USAGE}')
+
+def transcode_cache(codec: str):
+    import poster_codec
+    from database_janitor import reclaim_space
+    rows, before, after = poster_codec.transcode_cache(db, codec)
+    print(f'transcoded {rows} posters, {before} -> {after} bytes')
+    # the file only shrinks if it's in incremental auto_vacuum mode (database_janitor.py switches it)
+    print(f'database file shrank by {reclaim_space(db)} bytes')
+
+def show_databases():
+    schemas = get_schemas(db)
+    for schema, store in schemas.items():
+        path = get_path(store)
+        page_size = db.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+        journal_mode = db.execute(f'PRAGMA {schema}.journal_mode').fetchone()[0]
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        tables = [table for other, tables in STORES.items() if other == store or (schema == 'main' and other not in schemas.values()) for table in tables]
+        print(f"{store:<10} {path:<40} {size:>12} bytes  page_size {page_size:<6} {journal_mode:<5} {' '.join(tables)}")
+
+def move_tables():
+    from database_janitor import reclaim_space
+    moved = split_databases(db)
+    for table, rows in moved.items():
+        print(f'moved {rows} rows of {table}')
+    if not moved:
+        print('every table is already in its store\'s file')
+    else:
+        print(f'database files shrank by {reclaim_space(db)} bytes')
+
+def show_profile(args: list):
+    # imported here so the other commands don't pay for cProfile/tracemalloc
+    import profiling
+    if not args:
+        task_ids = profiling.list_profiles()
+        if not task_ids:
+            print(f'no profiles in {profiling.get_profiles_dir()} (set PROFILE_USERS or PROFILE_SAMPLE_RATE for the worker)')
+        for task_id in task_ids:
+            print(task_id)
+        return
+    print(profiling.summarize(args[0]))
 
 if __name__ == '__main__':
     args = sys.argv[1:]
-    if len(args) != 1:
-        print(f'invalid number of args\n- (cache) display contents of cache\n- (refresh) refresh contents of TASKS and RESULTS table.')
+    if not args:
+        print(f'invalid number of args\n{USAGE}')
     else:
-        if args[0] == 'cache':
-            pass
+        if args[0] == 'cache' and len(args) > 1:
+            cache_command(args[1:])
+        elif args[0] == 'cache':
+            create_tables(db, ['DB_CACHE'])
+            show_cache()
         elif args[0] == 'refresh':
             pass
+        elif args[0] == 'databases' and args[1:] == ['split']:
+            move_tables()
+        elif args[0] == 'databases' and len(args) == 1:
+            show_databases()
+        elif args[0] == 'profile':
+            show_profile(args[1:])
+        elif args[0] == 'batch':
+            if len(args) not in (3, 4):
+                print(f'invalid number of args for batch\n{USAGE}')
+            else:
+                from batch_builder import run_batch
+                run_batch(args[1], args[2], int(args[3]) if len(args) == 4 else None)
         else:
-            print(f'invalid arg `{args[0]}` passed\n- (cache) display contents of cache\n- (refresh) refresh contents of TASKS and RESULTS table.')
\ No newline at end of file
+            print(f'invalid arg `{args[0]}` passed\n{USAGE}')
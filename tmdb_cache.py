@@ -0,0 +1,67 @@
+'''
+tmdbCache class:
+stores the director and poster url resolved for a tmdb id so repeat films skip the two tmdb api calls.
+the table lives in the shared sqlite database so every worker/batch process benefits from the others' lookups.
+entries older than _max_age are treated as missing so poster changes on tmdb are eventually picked up.
+empty answers are negative cache entries with shorter ttls (see negative_cache.py): NOT_FOUND for ids tmdb 404s on,
+a NULL POSTER_URL for films without a poster and an empty DIRECTOR for films without a Director credit.
+
+rows in 'TMDB_CACHE' table are structured like this
+| TMDB_ID: int | TMDB_TYPE: str('mv'/'tv') | DIRECTOR: str | POSTER_URL: str | CREATED_ON: str(datetime) |
+'''
+
+import sqlite3
+from datetime import datetime, timedelta
+from negative_cache import load_negative_ttls
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+NOT_FOUND = (None, None) # (director, poster_url) pushed for ids tmdb doesn't know
+
+
+class tmdbCache:
+    _db: sqlite3.Connection
+    _max_age: timedelta
+    _negative_ttls: dict
+    def __init__(self, db: sqlite3.Connection, max_age: timedelta = timedelta(days=7), negative_ttls: dict = None) -> None:
+        self._db = db
+        self._max_age = max_age
+        self._negative_ttls = negative_ttls or load_negative_ttls()
+
+    def lookup(self, tmdb_id: int, tmdb_type: str) -> tuple[str, str]:
+        '''
+        returns (director, poster_url) or None if the id hasn't been resolved recently.
+        ids tmdb doesn't know come back as ('', None) like films with neither a poster nor a director
+        '''
+        def oldest(seconds: float) -> str:
+            return (datetime.now() - timedelta(seconds=seconds)).strftime(DATE_FORMAT)
+
+        cur = self._db.execute(
+            """
+            SELECT DIRECTOR, POSTER_URL FROM TMDB_CACHE
+            WHERE TMDB_ID = ? AND TMDB_TYPE = ? AND CREATED_ON >= CASE
+                WHEN DIRECTOR IS NULL THEN ?
+                WHEN POSTER_URL IS NULL THEN ?
+                WHEN DIRECTOR = '' THEN ?
+                ELSE ?
+            END
+            """,
+            (tmdb_id, tmdb_type,
+             oldest(self._negative_ttls['tmdb_not_found']),
+             oldest(self._negative_ttls['tmdb_no_poster']),
+             oldest(self._negative_ttls['tmdb_no_director']),
+             oldest(self._max_age.total_seconds())))
+        data = cur.fetchone()
+        cur.close()
+        if not data:
+            return None
+        director, poster_url = data
+        return (director or '', poster_url)
+
+    def push(self, tmdb_id: int, tmdb_type: str, director: str, poster_url: str) -> None:
+        self._db.execute(
+            """
+            INSERT OR REPLACE INTO TMDB_CACHE(TMDB_ID, TMDB_TYPE, DIRECTOR, POSTER_URL, CREATED_ON)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (tmdb_id, tmdb_type, director, poster_url, datetime.now().strftime(DATE_FORMAT)))
+        self._db.commit()
@@ -4,9 +4,45 @@ Get director name from tmdb api using the tmdbsimple api
 
 import tmdbsimple as tmdb
 import os
+import re
+import time
+import asyncio
+import requests
+from rate_limiter import get_limiter, retry_delay, RETRY_STATUSES
+
+TMDB_RETRIES = 3
+
+class RateLimitedSession(requests.Session):
+    '''
+    every tmdbsimple call goes through the shared 'tmdb_api' bucket (see rate_limiter.py).
+    429/5xx responses are retried, a 429 blocks the bucket for every process until its Retry-After
+    '''
+    def request(self, method, url, *args, **kwargs):
+        limiter = get_limiter('tmdb_api')
+        for attempt in range(TMDB_RETRIES):
+            limiter.acquire()
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt + 1 == TMDB_RETRIES:
+                return response
+            delay = retry_delay(attempt, response.headers.get('Retry-After'))
+            response.close()
+            if response.status_code == 429:
+                # the next acquire() waits this out
+                limiter.throttled(delay)
+            else:
+                time.sleep(delay)
+
 tmdb.API_KEY = os.environ['TMDB_API_KEY']
+# (connect, read) seconds, tmdbsimple waits forever by default and a stuck call would outlive the task's deadline
+tmdb.REQUESTS_TIMEOUT = (5, 10)
+# also keeps connections to tmdb alive between calls
+tmdb.REQUESTS_SESSION = RateLimitedSession()
 movie: tmdb.Movies
 
+# poster sizes tmdb serves, posters are 2:3 so every size is (width, width * 1.5)
+POSTER_SIZES = [('w92', 92), ('w154', 154), ('w185', 185), ('w342', 342), ('w500', 500), ('w780', 780)]
+POSTER_SIZE_PATTERN = re.compile(r'/t/p/(w\d+|original)/')
+
 def get_director(tmdb_id: int, tmdb_type: str) -> str:
     '''
     Takes in tmdb movie id and returns director's name string
@@ -22,14 +58,7 @@ def get_director(tmdb_id: int, tmdb_type: str) -> str:
         tv = tmdb.TV(tmdb_id)
         response = tv.credits()
         
-    if not response or 'crew' not in response:
-        return ''
-
-    for role in response['crew']:
-        if role['job'] == 'Director':
-            return role['name']
-    
-    return ''
+    return director_from_credits(response)
 
     # try:
     #     response = movie.credits()['crew']
@@ -41,6 +70,16 @@ def get_director(tmdb_id: int, tmdb_type: str) -> str:
     #     director = ''
     # return director
 
+def director_from_credits(response: dict) -> str:
+    if not response or 'crew' not in response:
+        return ''
+
+    for role in response['crew']:
+        if role['job'] == 'Director':
+            return role['name']
+    
+    return ''
+
 def get_tmdb_poster_url(tmdb_id: int, tmdb_type: str) -> str:
     '''
     Takes in tmdb (movie or tv) id and returns url for poster
@@ -72,3 +111,61 @@ def get_tmdb_poster_url(tmdb_id: int, tmdb_type: str) -> str:
     # file_path = image_dict['file_path']
     # print(f'file_path: {file_path}')
     return f'http://image.tmdb.org/t/p/w500/{file_path}'
+
+def get_poster_size(thumbnail_size: tuple[int, int]) -> str:
+    '''
+    smallest tmdb poster size that still covers a thumbnail, so posters are only ever scaled down
+    '''
+    thumb_width, thumb_height = thumbnail_size
+    for size, width in POSTER_SIZES:
+        if width >= thumb_width and width * 3 // 2 >= thumb_height:
+            return size
+    return 'original'
+
+def set_poster_size(poster_url: str, size: str) -> str:
+    '''
+    swaps the size in a poster url, urls in TMDB_CACHE keep whatever size they were fetched with
+    '''
+    if not poster_url:
+        return poster_url
+    return POSTER_SIZE_PATTERN.sub(f'/t/p/{size}/', poster_url, count=1)
+
+def get_title(tmdb_id: int, tmdb_type: str) -> str:
+    '''
+    Takes in tmdb (movie or tv) id and returns its title
+    '''
+    if tmdb_type == 'tv':
+        return tmdb.TV(tmdb_id).info().get('name', '')
+    return tmdb.Movies(tmdb_id).info().get('title', '')
+
+# async versions for the async worker (worker.py --async), they share a keep-alive aiohttp session across tasks
+# instead of tmdbsimple's blocking requests. responses are read the same way as above
+TMDB_API_URL = 'https://api.themoviedb.org/3'
+TMDB_PATHS = {'mv': 'movie', 'tv': 'tv'}
+
+async def fetch_tmdb(session: "aiohttp.ClientSession", path: str, **params) -> dict:
+    # same rate limiting and retries as RateLimitedSession
+    limiter = get_limiter('tmdb_api')
+    for attempt in range(TMDB_RETRIES):
+        await limiter.acquire_async()
+        async with session.get(f'{TMDB_API_URL}/{path}', params={'api_key': tmdb.API_KEY, **params}) as response:
+            if response.status not in RETRY_STATUSES or attempt + 1 == TMDB_RETRIES:
+                response.raise_for_status()
+                return await response.json()
+            delay = retry_delay(attempt, response.headers.get('Retry-After'))
+        if response.status == 429:
+            await limiter.throttled_async(delay)
+        else:
+            await asyncio.sleep(delay)
+
+async def async_get_director(session: "aiohttp.ClientSession", tmdb_id: int, tmdb_type: str) -> str:
+    return director_from_credits(await fetch_tmdb(session, f'{TMDB_PATHS[tmdb_type]}/{tmdb_id}/credits'))
+
+async def async_get_tmdb_poster_url(session: "aiohttp.ClientSession", tmdb_id: int, tmdb_type: str) -> str:
+    path = f'{TMDB_PATHS[tmdb_type]}/{tmdb_id}/images'
+    posters = (await fetch_tmdb(session, path, include_image_language='en'))['posters']
+    if not posters:
+        posters = (await fetch_tmdb(session, path))['posters']
+    if not posters:
+        return None
+    return f'http://image.tmdb.org/t/p/w500/{posters[0]["file_path"]}'
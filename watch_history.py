@@ -0,0 +1,135 @@
+'''
+watchHistory class:
+keeps every diary entry parsed from a user's letterboxd rss feed. the feed only holds the most recent entries and
+lists them newest first, so ingest() parses until it reaches a guid it already has and appends only what is new.
+returning users pay for the entries logged since their last mosaic, and mosaics can cover months that have
+already dropped out of the feed.
+
+rows in 'WATCH_HISTORY' table are structured like this
+| USERNAME: str(lowercase) | GUID: str | TITLE: str | WATCHED_DATE: str(date) | RATING: float(-1 when unrated) |
+| TMDB_ID: int | TMDB_TYPE: str('mv'/'tv') | ADDED_ON: str(datetime) |
+rows are appended oldest first, so ROWID breaks ties between entries watched on the same day in feed order
+'''
+
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from io import BytesIO
+from typing import Callable, Iterable
+from lxml import etree
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+WATCHED_DATE_FORMAT = '%Y-%m-%d'
+
+@dataclass
+class WatchEntry:
+    guid: str
+    title: str
+    watched_date: datetime
+    rating: float
+    tmdb_id: int
+    tmdb_type: str
+
+def parse_feed(feed_content: bytes, username: str, seen: Callable[[str], bool] = lambda guid: False) -> list[WatchEntry]:
+    '''
+    diary entries in feed order (newest first), stops at the first entry whose guid seen() knows.
+    lists and entries without a watched date or tmdb id are skipped
+    '''
+    entries = []
+    for _, item in etree.iterparse(BytesIO(feed_content), events=('end',), tag='item', recover=True):
+        fields = {etree.QName(child).localname: (child.text or '').strip() for child in item}
+        item.clear()
+
+        guid = fields.get('guid') or fields.get('link')
+        if seen(guid):
+            break
+        if f'https://letterboxd.com/{username}/list/' in fields.get('link', '') or not fields.get('watchedDate'):
+            continue
+
+        tmdb_type = 'mv' if fields.get('movieId') else 'tv'
+        tmdb_id = fields.get('movieId') or fields.get('tvId')
+        if not tmdb_id:
+            continue
+
+        entries.append(WatchEntry(
+            guid=guid,
+            title=fields.get('filmTitle', ''),
+            watched_date=datetime.strptime(fields['watchedDate'], WATCHED_DATE_FORMAT),
+            rating=float(fields['memberRating']) if fields.get('memberRating') else -1,
+            tmdb_id=int(tmdb_id),
+            tmdb_type=tmdb_type
+        ))
+    return entries
+
+def select_entries(entries: Iterable[WatchEntry], start: datetime = None, end: datetime = None, limit: int = None) -> list[WatchEntry]:
+    '''
+    entries newest first -> entries watched between start and end (inclusive, either can be None),
+    each title kept once at its most recent watch, at most limit of them
+    '''
+    selected = {}
+    for entry in entries:
+        if (start and entry.watched_date < start) or (end and entry.watched_date > end):
+            continue
+        selected.setdefault(entry.title, entry)
+        if limit and len(selected) >= limit:
+            break
+    return list(selected.values())
+
+
+class watchHistory:
+    _db: sqlite3.Connection
+    def __init__(self, db: sqlite3.Connection) -> None:
+        self._db = db
+
+    def seen(self, username: str, guid: str) -> bool:
+        cur = self._db.execute('SELECT 1 FROM WATCH_HISTORY WHERE USERNAME = ? AND GUID = ?', (username.lower(), guid))
+        data = cur.fetchone()
+        cur.close()
+        return data is not None
+
+    def ingest(self, username: str, feed_content: bytes) -> int:
+        '''
+        appends the feed's entries newer than anything stored for username, returns how many were added
+        '''
+        entries = parse_feed(feed_content, username, lambda guid: self.seen(username, guid))
+        if not entries:
+            return 0
+
+        now = datetime.now().strftime(DATE_FORMAT)
+        self._db.executemany(
+            """
+            INSERT OR IGNORE INTO WATCH_HISTORY(USERNAME, GUID, TITLE, WATCHED_DATE, RATING, TMDB_ID, TMDB_TYPE, ADDED_ON)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(username.lower(), entry.guid, entry.title, entry.watched_date.strftime(WATCHED_DATE_FORMAT),
+              entry.rating, entry.tmdb_id, entry.tmdb_type, now) for entry in reversed(entries)])
+        self._db.commit()
+        return len(entries)
+
+    def query(self, username: str, start: datetime = None, end: datetime = None, limit: int = None) -> list[WatchEntry]:
+        '''
+        select_entries() over the stored history, rows are read newest first off the (USERNAME, WATCHED_DATE)
+        index and reading stops once limit titles are found
+        '''
+        cur = self._db.execute(
+            """
+            SELECT GUID, TITLE, WATCHED_DATE, RATING, TMDB_ID, TMDB_TYPE FROM WATCH_HISTORY
+            WHERE USERNAME = ? AND WATCHED_DATE >= ? AND WATCHED_DATE <= ?
+            ORDER BY WATCHED_DATE DESC, ROWID DESC
+            """,
+            (username.lower(),
+             start.strftime(WATCHED_DATE_FORMAT) if start else '',
+             end.strftime(WATCHED_DATE_FORMAT) if end else '9999-12-31'))
+        entries = (
+            WatchEntry(guid, title, datetime.strptime(watched_date, WATCHED_DATE_FORMAT), rating, tmdb_id, tmdb_type)
+            for guid, title, watched_date, rating, tmdb_id, tmdb_type in cur
+        )
+        selected = select_entries(entries, limit=limit)
+        cur.close()
+        return selected
+
+    def get_count(self, username: str) -> int:
+        cur = self._db.execute('SELECT COUNT(*) FROM WATCH_HISTORY WHERE USERNAME = ?', (username.lower(),))
+        count = cur.fetchone()[0]
+        cur.close()
+        return count
@@ -3,17 +3,28 @@ Background worker that will check/execute tasks in database
 '''
 import sqlite3
 import os
+import sys
 from dotenv import load_dotenv
 if os.path.isfile('.env'):
     load_dotenv('.env')
-from collections import deque
 from time import sleep
 from fetch_data import MovieCellBuilder
 from image_builder import build
-from datetime import datetime
-import io
-import base64
 import db_cache
+import io
+from datetime import datetime
+from tmdb_cache import tmdbCache
+from watch_history import watchHistory
+from negative_cache import negativeCache
+from metrics import TaskMetrics
+from profiling import profile_task
+from scheduler import TaskScheduler
+from schema import create_tables
+from databases import connect
+from result_store import get_result_store
+from encoder import encode_all, encode_preview, load_output_formats, load_preview_config
+from large_mosaic import build_striped, load_large_mosaic_config, use_striped
+from deadline import TaskDeadline, load_deadlines
 
 def get_new_tasks(db: sqlite3.Connection) -> list:
     # check if there is a new task in TASKS
@@ -34,19 +45,24 @@ def update_task_status(db: sqlite3.Connection, task_id: str, status: str, progre
 
     db.commit()
 
-def push_result(db: sqlite3.Connection, task_id: str, result: str):
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    db.execute(
-        """
-        INSERT INTO RESULTS
-        VALUES (?, ?, ?)
-        """,
-        (task_id, result, now)
-        )
-    db.commit()
+def push_result(db: sqlite3.Connection, task_id: str, result: bytes, fmt: str = 'png', rendition: str = 'full'):
+    get_result_store(db).put(task_id, result, fmt, rendition)
+
+def get_date_range(task: tuple) -> tuple[datetime, datetime]:
+    # TASKS(id, user, mode, progress_msg, status, error_msg, created_on, client, range_start, range_end, members, estimated_seconds)
+    if int(task[2]) != 3 or not task[8] or not task[9]:
+        return None
+    return (datetime.strptime(task[8], '%Y-%m-%d'), datetime.strptime(task[9], '%Y-%m-%d'))
+
+def get_members(task: tuple) -> list[str]:
+    # usernames of a group mosaic, None for a single user's mosaic
+    if len(task) < 11 or not task[10]:
+        return None
+    return task[10].split(',')
 
 def main(db: sqlite3.Connection, db_cache: db_cache.dbCache):
-    tasks = deque()
+    tmdb_cache = tmdbCache(db)
+    tasks = TaskScheduler(db)
     while True:
         sleep(1)
         # get new tasks
@@ -54,72 +70,152 @@ def main(db: sqlite3.Connection, db_cache: db_cache.dbCache):
 
         # set status of all new tasks to queued
         for task in new_tasks:
-            tasks.append(task)
+            tasks.push(task, get_members(task) or [task[1]], get_date_range(task))
             update_task_status(db, task[0], 'QUEUED', "I'M WAITING :/")
 
         # see if any tasks exist
         if not tasks:
             continue
 
-        start_time = datetime.now()
-        
-        # task is starting to we change its status immediately to reflect change on front end
-        update_task_status(db, tasks[0][0], 'COLLECTING DATA', "I'M COLLECTING DATA")
-
-        # 
-        movie_cell_builder = MovieCellBuilder(
-            username = tasks[0][1],
-            mode = int(tasks[0][2]),
-            db_cache=db_cache
-        )
-
-        status, err = movie_cell_builder.get_status()
-
-        # username is no good
-        if not status:
-            update_task_status(db, tasks[0][0], 'ERROR', "I BROKE IT :(", err)
-            push_result(db, tasks[0][0], 'NULL')
-            tasks.popleft()
-            continue
-
+        # cheapest expected task first, see scheduler.py
+        task, estimate = tasks.pop()
+        metrics = TaskMetrics(task[0])
+        estimate.count(metrics)
+        status = 'ERROR'
+        try:
+            with profile_task(task[0], task[1], metrics) as checkpoint:
+                status = run_task(db, db_cache, tmdb_cache, task, metrics, checkpoint)
+        except Exception as e:
+            # the worker stays up for the tasks still queued
+            print(f'TASK {task[0]} FAILED: {type(e).__name__}: {e}')
+            update_task_status(db, task[0], 'ERROR', "I BROKE IT :(", 'something went wrong building your mosaic, try again soon')
+            push_result(db, task[0], None)
+        metrics.push(db, status)
+
+def run_task(db: sqlite3.Connection, db_cache: db_cache.dbCache, tmdb_cache: tmdbCache, task: tuple, metrics: TaskMetrics, checkpoint=lambda: None) -> str:
+    '''
+    collects data for a task, builds its mosaic and pushes the result.
+    returns the final status of the task
+    '''
+    # task is starting to we change its status immediately to reflect change on front end
+    update_task_status(db, task[0], 'COLLECTING DATA', "I'M COLLECTING DATA")
+    # slow stages give up and render what they have instead of holding up the queue
+    deadline = TaskDeadline(load_deadlines('config.json'), metrics)
+
+    # 
+    movie_cell_builder = MovieCellBuilder(
+        username = task[1],
+        mode = int(task[2]),
+        db_cache=db_cache,
+        metrics=metrics,
+        tmdb_cache=tmdb_cache,
+        date_range=get_date_range(task),
+        deadline=deadline,
+        watch_history=watchHistory(db),
+        negative_cache=negativeCache(db),
+        members=get_members(task)
+    )
+
+    status, err = movie_cell_builder.get_status()
+
+    # username is no good
+    if not status:
+        update_task_status(db, task[0], 'ERROR', "I BROKE IT :(", err)
+        push_result(db, task[0], None)
+        return 'ERROR'
+
+    # a year or custom range can need more posters than the cache holds, none are evicted until the mosaic is rendered
+    with db_cache.pinned(movie_cell_builder.get_movie_poster_paths()):
         movie_cells = movie_cell_builder.build_cells()
 
         # task is building image now
-        update_task_status(db, tasks[0][0], 'BUILDING MOSAIC', "I'M BUILDING UR MOSAIC")
+        update_task_status(db, task[0], 'BUILDING MOSAIC', "I'M BUILDING UR MOSAIC")
+        encoded, preview = render(db, task, movie_cells, movie_cell_builder, metrics, checkpoint, deadline)
+    store_results(db, task[0], encoded, preview, metrics)
+
+    # mark task as complete
+    update_task_status(db, task[0], 'COMPLETE', 'ALL DONE!')
+    return 'COMPLETE'
+
+def render(db: sqlite3.Connection, task: tuple, movie_cells: list, movie_cell_builder: MovieCellBuilder, metrics: TaskMetrics, checkpoint=lambda: None, deadline: TaskDeadline = None) -> tuple[dict, dict]:
+    deadline = deadline or TaskDeadline(None, metrics)
+    if use_striped(len(movie_cells), load_large_mosaic_config('config.json')):
+        return build_large(db, task, movie_cells, movie_cell_builder, metrics, checkpoint, deadline)
+    return build_regular(db, task, movie_cells, movie_cell_builder, metrics, checkpoint, deadline)
+
+def store_results(db: sqlite3.Connection, task_id: str, encoded: dict, preview: dict, metrics: TaskMetrics) -> None:
+    metrics.count('result_bytes', sum(len(image_data) for image_data in [*encoded.values(), *preview.values()]))
+    with metrics.stage('result_insert'):
+        for fmt, image_data in encoded.items():
+            push_result(db, task_id, image_data, fmt)
+        for fmt, image_data in preview.items():
+            push_result(db, task_id, image_data, fmt, 'preview')
+
+def build_regular(db: sqlite3.Connection, task: tuple, movie_cells: list, movie_cell_builder: MovieCellBuilder, metrics: TaskMetrics, checkpoint=lambda: None, deadline: TaskDeadline = None) -> tuple[dict, dict]:
+    '''
+    composites the whole mosaic in memory and encodes it in every output format.
+    returns ({format: bytes}, {preview format: bytes}), past the render deadline only the png is made
+    '''
+    deadline = deadline or TaskDeadline(None, metrics)
+    with metrics.stage('compositing'):
         image = build(
             movie_cells=movie_cells,
-            username=tasks[0][1],
+            username=task[1],
             config_path='config.json',
             last_watch_date=movie_cell_builder.get_last_movie_date(),
-            db=db
+            db=db,
+            metrics=metrics,
+            members=movie_cell_builder.get_members()
             )
-        
-        # image has been built now we need to store it in RESULTS table
-        buffer = io.BytesIO()
-        image.save(buffer, format='PNG')
-        buffer.seek(0)
-        image_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
-       # push_result(db, task[0][0], image_string)
-        push_result(db, tasks[0][0], image_string)
-
-
-        # mark task as complete
-        update_task_status(db, tasks[0][0], 'COMPLETE', 'ALL DONE!')
-
-        # remove task from queue
-        tasks.popleft()
-
-        # testing to see object persistence
-        print(f'DB_CACHE: {str(db_cache)}')
+    
+    # image has been built now we need to encode it in every format for the RESULTS table
+    encoded = encode_all(image, load_output_formats('config.json'), metrics, deadline.until('render'))
+    # the result page shows a small copy first, made from the same canvas
+    preview = encode_preview(image, load_preview_config('config.json'), metrics, deadline.until('render'))
+    checkpoint()
+    return (encoded, preview)
+
+def build_large(db: sqlite3.Connection, task: tuple, movie_cells: list, movie_cell_builder: MovieCellBuilder, metrics: TaskMetrics, checkpoint=lambda: None, deadline: TaskDeadline = None) -> tuple[dict, dict]:
+    '''
+    renders big mosaics in stripes straight into a png so the full canvas never exists in memory.
+    only png is produced, the other output formats would need the whole canvas decoded at once
+    '''
+    deadline = deadline or TaskDeadline(None, metrics)
+    preview_config = load_preview_config('config.json')
+    date_range = get_date_range(task)
+    buffer = io.BytesIO()
+    with metrics.stage('striped_render'):
+        preview_image = build_striped(
+            movie_cells=movie_cells,
+            username=task[1],
+            config_path='config.json',
+            last_watch_date=movie_cell_builder.get_last_movie_date(),
+            db=db,
+            out=buffer,
+            metrics=metrics,
+            end_date=date_range[1] if date_range else None,
+            preview_width=preview_config['max_width'],
+            members=movie_cell_builder.get_members()
+            )
+    # a view of the buffer rather than a copy, the compressed png is the biggest thing left in memory
+    encoded = {'png': buffer.getbuffer()}
+    metrics.count('bytes_png', len(encoded['png']))
+    checkpoint()
+    return (encoded, encode_preview(preview_image, preview_config, metrics, deadline.until('render')))
 
 
 if __name__ == '__main__':
     # https://moviemosaic.org/user/shuval/d9a577be-2fef-4120-9a4a-ab464ff355b2
-    db = sqlite3.connect(os.environ['DATABASE'])
-    cur = db.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS TASKS(id, user, mode, progress_msg, status, error_msg)")
-    cur.execute("CREATE TABLE IF NOT EXISTS RESULTS(id, result, created_on)")
-    cur.execute("CREATE TABLE IF NOT EXISTS DB_CACHE(FILENAME, IMAGEBLOB, LAST_USED_DATE)")
-    cur.close()
-    db.commit()
-    main(db, db_cache.dbCache(100, db))
+    db = connect()
+    create_tables(db)
+    if '--async' in sys.argv or os.environ.get('WORKER_MODE') == 'async':
+        # several tasks at once on one event loop, see async_worker.py
+        import asyncio
+        import async_worker
+        asyncio.run(async_worker.main(db))
+    elif '--prefork' in sys.argv or os.environ.get('WORKER_MODE') == 'prefork':
+        # warm parent forking executor processes, see prefork.py
+        import prefork
+        prefork.main(db)
+    else:
+        main(db, db_cache.dbCache(db_cache.DEFAULT_MAX_SIZE, db))